@@ -0,0 +1,86 @@
+# Helpers shared by the benchmark scripts in this directory.
+
+import os
+import resource
+import socket
+import ssl
+import subprocess
+import time
+
+from securedrop.server import Authentication, ClientData, RegisteredUsers, hash_email
+
+PASSWORD = "password_v12"
+
+
+def make_cert(path):
+    subprocess.run([
+        "openssl", "req", "-new", "-x509", "-days", "1", "-nodes", "-subj", "/CN=localhost", "-out", path, "-keyout",
+        path
+    ],
+                   check=True,
+                   stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL)
+
+
+def make_context(cert_path="server.pem"):
+    ctx = ssl.create_default_context(ssl.Purpose.SERVER_AUTH, cafile=cert_path)
+    ctx.check_hostname = False
+    return ctx
+
+
+def user_email(i):
+    return "user{}@bench.com".format(i)
+
+
+def make_users(filename, count, password=PASSWORD):
+    # Registering one by one derives a key and rewrites the whole file per user, so build the file in one go. All
+    # users share one salt, which makes no difference to the cost of logging in.
+    auth = Authentication(password)
+    users = RegisteredUsers(filename)
+    for i in range(count):
+        email = user_email(i)
+        users.users[hash_email(email)] = ClientData("user{}".format(i), email, dict(), auth=auth)
+    users.write_json()
+    return [user_email(i) for i in range(count)]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=10):
+    ctx = make_context()
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("localhost", port)) as raw, ctx.wrap_socket(raw):
+                return
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+    raise RuntimeError("Server did not start listening on port {}".format(port))
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * q))]
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"],
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              check=True,
+                              capture_output=True,
+                              text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
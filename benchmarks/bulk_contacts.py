@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+# Time to import a user's contacts: one AddContactPackets request per contact, each of which rewrites the users file,
+# against a single AddContactsPackets batch, which is written once. Each run imports into a fresh user of a database
+# that holds --users users, since the cost of a write grows with the file. Prints (or writes) JSON with the seconds
+# and contacts per second per mode.
+#
+#   PYTHONPATH=. ./benchmarks/bulk_contacts.py --contacts 2000 --users 1000
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from multiprocessing import Process
+
+from tornado.ioloop import IOLoop
+
+from bench_utils import PASSWORD, make_cert, make_users, user_email, free_port, wait_for_port, git_revision
+from securedrop.session import SecureDropSession
+from securedrop.server import ServerDriver
+
+MODES = ("single", "batch")
+
+
+async def import_contacts(port, mode, user, count):
+    session = SecureDropSession("localhost", port)
+    await session.main()
+    try:
+        await session.login(user_email(user), PASSWORD)
+        contacts = [("contact{}".format(i), "contact{}@bench.com".format(i)) for i in range(count)]
+        start = time.perf_counter()
+        if mode == "batch":
+            messages = await session.add_contacts(contacts)
+        else:
+            messages = []
+            for name, email in contacts:
+                await session.add_contact(name, email)
+                messages.append("")
+        seconds = time.perf_counter() - start
+    finally:
+        session.close()
+    return {
+        "mode": mode,
+        "contacts": count,
+        "added": messages.count(""),
+        "seconds": seconds,
+        "contacts_per_second": count / seconds,
+    }
+
+
+def run(args, port):
+    results = []
+    for user, mode in enumerate(args.modes.split(",")):
+        if mode not in MODES:
+            raise ValueError("Unknown mode {}".format(mode))
+        results.append(IOLoop.current().run_sync(lambda: import_contacts(port, mode, user, args.contacts)))
+        print(json.dumps(results[-1]), file=sys.stderr)
+    return {"revision": git_revision(), "time": time.time(), "args": vars(args), "results": results}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--contacts", type=int, default=2000, help="contacts imported per mode")
+    parser.add_argument("--users", type=int, default=1000, help="users in the database")
+    parser.add_argument("--modes", default=",".join(MODES), help="comma separated: single, batch")
+    parser.add_argument("--output", default=None, help="write the JSON results here instead of stdout")
+    args = parser.parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # the server and clients find server.pem in the working directory
+        os.chdir(tmp_dir)
+        make_cert("server.pem")
+        filename = os.path.join(tmp_dir, "server.json")
+        make_users(filename, max(args.users, len(MODES)))
+        port = free_port()
+        driver = ServerDriver(port, filename)
+        server = Process(target=driver.run)
+        server.start()
+        try:
+            wait_for_port(port)
+            result = run(args, port)
+        finally:
+            driver.stop()
+            server.join()
+            driver.close()
+
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(result, f, indent=2)
+    else:
+        json.dump(result, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+
+# Load generator for the control-plane Server. Opens many TLS connections, logs each in as its own user, then has
+# every connection run a weighted mix of operations back to back for a while. Prints (or writes) JSON with throughput
+# and latency percentiles per operation, so results can be compared between commits.
+#
+#   PYTHONPATH=. ./benchmarks/control_plane_load.py --connections 2000 --processes 4 --duration 30 \
+#       --mix login=1,add_contact=1,list=5,poll=20,register=0.1 --output load.json
+#
+# Without --port, a server is started in a temporary directory (with --workers, a supervisor with that many workers).
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from multiprocessing import Process, Queue
+
+from tornado.ioloop import IOLoop
+from tornado.tcpclient import TCPClient
+
+from bench_utils import PASSWORD, make_cert, make_context, make_users, user_email, free_port, wait_for_port, \
+    raise_fd_limit, percentile, git_revision
+from securedrop.List_Contacts_Packets import ListContactsPackets
+from securedrop.add_contact_packets import AddContactPackets
+from securedrop.client_server_base import read, write
+from securedrop.file_transfer_packets import FileTransferRequestResponsePackets
+from securedrop.login_packets import LoginPackets
+from securedrop.register_packets import RegisterPackets
+from securedrop.server import ServerDriver
+from securedrop.status_packets import STATUS_PACKETS_NAME, StatusPackets
+
+DEFAULT_MIX = "login=1,add_contact=1,list=5,poll=20"
+
+
+class LoadClient:
+    # one connection, logged in as users[index]
+    def __init__(self, port, ctx, index, users, process_index):
+        self.port, self.ctx, self.index, self.users = port, ctx, index, users
+        self.email = user_email(index)
+        self.stream = None
+        self.registered = 0
+        self.process_index = process_index
+
+    async def connect(self):
+        stream = await TCPClient().connect("localhost", self.port, ssl_options=self.ctx)
+        await stream.wait_for_handshake()
+        return stream
+
+    async def request(self, stream, packet):
+        await write(stream, bytes(packet))
+        data = await read(stream)
+        if data[:4] == STATUS_PACKETS_NAME:
+            msg = StatusPackets(data=data[4:]).message
+            if msg:
+                raise RuntimeError(msg)
+        return data
+
+    async def login(self):
+        await self.request(self.stream, LoginPackets(self.email, PASSWORD))
+
+    async def register(self):
+        # a new connection and a new user every time
+        self.registered += 1
+        email = "new{}.{}.{}@bench.com".format(self.process_index, self.index, self.registered)
+        stream = await self.connect()
+        try:
+            await self.request(stream, RegisterPackets(email, email, PASSWORD))
+        finally:
+            stream.close()
+
+    async def add_contact(self):
+        contact = user_email(random.randrange(self.users))
+        await self.request(self.stream, AddContactPackets(contact, contact))
+
+    async def list(self):
+        await self.request(self.stream, ListContactsPackets())
+
+    async def poll(self):
+        await self.request(self.stream, FileTransferRequestResponsePackets())
+
+    async def run(self, ops, weights, deadline, latencies, errors):
+        loop = IOLoop.current()
+        while loop.time() < deadline:
+            op = random.choices(ops, weights)[0]
+            start = time.perf_counter()
+            try:
+                await getattr(self, op)()
+                latencies[op].append(time.perf_counter() - start)
+            except Exception:
+                errors[op] += 1
+
+
+async def generate(port, indices, users, mix, ramp_up, duration, process_index):
+    ctx = make_context()
+    ops, weights = list(mix.keys()), list(mix.values())
+    latencies = {op: [] for op in ops}
+    errors = {op: 0 for op in ops}
+    clients = [LoadClient(port, ctx, i, users, process_index) for i in indices]
+    # connect and log in everyone before measuring, spread over the ramp up period
+    delay = ramp_up / len(clients) if clients else 0
+    setup_errors = 0
+    for client in clients:
+        try:
+            client.stream = await client.connect()
+            await client.login()
+        except Exception:
+            setup_errors += 1
+            client.stream = None
+        await asyncio.sleep(delay)
+    clients = [client for client in clients if client.stream is not None]
+    deadline = IOLoop.current().time() + duration
+    await asyncio.gather(*(client.run(ops, weights, deadline, latencies, errors) for client in clients))
+    for client in clients:
+        client.stream.close()
+    return latencies, errors, setup_errors, len(clients)
+
+
+def generator_process(port, indices, users, mix, ramp_up, duration, process_index, results):
+    raise_fd_limit()
+    results.put(
+        IOLoop.current().run_sync(lambda: generate(port, indices, users, mix, ramp_up, duration, process_index)))
+
+
+def parse_mix(mix):
+    ops = dict()
+    for item in mix.split(","):
+        op, weight = item.split("=")
+        if op not in ("register", "login", "add_contact", "list", "poll"):
+            raise ValueError("Unknown operation {}".format(op))
+        ops[op] = float(weight)
+    return ops
+
+
+def summarize(latencies, errors, duration):
+    ops = dict()
+    for op, values in latencies.items():
+        values.sort()
+        ops[op] = {
+            "count": len(values),
+            "errors": errors[op],
+            "throughput": len(values) / duration,
+            "p50_ms": 1000 * percentile(values, 0.5) if values else None,
+            "p99_ms": 1000 * percentile(values, 0.99) if values else None,
+            "p999_ms": 1000 * percentile(values, 0.999) if values else None,
+        }
+    return ops
+
+
+def run(args, port, mix):
+    results = Queue()
+    procs = [
+        Process(target=generator_process,
+                args=(port, range(i, args.connections,
+                                  args.processes), args.users, mix, args.ramp_up, args.duration, i, results))
+        for i in range(args.processes)
+    ]
+    for proc in procs:
+        proc.start()
+    latencies = {op: [] for op in mix}
+    errors = {op: 0 for op in mix}
+    setup_errors, connected = 0, 0
+    for _ in procs:
+        lat, err, setup_err, conn = results.get()
+        for op in mix:
+            latencies[op] += lat[op]
+            errors[op] += err[op]
+        setup_errors += setup_err
+        connected += conn
+    for proc in procs:
+        proc.join()
+    return {
+        "revision": git_revision(),
+        "time": time.time(),
+        "args": vars(args),
+        "connected": connected,
+        "setup_errors": setup_errors,
+        "total_throughput": sum(len(values) for values in latencies.values()) / args.duration,
+        "ops": summarize(latencies, errors, args.duration),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--connections", type=int, default=1000, help="concurrent connections")
+    parser.add_argument("--processes", type=int, default=1, help="load generating processes")
+    parser.add_argument("--users", type=int, default=None, help="registered users, at least one per connection")
+    parser.add_argument("--mix",
+                        default=DEFAULT_MIX,
+                        help="comma separated op=weight, ops: register, login, add_contact, list, poll")
+    parser.add_argument("--ramp-up", type=float, default=5, help="seconds over which to open connections")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to measure for")
+    parser.add_argument("--port",
+                        type=int,
+                        default=None,
+                        help="port of a running server with users from bench_utils.make_users; the working "
+                        "directory must hold its server.pem")
+    parser.add_argument("--workers", type=int, default=None, help="server worker processes, see ServerSupervisor")
+    parser.add_argument("--output", default=None, help="write the JSON results here instead of stdout")
+    args = parser.parse_args()
+    args.users = max(args.users or 0, args.connections)
+    mix = parse_mix(args.mix)
+    output = os.path.abspath(args.output) if args.output else None
+    raise_fd_limit()
+
+    if args.port is not None:
+        result = run(args, args.port, mix)
+    else:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # the server and clients find server.pem in the working directory
+            os.chdir(tmp_dir)
+            make_cert("server.pem")
+            filename = os.path.join(tmp_dir, "server.json")
+            make_users(filename, args.users)
+            port = free_port()
+            driver = ServerDriver(port, filename, args.workers)
+            server = Process(target=driver.run)
+            server.start()
+            try:
+                wait_for_port(port)
+                result = run(args, port, mix)
+            finally:
+                driver.stop()
+                server.join()
+                driver.close()
+
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(result, f, indent=2)
+    else:
+        json.dump(result, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+# Sending one file to several recipients at once: in "separate" mode every P2PClient reads, compresses and encodes the
+# file on its own, like one send_file per recipient; in "shared" mode they share a SharedChunks, like
+# SecureDropSession.send_file_to_many. Recipients are P2PServers in the same process, so the CPU time includes
+# receiving. The same-host mode is off, since it skips chunks altogether. Prints (or writes) JSON with seconds and CPU
+# seconds per mode and number of recipients.
+#
+#   PYTHONPATH=. ./benchmarks/fan_out.py --size-mb 64 --recipients 1,4,10
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+from tornado.ioloop import IOLoop
+
+from bench_utils import make_cert, git_revision
+from securedrop.p2p import P2PClient, P2PServer, SharedChunks
+from securedrop.utils import sha256_file
+
+MODES = ("separate", "shared")
+TOKEN = b"t" * 32
+
+
+async def fan_out(path, sha256, tmp_dir, mode, recipients):
+    servers = []
+    for _ in range(recipients):
+        out_dir = tempfile.mkdtemp(dir=tmp_dir)
+        servers.append(P2PServer(TOKEN, out_dir))
+    shared = SharedChunks(path) if mode == "shared" else None
+    start, cpu_start = time.perf_counter(), time.process_time()
+    try:
+        clients = [
+            P2PClient(server.start(0),
+                      TOKEN,
+                      path,
+                      os.path.getsize(path),
+                      sha256,
+                      shared_chunks=shared,
+                      same_host=False) for server in servers
+        ]
+        await asyncio.gather(*(client.main() for client in clients))
+        for server in servers:
+            msg = await server.wait()
+            if msg:
+                raise RuntimeError(msg)
+    finally:
+        for server in servers:
+            server.close()
+    seconds, cpu_seconds = time.perf_counter() - start, time.process_time() - cpu_start
+    for server in servers:
+        os.remove(server.out_path)
+    return {
+        "mode": mode,
+        "recipients": recipients,
+        "seconds": seconds,
+        "cpu_seconds": cpu_seconds,
+        "detached": shared.detached if shared is not None else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=int, default=64, help="size of the file sent")
+    parser.add_argument("--recipients", default="1,4,10", help="comma separated numbers of recipients")
+    parser.add_argument("--modes", default=",".join(MODES), help="comma separated: separate, shared")
+    parser.add_argument("--output", default=None, help="write the JSON results here instead of stdout")
+    args = parser.parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # the P2P servers and clients find server.pem in the working directory
+        os.chdir(tmp_dir)
+        make_cert("server.pem")
+        path = os.path.join(tmp_dir, "file.bin")
+        with open(path, "wb") as f:
+            # half random, half compressible
+            for _ in range(args.size_mb):
+                f.write(os.urandom(512 * 1024) + b"a" * 512 * 1024)
+        sha256 = sha256_file(path, [])
+        for recipients in args.recipients.split(","):
+            for mode in args.modes.split(","):
+                if mode not in MODES:
+                    raise ValueError("Unknown mode {}".format(mode))
+                result = IOLoop.current().run_sync(lambda: fan_out(path, sha256, tmp_dir, mode, int(recipients)))
+                print(json.dumps(result), file=sys.stderr)
+                results.append(result)
+
+    result = {"revision": git_revision(), "time": time.time(), "args": vars(args), "results": results}
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(result, f, indent=2)
+    else:
+        json.dump(result, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+
+# Throughput of P2P file transfers over loopback, driving P2PClient and P2PServer directly. Sweeps file size, chunk
+# size, how compressible the file is, compression, TLS, the same-host mode (the receiver copies the file through a
+# passed file descriptor instead of receiving chunks) and adaptive chunk sizes (starting at the chunk size). Reports
+# MB/s, CPU seconds per GB on each side, the peak RSS of each side and the final chunk size as JSON. The sender and
+# receiver are fresh processes for every transfer, so that their CPU time and peak RSS belong to that transfer alone.
+#
+#   PYTHONPATH=. ./benchmarks/p2p_throughput.py --sizes 16M,256M --chunk-sizes 16K,64K,256K --data random,text,zeros
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+from tornado.ioloop import IOLoop
+
+from bench_utils import make_cert, git_revision
+from securedrop.file_transfer_packets import FILE_TRANSFER_P2P_MAX_CHUNK_SIZE
+from securedrop.p2p import P2PClient, P2PServer
+from securedrop.progress import Progress
+from securedrop.utils import sha256_file
+
+TOKEN = b"t" * 32
+UNITS = {"K": 1024, "M": 1024**2, "G": 1024**3}
+WORDS = ("secure drop file transfer chunk window credit token server client packet stream socket buffer hash "
+         "compress encode decode latency throughput the a of to and in is it for on").split()
+
+
+def parse_size(size):
+    if size[-1].upper() in UNITS:
+        return int(float(size[:-1]) * UNITS[size[-1].upper()])
+    return int(size)
+
+
+def make_file(path, size, data):
+    block = 1024 * 1024
+    rand = random.Random(0)
+    text = " ".join(rand.choice(WORDS) for _ in range(block // 4)).encode()[:block]
+    with open(path, "wb") as f:
+        written = 0
+        while written < size:
+            n = min(block, size - written)
+            if data == "random":
+                f.write(os.urandom(n))
+            elif data == "zeros":
+                f.write(bytes(n))
+            else:
+                f.write(text[:n])
+            written += n
+
+
+def usage():
+    ru = resource.getrusage(resource.RUSAGE_SELF)
+    # ru_maxrss is in KiB on Linux
+    return ru.ru_utime + ru.ru_stime, ru.ru_maxrss * 1024
+
+
+def receiver(out_dir, max_chunk_size, tls, same_host, ports, results):
+    sys.stdout = open(os.devnull, "w")
+    cpu = usage()[0]
+
+    async def receive():
+        server = P2PServer(TOKEN, out_dir, Progress(), max_chunk_size=max_chunk_size, tls=tls, same_host=same_host)
+        ports.put(server.start(0))
+        try:
+            return await server.wait()
+        finally:
+            server.close()
+
+    msg = IOLoop.current().run_sync(receive)
+    cpu_end, peak_rss = usage()
+    results.put(("receiver", msg, cpu_end - cpu, peak_rss))
+
+
+def sender(path, sha256, chunk_size, compress, tls, same_host, adaptive, port, results):
+    sys.stdout = open(os.devnull, "w")
+    cpu = usage()[0]
+    client = P2PClient(port,
+                       TOKEN,
+                       path,
+                       os.path.getsize(path),
+                       sha256,
+                       Progress(),
+                       chunk_size=chunk_size,
+                       compress=compress,
+                       tls=tls,
+                       same_host=same_host,
+                       adaptive=adaptive)
+    start = time.perf_counter()
+    try:
+        client.run()
+        msg = ""
+    except Exception as e:
+        msg = str(e)
+    seconds = time.perf_counter() - start
+    cpu_end, peak_rss = usage()
+    final_chunk_size = client.tuner.size if client.tuner is not None else chunk_size
+    results.put(("sender", msg, cpu_end - cpu, peak_rss, seconds, final_chunk_size))
+
+
+def transfer(ctx, path, sha256, out_dir, chunk_size, compress, tls, same_host, adaptive):
+    ports, results = ctx.Queue(), ctx.Queue()
+    max_chunk_size = max(FILE_TRANSFER_P2P_MAX_CHUNK_SIZE, chunk_size) if adaptive else chunk_size
+    recv = ctx.Process(target=receiver, args=(out_dir, max_chunk_size, tls, same_host, ports, results))
+    recv.start()
+    send = ctx.Process(target=sender,
+                       args=(path, sha256, chunk_size, compress, tls, same_host, adaptive, ports.get(), results))
+    send.start()
+    reports = {report[0]: report for report in (results.get(), results.get())}
+    send.join()
+    recv.join()
+    out_path = os.path.join(out_dir, os.path.basename(path))
+    if os.path.exists(out_path):
+        os.remove(out_path)
+
+    size = os.path.getsize(path)
+    _, send_msg, send_cpu, send_rss, seconds, final_chunk_size = reports["sender"]
+    _, recv_msg, recv_cpu, recv_rss = reports["receiver"]
+    return {
+        "error": send_msg or recv_msg or None,
+        "seconds": seconds,
+        "mb_per_s": size / seconds / 1e6,
+        "sender_cpu_s_per_gb": send_cpu / size * 1e9,
+        "receiver_cpu_s_per_gb": recv_cpu / size * 1e9,
+        "sender_peak_rss": send_rss,
+        "receiver_peak_rss": recv_rss,
+        "final_chunk_size": final_chunk_size,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="16M", help="comma separated file sizes, with K/M/G suffixes")
+    parser.add_argument("--chunk-sizes", default="64K", help="comma separated chunk sizes, with K/M/G suffixes")
+    parser.add_argument("--data", default="random,text,zeros", help="comma separated contents: random, text, zeros")
+    parser.add_argument("--compression", default="on,off", help="comma separated: on, off")
+    parser.add_argument("--tls", default="on,off", help="comma separated: on, off")
+    parser.add_argument("--same-host", default="off,on", help="comma separated: on, off")
+    parser.add_argument("--adaptive", default="off,on", help="comma separated: on, off")
+    parser.add_argument("--repeat", type=int, default=1, help="transfers per combination")
+    parser.add_argument("--dir", default=None, help="directory for the files, a temporary one by default")
+    parser.add_argument("--output", default=None, help="write the JSON results here instead of stdout")
+    args = parser.parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+
+    # spawn instead of fork, so that the peak RSS of a side doesn't start at the size of this process
+    ctx = multiprocessing.get_context("spawn")
+    results = []
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp_dir:
+        # P2PServer and P2PClient find server.pem in the working directory
+        os.chdir(tmp_dir)
+        make_cert("server.pem")
+        out_dir = os.path.join(tmp_dir, "out")
+        os.mkdir(out_dir)
+        for size, data in itertools.product(args.sizes.split(","), args.data.split(",")):
+            path = os.path.join(tmp_dir, "{}.{}".format(size, data))
+            make_file(path, parse_size(size), data)
+            sha256 = sha256_file(path, [])
+            for chunk_size, compression, tls, same_host, adaptive in itertools.product(
+                    args.chunk_sizes.split(","), args.compression.split(","), args.tls.split(","),
+                    args.same_host.split(","), args.adaptive.split(",")):
+                for _ in range(args.repeat):
+                    result = {
+                        "size": parse_size(size),
+                        "data": data,
+                        "chunk_size": parse_size(chunk_size),
+                        "compression": compression == "on",
+                        "tls": tls == "on",
+                        "same_host": same_host == "on",
+                        "adaptive": adaptive == "on",
+                    }
+                    result.update(
+                        transfer(ctx, path, sha256, out_dir, parse_size(chunk_size), compression == "on", tls == "on",
+                                 same_host == "on", adaptive == "on"))
+                    print(json.dumps(result), file=sys.stderr)
+                    results.append(result)
+            os.remove(path)
+
+    report = {"revision": git_revision(), "time": time.time(), "args": vars(args), "results": results}
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+# Throughput of one control connection with several tagged requests in flight (see ClientBase.request), over a link
+# with a simulated round trip time: a proxy in front of the server delays everything it forwards by half the RTT in
+# each direction. Depth 1 is the lock-step protocol, where throughput is bound by the RTT. Prints (or writes) JSON with
+# requests per second and latency percentiles per RTT and depth.
+#
+#   PYTHONPATH=. ./benchmarks/pipelining.py --rtts 0,20,100 --depths 1,8,32 --requests 2000
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+from multiprocessing import Process
+
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+from tornado.tcpclient import TCPClient
+from tornado.tcpserver import TCPServer
+
+from bench_utils import PASSWORD, make_cert, make_users, user_email, free_port, wait_for_port, percentile, \
+    git_revision
+from securedrop.List_Contacts_Packets import ListContactsPackets
+from securedrop.client_server_base import ClientBase
+from securedrop.file_transfer_packets import FileTransferRequestResponsePackets
+from securedrop.login_packets import LoginPackets
+from securedrop.server import ServerDriver
+from securedrop.status_packets import StatusPackets
+
+OPS = {"list": ListContactsPackets, "poll": FileTransferRequestResponsePackets}
+
+
+class DelayProxy(TCPServer):
+    # forwards connections to port, delaying the bytes in each direction by delay seconds
+    def __init__(self, port, delay):
+        super().__init__()
+        self.port, self.delay = port, delay
+
+    async def handle_stream(self, stream, address):
+        upstream = await TCPClient().connect("localhost", self.port)
+        # Nagle's algorithm would hold back small writes until the previous ones are acked
+        stream.set_nodelay(True)
+        upstream.set_nodelay(True)
+        await asyncio.gather(self.forward(stream, upstream), self.forward(upstream, stream))
+
+    async def forward(self, source, destination):
+        loop = IOLoop.current()
+        try:
+            while True:
+                data = await source.read_bytes(64 * 1024, partial=True)
+                # call_later keeps the order of callbacks with the same delay
+                loop.call_later(self.delay, self.send, destination, data)
+        except StreamClosedError:
+            loop.call_later(self.delay, destination.close)
+
+    @staticmethod
+    def send(stream, data):
+        if not stream.closed():
+            stream.write(data).add_done_callback(lambda f: f.exception())
+
+
+async def measure(port, rtt, depth, count, op):
+    proxy_port = free_port()
+    proxy = DelayProxy(port, rtt / 2000)
+    proxy.listen(proxy_port, "127.0.0.1")
+    client = ClientBase("localhost", proxy_port)
+    await client.main()
+    try:
+        reply = await client.request(bytes(LoginPackets(user_email(0), PASSWORD)))
+        if StatusPackets(data=reply[4:]).message:
+            raise RuntimeError("Login failed")
+        latencies = []
+        remaining = iter(range(count))
+
+        async def worker():
+            for _ in remaining:
+                start = time.perf_counter()
+                await client.request(bytes(OPS[op]()))
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(depth)))
+        seconds = time.perf_counter() - start
+    finally:
+        client.stream.close()
+        proxy.stop()
+    latencies.sort()
+    return {
+        "rtt_ms": rtt,
+        "depth": depth,
+        "op": op,
+        "requests": count,
+        "throughput": count / seconds,
+        "p50_ms": 1000 * percentile(latencies, 0.5),
+        "p99_ms": 1000 * percentile(latencies, 0.99),
+    }
+
+
+def run(args, port):
+    results = []
+    for rtt, depth in itertools.product(args.rtts.split(","), args.depths.split(",")):
+        result = IOLoop.current().run_sync(lambda: measure(port, float(rtt), int(depth), args.requests, args.op))
+        print(json.dumps(result), file=sys.stderr)
+        results.append(result)
+    return {"revision": git_revision(), "time": time.time(), "args": vars(args), "results": results}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rtts", default="0,20,100", help="comma separated simulated round trip times in ms")
+    parser.add_argument("--depths", default="1,8,32", help="comma separated numbers of requests in flight")
+    parser.add_argument("--requests", type=int, default=1000, help="requests per combination")
+    parser.add_argument("--op", default="list", choices=sorted(OPS), help="request to send")
+    parser.add_argument("--port",
+                        type=int,
+                        default=None,
+                        help="port of a running server with users from bench_utils.make_users; the working "
+                        "directory must hold its server.pem")
+    parser.add_argument("--output", default=None, help="write the JSON results here instead of stdout")
+    args = parser.parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+
+    if args.port is not None:
+        result = run(args, args.port)
+    else:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # the server and clients find server.pem in the working directory
+            os.chdir(tmp_dir)
+            make_cert("server.pem")
+            filename = os.path.join(tmp_dir, "server.json")
+            make_users(filename, 1)
+            port = free_port()
+            driver = ServerDriver(port, filename)
+            server = Process(target=driver.run)
+            server.start()
+            try:
+                wait_for_port(port)
+                result = run(args, port)
+            finally:
+                driver.stop()
+                server.join()
+                driver.close()
+
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(result, f, indent=2)
+    else:
+        json.dump(result, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
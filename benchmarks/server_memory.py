@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+# Memory a server process holds per registered user, as loaded from the users file, and per online session, i.e. a
+# connection whose user logged in: its Session, the decrypted name and contacts and the session directory's entry.
+# Users are loaded straight into a Server that doesn't listen, and sessions are added without connections, so that
+# nothing but what the server keeps is measured (with tracemalloc). Each online user has --contacts contacts among
+# the other online users. Prints (or writes) JSON with the bytes per user and per session.
+#
+#   PYTHONPATH=. ./benchmarks/server_memory.py --users 1000000 --sessions 100000
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from tornado.ioloop import IOLoop
+
+from bench_utils import PASSWORD, make_cert, user_email, git_revision
+from securedrop.server import Authentication, ClientData, Server, Session, hash_email
+
+
+def users_file(count, sessions, contacts):
+    # What the users file holds for count users, whose first sessions users will log in. Those are encrypted with
+    # their email; the others share ciphertexts of the same size, which the server never decrypts.
+    auth = Authentication(PASSWORD).make_dict()
+    jdict, template = dict(), None
+    for i in range(count):
+        if i < sessions or template is None:
+            others = sessions if i < sessions else count
+            user_contacts = {
+                user_email((i + k) % others): "user{}".format((i + k) % others)
+                for k in range(1, contacts + 1)
+            }
+            entry = ClientData("user{}".format(i), user_email(i), user_contacts,
+                               auth=Authentication(jdict=auth)).make_dict()
+            if i >= sessions:
+                template = entry
+        else:
+            entry = dict(template, email=hash_email(user_email(i)).hex())
+        jdict[entry["email"]] = entry
+    return jdict
+
+
+async def add_sessions(server, count):
+    # what logging in does, without deriving the password key
+    for i in range(count):
+        email, stream = user_email(i), object()
+        server.sessions[stream] = Session(stream, ("127.0.0.1", 50000 + i % 10000))
+        user = server.users.users[hash_email(email)]
+        user.email = sys.intern(email)
+        user.decrypt_name_contacts()
+        await server.add_online(email, stream)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=1000000, help="registered users")
+    parser.add_argument("--sessions", type=int, default=100000, help="users that log in")
+    parser.add_argument("--contacts", type=int, default=10, help="contacts of each user that logs in")
+    parser.add_argument("--output", default=None, help="write the JSON results here instead of stdout")
+    args = parser.parse_args()
+    sessions = min(args.sessions, args.users)
+    output = os.path.abspath(args.output) if args.output else None
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # the server finds server.pem in the working directory
+        os.chdir(tmp_dir)
+        make_cert("server.pem")
+        filename = os.path.join(tmp_dir, "server.json")
+        with open(filename, "w") as f:
+            json.dump(users_file(args.users, sessions, args.contacts), f)
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        server = Server(filename)
+        users_bytes = tracemalloc.get_traced_memory()[0]
+        load_seconds = time.perf_counter() - start
+
+        base = tracemalloc.get_traced_memory()[0]
+        IOLoop.current().run_sync(lambda: add_sessions(server, sessions))
+        sessions_bytes = tracemalloc.get_traced_memory()[0] - base
+        tracemalloc.stop()
+
+    result = {
+        "revision": git_revision(),
+        "time": time.time(),
+        "args": vars(args),
+        "users": args.users,
+        "sessions": sessions,
+        "bytes_per_user": users_bytes / args.users,
+        "bytes_per_session": sessions_bytes / sessions if sessions else None,
+        "load_seconds": load_seconds,
+    }
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(result, f, indent=2)
+    else:
+        json.dump(result, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+# Measures how login throughput of the server scales with the number of worker processes (see ServerSupervisor).
+# Every login is a new TLS connection plus a password check, which is what a single worker is bound by.
+#
+#   PYTHONPATH=. ./benchmarks/server_scaling.py --workers 1,2,4 --clients 8 --duration 10
+
+import argparse
+import json
+import os
+import socket
+import sys
+import tempfile
+import time
+from multiprocessing import Process, Queue
+
+from bench_utils import PASSWORD, make_cert, make_context, make_users, free_port, wait_for_port, percentile
+from securedrop.client_server_base import MESSAGE_SENTINEL
+from securedrop.login_packets import LoginPackets
+from securedrop.server import ServerDriver
+from securedrop.status_packets import StatusPackets
+
+
+def login(ctx, port, email):
+    with socket.create_connection(("localhost", port)) as raw, ctx.wrap_socket(raw) as sock:
+        sock.sendall(bytes(LoginPackets(email, PASSWORD)) + MESSAGE_SENTINEL)
+        data = b""
+        while not data.endswith(MESSAGE_SENTINEL):
+            chunk = sock.recv(4096)
+            if not chunk:
+                raise RuntimeError("Server closed the connection")
+            data += chunk
+    msg = StatusPackets(data=data[4:-len(MESSAGE_SENTINEL)]).message
+    if msg:
+        raise RuntimeError(msg)
+
+
+def client(port, emails, deadline, results):
+    ctx = make_context()
+    latencies, errors, i = [], 0, 0
+    while time.monotonic() < deadline:
+        start = time.monotonic()
+        try:
+            login(ctx, port, emails[i % len(emails)])
+            latencies.append(time.monotonic() - start)
+        except (OSError, RuntimeError):
+            errors += 1
+        i += 1
+    results.put((latencies, errors))
+
+
+def run(workers, clients, duration, filename, emails):
+    port = free_port()
+    driver = ServerDriver(port, filename, workers)
+    server = Process(target=driver.run)
+    server.start()
+    try:
+        wait_for_port(port)
+        results = Queue()
+        deadline = time.monotonic() + duration
+        procs = [Process(target=client, args=(port, emails[i::clients], deadline, results)) for i in range(clients)]
+        for proc in procs:
+            proc.start()
+        latencies, errors = [], 0
+        for _ in procs:
+            lat, err = results.get()
+            latencies += lat
+            errors += err
+        for proc in procs:
+            proc.join()
+    finally:
+        driver.stop()
+        server.join()
+        driver.close()
+
+    latencies.sort()
+    return {
+        "workers": workers,
+        "clients": clients,
+        "logins": len(latencies),
+        "errors": errors,
+        "logins_per_s": len(latencies) / duration,
+        "p50_ms": 1000 * percentile(latencies, 0.5) if latencies else None,
+        "p99_ms": 1000 * percentile(latencies, 0.99) if latencies else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", default="1,2,4", help="comma separated worker counts, 0 for a single process")
+    parser.add_argument("--clients", type=int, default=os.cpu_count(), help="concurrent client processes")
+    parser.add_argument("--users", type=int, default=64, help="registered users to log in as")
+    parser.add_argument("--duration", type=float, default=10, help="seconds per worker count")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # the server and clients find server.pem in the working directory
+        os.chdir(tmp_dir)
+        make_cert("server.pem")
+        filename = os.path.join(tmp_dir, "server.json")
+        emails = make_users(filename, args.users)
+        results = [
+            run(int(workers), args.clients, args.duration, filename, emails) for workers in args.workers.split(",")
+        ]
+    json.dump(results, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == "__main__":
+    main()
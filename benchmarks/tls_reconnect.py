@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+# Reconnect latency against the control-plane Server: every reconnect opens a TLS connection and waits for the answer
+# to a login for an unknown user, which the server answers without deriving a key. In "cold" mode the client's cached
+# TLS contexts are dropped before each reconnect, like clients did before contexts were cached, so that each one loads
+# the certificate again and does a full handshake; in "resumed" mode the client resumes its TLS session. Prints (or
+# writes) JSON with latency percentiles and the resumption rate per mode.
+#
+#   PYTHONPATH=. ./benchmarks/tls_reconnect.py --reconnects 1000 --modes cold,resumed
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from multiprocessing import Process
+
+from tornado.ioloop import IOLoop
+
+from bench_utils import PASSWORD, make_cert, make_users, free_port, wait_for_port, percentile, git_revision
+from securedrop.client_server_base import ClientBase
+from securedrop.login_packets import LoginPackets
+from securedrop.server import ServerDriver
+from securedrop.tls import clear_ssl_contexts
+
+MODES = ("cold", "resumed")
+
+
+class ReconnectClient(ClientBase):
+    async def main(self):
+        await super().main()
+        try:
+            await self.write(bytes(LoginPackets("nobody@bench.com", PASSWORD)))
+            await self.read()
+            return self.stream.socket.session_reused
+        finally:
+            self.stream.close()
+
+
+async def reconnect(port, mode, count):
+    latencies, resumed = [], 0
+    # the first connection of "resumed" has no session to resume yet
+    if mode == "resumed":
+        await ReconnectClient("localhost", port).main()
+    for _ in range(count):
+        start = time.perf_counter()
+        if mode == "cold":
+            clear_ssl_contexts()
+        resumed += await ReconnectClient("localhost", port).main()
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return {
+        "mode": mode,
+        "reconnects": count,
+        "resumption_rate": resumed / count,
+        "p50_ms": 1000 * percentile(latencies, 0.5),
+        "p99_ms": 1000 * percentile(latencies, 0.99),
+        "mean_ms": 1000 * sum(latencies) / count,
+    }
+
+
+def run(args, port):
+    results = []
+    for mode in args.modes.split(","):
+        if mode not in MODES:
+            raise ValueError("Unknown mode {}".format(mode))
+        results.append(IOLoop.current().run_sync(lambda: reconnect(port, mode, args.reconnects)))
+        print(json.dumps(results[-1]), file=sys.stderr)
+    return {"revision": git_revision(), "time": time.time(), "args": vars(args), "results": results}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--reconnects", type=int, default=500, help="reconnects per mode")
+    parser.add_argument("--modes", default=",".join(MODES), help="comma separated: cold, resumed")
+    parser.add_argument("--port",
+                        type=int,
+                        default=None,
+                        help="port of a running server; the working directory must hold its server.pem")
+    parser.add_argument("--output", default=None, help="write the JSON results here instead of stdout")
+    args = parser.parse_args()
+    output = os.path.abspath(args.output) if args.output else None
+
+    if args.port is not None:
+        result = run(args, args.port)
+    else:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # the server and clients find server.pem in the working directory
+            os.chdir(tmp_dir)
+            make_cert("server.pem")
+            filename = os.path.join(tmp_dir, "server.json")
+            make_users(filename, 0)
+            port = free_port()
+            driver = ServerDriver(port, filename)
+            server = Process(target=driver.run)
+            server.start()
+            try:
+                wait_for_port(port)
+                result = run(args, port)
+            finally:
+                driver.stop()
+                server.join()
+                driver.close()
+
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(result, f, indent=2)
+    else:
+        json.dump(result, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
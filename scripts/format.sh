@@ -6,12 +6,12 @@ set -eo pipefail
 if [ "$#" -eq 0 ]
 then
   # format source files
-  yapf -i -r securedrop bin 2>/dev/null
+  yapf -i -r securedrop bin benchmarks 2>/dev/null
 
 # check if source code is formatted.
 elif [ "$1" == "check" ]
 then
 
-  yapf -d -r securedrop bin
+  yapf -d -r securedrop bin benchmarks
 
 fi
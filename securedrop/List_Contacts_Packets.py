@@ -4,8 +4,19 @@ LIST_CONTACTS_PACKETS_NAME = b"LCPN"
 
 
 class ListContactsPackets:
-    def __init__(self, data=None):
+    def __init__(self, epoch: str = None, version: int = None, data=None):
+        # A client that kept the list of an earlier response asks for the changes since its epoch and version, see
+        # ListContactsResponsePackets; without them, the server sends the whole list.
+        self.epoch, self.version = epoch, version
         self.jdict = dict()
+        if data is not None:
+            self.jdict = json.loads(data) if data else dict()
+            self.epoch, self.version = self.jdict.get("epoch"), self.jdict.get("version")
+        elif epoch is not None and version is not None:
+            self.jdict = {
+                "epoch": self.epoch,
+                "version": self.version,
+            }
 
     def __bytes__(self):
         return LIST_CONTACTS_PACKETS_NAME + bytes(json.dumps(self.jdict), encoding='ascii')
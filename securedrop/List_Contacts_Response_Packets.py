@@ -4,16 +4,43 @@ LIST_CONTACTS_RESPONSE_PACKETS_NAME = b"LCRN"
 
 
 class ListContactsResponsePackets:
-    def __init__(self, contacts=None, data=None):
-        self.contacts = contacts
+    def __init__(self,
+                 contacts=None,
+                 epoch: str = None,
+                 version: int = None,
+                 added: dict = None,
+                 removed: list = None,
+                 data=None):
+        # The list is at version of epoch, which the client passes back in its next ListContactsPackets. Either
+        # contacts holds the whole list, or, when the client asked for changes, added and removed hold what changed
+        # since its version; neither means the list didn't change. Servers that predate versions only send contacts.
+        self.contacts, self.epoch, self.version, self.added, self.removed = contacts, epoch, version, added, removed
         self.jdict = dict()
         if data is not None:
             self.jdict = json.loads(data)
-            self.contacts = self.jdict["contacts"]
-        elif contacts is not None:
-            self.jdict = {
-                "contacts": self.contacts,
-            }
+            self.contacts = self.jdict.get("contacts")
+            self.epoch, self.version = self.jdict.get("epoch"), self.jdict.get("version")
+            self.added, self.removed = self.jdict.get("added"), self.jdict.get("removed")
+        else:
+            if contacts is not None:
+                self.jdict["contacts"] = self.contacts
+            if epoch is not None and version is not None:
+                self.jdict["epoch"], self.jdict["version"] = self.epoch, self.version
+            if added or removed:
+                self.jdict["added"], self.jdict["removed"] = self.added or dict(), self.removed or []
+
+    def not_modified(self):
+        return self.contacts is None and self.added is None and self.removed is None
+
+    def apply(self, contacts):
+        # the list after this response, given the client's list at the version it asked for changes since
+        if self.contacts is not None:
+            return dict(self.contacts)
+        contacts = dict(contacts)
+        for email in self.removed or []:
+            contacts.pop(email, None)
+        contacts.update(self.added or dict())
+        return contacts
 
     def __bytes__(self):
         return LIST_CONTACTS_RESPONSE_PACKETS_NAME + bytes(json.dumps(self.jdict), encoding='ascii')
@@ -1,5 +1,9 @@
-__all__ = ['ClientBase', 'ServerBase', 'Client', 'Server', 'ServerDriver']
+__all__ = [
+    'ClientBase', 'ServerBase', 'ShutdownController', 'MemoryBudget', 'SecureDropSession', 'Client', 'Server',
+    'ServerDriver'
+]
 
-from securedrop.client_server_base import ClientBase, ServerBase
+from securedrop.client_server_base import ClientBase, ServerBase, ShutdownController, MemoryBudget
+from securedrop.session import SecureDropSession
 from securedrop.client import Client
 from securedrop.server import Server, ServerDriver
@@ -18,3 +18,27 @@ class AddContactPackets:
 
     def __bytes__(self):
         return ADD_CONTACT_PACKETS_NAME + bytes(json.dumps(self.jdict), encoding='ascii')
+
+
+ADD_CONTACTS_PACKETS_NAME = b"ADCS"
+
+
+class AddContactsPackets:
+    # many contacts at once, answered with a BatchStatusPackets holding a message per contact
+    def __init__(self, contacts: list = None, data=None):
+        # contacts is a list of (name, email) pairs
+        self.contacts = contacts
+        self.jdict = dict()
+        if data is not None:
+            self.jdict = json.loads(data)
+            self.contacts = [(contact["name"], contact["email"]) for contact in self.jdict["contacts"]]
+        elif contacts is not None:
+            self.jdict = {
+                "contacts": [{
+                    "name": name,
+                    "email": email
+                } for name, email in self.contacts],
+            }
+
+    def __bytes__(self):
+        return ADD_CONTACTS_PACKETS_NAME + bytes(json.dumps(self.jdict), encoding='ascii')
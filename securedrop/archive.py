@@ -0,0 +1,220 @@
+import json
+import os
+import shutil
+import struct
+from logging import getLogger
+
+from Crypto.Hash import SHA256
+
+# The stream P2PClient sends for a directory: for each entry, a header (its length, then JSON with the path relative
+# to the directory, the type, the mode and the size), then for files the content and the SHA256 digest of the content.
+# Entries are sent in the order of a sorted walk, so every directory comes before what is in it. Small files end up
+# packed together in the same chunks, and the receiver writes each entry in place as it arrives.
+
+HEADER_LENGTH = struct.Struct(">I")
+DIGEST_SIZE = 32
+FILE, DIRECTORY = "file", "directory"
+
+# bytes read from a file at once
+ARCHIVE_READ_SIZE = 256 * 1024
+
+# largest header accepted, which is far more than a path needs
+MAX_HEADER_SIZE = 64 * 1024
+
+log = getLogger()
+
+
+def encode_header(entry):
+    header = json.dumps(entry, separators=(",", ":")).encode("ascii")
+    return HEADER_LENGTH.pack(len(header)) + header
+
+
+def scan(root):
+    # the entries of the directory root; symbolic links and special files are left out
+    entries = []
+    for directory, dirnames, filenames in os.walk(root):
+        # sorted in place, which os.walk descends in; a directory is listed before what is in it
+        dirnames.sort()
+        relative = os.path.relpath(directory, root)
+        for name in dirnames + sorted(filenames):
+            path = os.path.join(directory, name)
+            st = os.lstat(path)
+            if os.path.islink(path) or not (os.path.isdir(path) or os.path.isfile(path)):
+                log.info("Skipping {}: not a regular file or directory".format(path))
+                continue
+            entries.append({
+                "path": name if relative == "." else "/".join(relative.split(os.sep) + [name]),
+                "type": DIRECTORY if os.path.isdir(path) else FILE,
+                "mode": st.st_mode & 0o777,
+                "size": st.st_size if os.path.isfile(path) else 0,
+            })
+    return entries
+
+
+def archive_info(root, entries=None):
+    # size and SHA256 of the whole stream, contents included, which ArchiveWriter.close() returns as well
+    entries = entries if entries is not None else scan(root)
+    size, hasher = 0, SHA256.new()
+    with ArchiveReader(root, entries) as reader:
+        while data := reader.read(ARCHIVE_READ_SIZE):
+            hasher.update(data)
+            size += len(data)
+    return {"size": size, "SHA256": hasher.hexdigest(), "files": len(entries)}
+
+
+class ArchiveReader:
+    # File-like reader of the stream of the directory root, for file_chunks()
+
+    def __init__(self, root, entries=None):
+        self.root = root
+        self.entries = entries if entries is not None else scan(root)
+        self.parts = self.generate()
+        self.current = memoryview(b"")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def generate(self):
+        for entry in self.entries:
+            yield encode_header(entry)
+            if entry["type"] != FILE:
+                continue
+            hasher, remaining = SHA256.new(), entry["size"]
+            with open(os.path.join(self.root, *entry["path"].split("/")), "rb") as file:
+                while remaining and (data := file.read(min(remaining, ARCHIVE_READ_SIZE))):
+                    hasher.update(data)
+                    remaining -= len(data)
+                    yield data
+            if remaining:
+                raise RuntimeError("{} changed while being sent".format(entry["path"]))
+            yield hasher.digest()
+
+    def read(self, size):
+        # size bytes, fewer only at the end of the stream
+        parts = []
+        while size > 0:
+            if not self.current:
+                part = next(self.parts, None)
+                if part is None:
+                    break
+                self.current = memoryview(part)
+            parts.append(self.current[:size])
+            size -= len(parts[-1])
+            self.current = self.current[len(parts[-1]):]
+        return b"".join(parts)
+
+    def close(self):
+        self.parts.close()
+
+
+class ArchiveWriter:
+    # Writes the entries of a stream into the new directory root as the stream arrives, see write(); raises
+    # RuntimeError for streams that are malformed, have entries outside of root or content that doesn't match its
+    # digest.
+
+    def __init__(self, root):
+        self.root = root
+        os.mkdir(root)
+        self.hasher = SHA256.new()
+        self.pending = bytearray()
+        # bytes the current field needs: a header length, a header or a digest
+        self.field, self.wanted = "length", HEADER_LENGTH.size
+        self.entry, self.file, self.content_hasher, self.remaining = None, None, None, 0
+        self.directory_modes = []
+        self.entries = 0
+
+    def path(self, relative):
+        parts = relative.split("/")
+        if not relative or any(part in ("", ".", "..") or os.sep in part for part in parts):
+            raise RuntimeError("Invalid path in archive: {}".format(relative))
+        return os.path.join(self.root, *parts)
+
+    def write(self, data):
+        self.hasher.update(data)
+        view, pos = memoryview(data), 0
+        while pos < len(view):
+            if self.remaining:
+                part = view[pos:pos + self.remaining]
+                self.file.write(part)
+                self.content_hasher.update(part)
+                self.remaining -= len(part)
+                pos += len(part)
+                if not self.remaining:
+                    self.field, self.wanted = "digest", DIGEST_SIZE
+                continue
+            part = view[pos:pos + self.wanted - len(self.pending)]
+            self.pending += part
+            pos += len(part)
+            if len(self.pending) == self.wanted:
+                field = bytes(self.pending)
+                self.pending.clear()
+                self.on_field(field)
+
+    def on_field(self, field):
+        if self.field == "length":
+            length, = HEADER_LENGTH.unpack(field)
+            if not 0 < length <= MAX_HEADER_SIZE:
+                raise RuntimeError("Invalid header in archive")
+            self.field, self.wanted = "header", length
+        elif self.field == "header":
+            try:
+                entry = json.loads(field)
+                entry["path"], entry["type"], entry["mode"], entry["size"] = \
+                    str(entry["path"]), entry["type"], int(entry["mode"]), int(entry["size"])
+            except (ValueError, KeyError, TypeError):
+                raise RuntimeError("Invalid header in archive")
+            self.start_entry(entry)
+        else:
+            self.file.close()
+            self.file = None
+            if field != self.content_hasher.digest():
+                raise RuntimeError("File hashes don't match for {}".format(self.entry["path"]))
+            os.chmod(self.path(self.entry["path"]), self.entry["mode"] & 0o777)
+            self.field, self.wanted = "length", HEADER_LENGTH.size
+
+    def start_entry(self, entry):
+        self.entry = entry
+        self.entries += 1
+        path = self.path(entry["path"])
+        self.field, self.wanted = "length", HEADER_LENGTH.size
+        if entry["type"] == DIRECTORY:
+            os.mkdir(path)
+            # applied last, in case the mode doesn't let us write the directory's contents
+            self.directory_modes.append((path, entry["mode"] & 0o777))
+        elif entry["type"] == FILE:
+            if entry["size"] < 0:
+                raise RuntimeError("Invalid header in archive")
+            self.file = open(path, "xb")
+            self.content_hasher = SHA256.new()
+            self.remaining = entry["size"]
+            if not self.remaining:
+                self.field, self.wanted = "digest", DIGEST_SIZE
+        else:
+            raise RuntimeError("Invalid entry type in archive: {}".format(entry["type"]))
+
+    def close(self):
+        # returns the SHA256 of the stream, to compare with archive_info()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.field != "length" or self.pending or self.remaining:
+            raise RuntimeError("Archive ended in the middle of an entry")
+        for path, mode in reversed(self.directory_modes):
+            os.chmod(path, mode)
+        return self.hasher.hexdigest()
+
+    def abort(self):
+        # removes root and what was written into it, for a stream that failed
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        for path, _ in self.directory_modes:
+            # close() may have applied modes that don't let us delete what is in them
+            try:
+                os.chmod(path, 0o700)
+            except OSError:
+                pass
+        shutil.rmtree(self.root, ignore_errors=True)
@@ -1,28 +1,18 @@
 #!/usr/bin/env python3
+import asyncio
 import getpass
 import json
 import os
-import select
-import sys
+import threading
 import time
-from multiprocessing import Process, shared_memory, Lock
-from threading import Thread
-
-import nest_asyncio
-
-from securedrop import utils
-from securedrop.List_Contacts_Packets import ListContactsPackets
-from securedrop.List_Contacts_Response_Packets import ListContactsResponsePackets
-from securedrop.add_contact_packets import AddContactPackets
-from securedrop.client_server_base import ClientBase
-from securedrop.file_transfer_packets import FileTransferRequestPackets, FileTransferRequestResponsePackets, \
-    FileTransferCheckRequestsPackets, FileTransferAcceptRequestPackets, FileTransferSendTokenPackets, \
-    FileTransferSendPortPackets, FileTransferSendPortTokenPackets, FILE_TRANSFER_P2P_CHUNK_SIZE
-from securedrop.login_packets import LoginPackets
-from securedrop.p2p import P2PClient, P2PServer
-from securedrop.register_packets import RegisterPackets
-from securedrop.status_packets import StatusPackets
-from securedrop.utils import sha256_file, sizeof_fmt
+
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from tornado.locks import Lock
+
+from securedrop.progress import Progress, TerminalSink
+from securedrop.session import SecureDropSession
+from securedrop.utils import sizeof_fmt
 from securedrop.utils import validate_and_normalize_email
 
 DEFALT_SERVER_CERT_PATH = 'server.pem'
@@ -33,6 +23,82 @@ DEFAULT_PORT = 6969
 DEBUG_DEFAULT = False
 DEBUG = False
 
+# seconds between two checks for incoming file transfer requests
+FILE_TRANSFER_POLL_INTERVAL = 1
+
+
+def run_in_thread(func, *args):
+    # like IOLoop.run_in_executor, but on a daemon thread, which doesn't keep the process alive when it exits while
+    # the thread still waits for the user
+    loop, future = IOLoop.current(), Future()
+
+    def resolve(result, error):
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def run():
+        try:
+            loop.add_callback(resolve, func(*args), None)
+        except BaseException as e:
+            loop.add_callback(resolve, None, e)
+
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+
+class Console:
+    # Reads the terminal for coroutines, so that the IOLoop keeps serving the connection while waiting for the user.
+    # Lines are read on a thread, one at a time and only while someone waits for one. When several coroutines wait,
+    # the one that asked last gets the next line, e.g. a question about an incoming file transfer interrupting the
+    # shell prompt, and the prompt of the one below is shown again after.
+
+    def __init__(self):
+        self.waiters = []
+        self.reading = None
+
+    async def input(self, prompt=""):
+        print(prompt, end="", flush=True)
+        waiter = Future()
+        waiter.prompt = prompt
+        self.waiters.append(waiter)
+        self.read_line()
+        try:
+            return await waiter
+        finally:
+            was_top = self.waiters[-1] is waiter
+            self.waiters.remove(waiter)
+            if was_top and self.waiters:
+                print(self.waiters[-1].prompt, end="", flush=True)
+
+    async def getpass(self, prompt):
+        if self.reading is not None:
+            # a line is being read already, so getpass would compete for it
+            return await self.input(prompt)
+        return await run_in_thread(getpass.getpass, prompt)
+
+    def read_line(self):
+        if self.reading is None:
+            self.reading = run_in_thread(input)
+            self.reading.add_done_callback(self.on_line)
+
+    def on_line(self, reading):
+        self.reading = None
+        waiters = [waiter for waiter in self.waiters if not waiter.done()]
+        if not waiters:
+            return
+        if reading.exception() is not None:
+            # e.g. EOFError, which every waiter gets
+            for waiter in waiters:
+                waiter.set_exception(reading.exception())
+            return
+        waiters[-1].set_result(reading.result())
+        if len(waiters) > 1:
+            self.read_line()
+
 
 class RegisteredUsers:
     def __init__(self, filename):
@@ -49,17 +115,17 @@ class RegisteredUsers:
         with open(self.filename, 'w') as f:
             json.dump(self.make_json(), f)
 
-    def register_prompt(self):
-        name = input("Enter Full Name: ")
-        email = input("Enter Email Address: ")
+    async def register_prompt(self, console):
+        name = await console.input("Enter Full Name: ")
+        email = await console.input("Enter Email Address: ")
         valid_email = validate_and_normalize_email(email)
         if valid_email is None:
             raise RuntimeError("Invalid Email Address.")
         if valid_email in self.users:
             raise RuntimeError("That email already exists!")
 
-        pw1 = getpass.getpass(prompt="Enter Password: ")
-        pw2 = getpass.getpass(prompt="Re-enter password: ")
+        pw1 = await console.getpass("Enter Password: ")
+        pw2 = await console.getpass("Re-enter password: ")
         if pw1 != pw2:
             raise RuntimeError("The two entered passwords don't match!")
 
@@ -77,18 +143,22 @@ class RegisteredUsers:
         self.write_json()
         print("User registered.")
 
-    def login_prompt(self):
-        email = input("Enter Email Address: ")
-        password = getpass.getpass(prompt="Enter Password: ")
+    async def login_prompt(self, console):
+        email = await console.input("Enter Email Address: ")
+        password = await console.getpass("Enter Password: ")
         return email, password
 
 
-class Client(ClientBase):
+class Client(SecureDropSession):
+    # The interactive shell, which asks for what SecureDropSession needs
     users: RegisteredUsers
 
     def __init__(self, host: str, prt: int, filename):
         super().__init__(host, prt)
         self.filename = filename
+        self.console = Console()
+        # held while a command or an incoming file transfer request talks to the user
+        self.interaction = Lock()
         try:
             self.users = RegisteredUsers(filename)
             self.user = None
@@ -101,10 +171,10 @@ class Client(ClientBase):
             await super().main()
 
             if not self.users.users:
-                decision = input(
+                decision = await self.console.input(
                     "No users are registered with this client.\nDo you want to register a new user (y/n)? ")
                 if str(decision) == 'y':
-                    self.user = await self.register()
+                    self.user = await self.shell_register()
                     if self.user:
                         await self.sh()
                     else:
@@ -112,7 +182,7 @@ class Client(ClientBase):
                 else:
                     raise RuntimeError("You must register a user before using securedrop")
             else:
-                self.user = await self.login()
+                self.user = await self.shell_login()
                 if self.user:
                     await self.sh()
                 else:
@@ -120,98 +190,81 @@ class Client(ClientBase):
         except KeyboardInterrupt:
             pass
         finally:
+            self.close()
             print("Exiting SecureDrop")
 
-    async def register(self):
-        msg, email = None, None
+    async def shell_register(self):
         try:
-            name, email, pw = self.users.register_prompt()
-            await self.write(bytes(RegisterPackets(name, email, pw)))
-            msg = StatusPackets(data=(await self.read())[4:]).message
-            if msg != "":
-                raise RuntimeError(msg)
+            name, email, pw = await self.users.register_prompt(self.console)
+            await self.register(name, email, pw)
             self.users.register_user(email)
         except RuntimeError as e:
-            msg = str(e)
-        if msg != "":
-            print("Failed to register: ", msg)
+            print("Failed to register: ", str(e))
             return None
         return email
 
-    async def login(self):
-        msg, email = None, None
+    async def shell_login(self):
         try:
-            email, pw = self.users.login_prompt()
-            await self.write(bytes(LoginPackets(email, pw)))
-            msg = StatusPackets(data=(await self.read())[4:]).message
-            if msg != "":
-                raise RuntimeError(msg)
+            email, pw = await self.users.login_prompt(self.console)
+            await self.login(email, pw)
         except RuntimeError as e:
-            msg = str(e)
-        if msg != "":
-            print("Failed to login: ", msg)
+            print("Failed to login: ", str(e))
             return None
         return email
 
     async def sh(self):
+        poller = asyncio.ensure_future(self.poll_file_transfer_requests())
         try:
             print("Welcome to SecureDrop")
             print("Type \"help\" For Commands")
-            prompt = True
             while True:
-                if prompt:
-                    print("secure_drop> ", end="", flush=True)
-                    prompt = False
-                if select.select([sys.stdin], [], [], 1)[0]:
-                    cmd = input().strip()
+                command = asyncio.ensure_future(self.console.input("secure_drop> "))
+                await asyncio.wait([command, poller], return_when=asyncio.FIRST_COMPLETED)
+                if not command.done():
+                    # the poller only stops when it fails
+                    command.cancel()
+                    poller.result()
+                cmd = command.result().strip()
+                async with self.interaction:
                     if cmd == "help":
                         print("\"add\"  \t-> Add a new contact")
                         print("\"list\"  \t-> List all online contacts")
                         print("\"send\"  \t-> Transfer file to contact")
                         print("\"exit\"  \t-> Exit SecureDrop")
                     elif cmd == "add":
-                        await self.add_contact()
+                        await self.shell_add_contact()
                     elif cmd == "list":
-                        await self.list_contacts()
+                        await self.shell_list_contacts()
                     elif cmd == "send":
-                        await self.send_file()
+                        await self.shell_send_file()
                     elif cmd == "exit":
                         break
                     else:
                         print("Unknown command: {}".format(cmd))
-                    prompt = True
-
-                if (await self.check_for_file_transfer_requests()) is not None:
-                    prompt = True
         except Exception or KeyboardInterrupt as e:
             print("Exiting SecureDrop")
             raise e
+        finally:
+            poller.cancel()
 
-    async def add_contact(self):
-        msg = None
+    async def poll_file_transfer_requests(self):
+        # runs alongside the shell, see sh()
+        while True:
+            await self.check_for_file_transfer_requests()
+            await asyncio.sleep(FILE_TRANSFER_POLL_INTERVAL)
+
+    async def shell_add_contact(self):
         try:
-            name = input("Enter Full Name: ")
-            email = input("Enter Email Address: ")
-            valid_email = validate_and_normalize_email(email)
-            if valid_email is None:
-                raise RuntimeError("Invalid Email Address.")
-            if not name:
-                raise RuntimeError("Empty name input.")
-
-            await self.write(bytes(AddContactPackets(name, valid_email)))
-            msg = StatusPackets(data=(await self.read())[4:]).message
-            if msg != "":
-                raise RuntimeError(msg)
+            name = await self.console.input("Enter Full Name: ")
+            email = await self.console.input("Enter Email Address: ")
+            await self.add_contact(name, email)
         except RuntimeError as e:
-            msg = str(e)
-        if msg != "":
-            print("Failed to add contact: ", msg)
+            print("Failed to add contact: ", str(e))
 
-    async def list_contacts(self):
+    async def shell_list_contacts(self):
         msg = ""
         try:
-            await self.write(bytes(ListContactsPackets()))
-            contact_dict = ListContactsResponsePackets(data=(await self.read())[4:]).contacts
+            contact_dict = await self.list_online()
             # print contacts by Email and Name
             if len(contact_dict) > 0:
                 print("Email:\t\t\t\tName:")
@@ -235,223 +288,78 @@ class Client(ClientBase):
 
     # Y
     async def check_for_file_transfer_requests(self):
-        # 2. `Y -> S`: every one second, Y asks server for any requests
-        await self.write(bytes(FileTransferRequestResponsePackets()))
-
-        # 3. `S -> X/F -> Y`: server responds with active requests
-        file_transfer_requests = FileTransferCheckRequestsPackets(data=(await self.read())[4:]).requests
-        if not file_transfer_requests:
+        transfers = await self.check_incoming()
+        if not transfers:
             return
 
-        print("Incoming file transfer request(s):")
-        index_to_email = dict()
-        index_to_file_info = dict()
-        i = 1
-        for email, file_info in file_transfer_requests.items():
-            print("\t{}. {}".format(i, email))
-            print("\t\tname: ", file_info["name"])
-            print("\t\tsize: ", sizeof_fmt(int(file_info["size"])))
-            print("\t\tSHA256: ", file_info["SHA256"])
-            index_to_email[i] = email
-            index_to_file_info[i] = file_info
-            i += 1
+        async with self.interaction:
+            return await self.shell_file_transfer_requests(transfers)
+
+    async def shell_file_transfer_requests(self, transfers):
+        print("\nIncoming file transfer request(s):")
+        for i, transfer in enumerate(transfers, 1):
+            print("\t{}. {}".format(i, transfer.sender))
+            print("\t\tname: ", transfer.name + ("/" if transfer.directory else ""))
+            print("\t\tsize: ", sizeof_fmt(transfer.size))
+            print("\t\tSHA256: ", transfer.sha256)
 
         try:
-            selection = input("\nEnter the number for which request you'd like to accept, or 0 to deny all: ")
-            accept = True
+            selection = await self.console.input(
+                "\nEnter the number for which request you'd like to accept, or 0 to deny all: ")
             selection_num = int(selection)
-            if selection_num <= 0 or selection_num >= i:
+            if selection_num <= 0 or selection_num > len(transfers):
                 raise ValueError
-
-            packets = FileTransferAcceptRequestPackets(index_to_email[selection_num])
         except ValueError or KeyboardInterrupt:
-            packets = FileTransferAcceptRequestPackets("")
-            accept = False
-
-        if accept:
-            while True:
-                out_directory = input("Enter the output directory: ")
-                file_path = os.path.join(out_directory, index_to_file_info[selection_num]["name"])
-                if not os.path.isdir(out_directory):
-                    print("The path {} is not a directory".format(os.path.abspath(out_directory)))
-                elif os.path.exists(file_path):
-                    print("The file {} already exists".format(file_path))
-                elif not os.access(out_directory, os.X_OK | os.W_OK):
-                    print("Cannot write file path {} permission denied.".format(file_path))
-                else:
-                    break
-
-        # 4. `Y -> Yes/No -> S`: Y accepts or denies transfer request
-        await self.write(bytes(packets))
-        if not accept:
+            await self.deny()
             return False
-
-        # 5. `S -> Token -> Y`: if Y accepted, server sends a unique token Y
-        token = FileTransferSendTokenPackets(data=(await self.read())[4:]).token
-
-        lock = Lock()
-        progress = shared_memory.SharedMemory(create=True, size=8)
-        server_sentinel = shared_memory.SharedMemory(create=True, size=1)
-        status_sentinel = shared_memory.SharedMemory(create=True, size=1)
-        listen_port = shared_memory.SharedMemory(create=True, size=4)
-
-        # 6. `Y -> Port -> S`: Y binds to 0 (OS chooses) and sends the port it's listening on to S
-        p2p_server = P2PServer(token, os.path.abspath(out_directory), progress.name, lock, listen_port.name,
-                               status_sentinel.name)
-        p2p_server_process = Process(target=p2p_server.run, args=(0, server_sentinel.name))
-        p2p_server_process.start()
-
-        print("Started P2P server. Waiting for listen...")
-
-        # wait for listen
-        port = 0
-        while port == 0:
-            with lock:
-                port = int.from_bytes(listen_port.buf, byteorder='little')
-
-        await self.write(bytes(FileTransferSendPortPackets(port)))
-
-        # Wait until file received
+        transfer = transfers[selection_num - 1]
+
+        while True:
+            out_directory = await self.console.input("Enter the output directory: ")
+            file_path = os.path.join(out_directory, transfer.name)
+            if not os.path.isdir(out_directory):
+                print("The path {} is not a directory".format(os.path.abspath(out_directory)))
+            elif os.path.exists(file_path):
+                print("The file {} already exists".format(file_path))
+            elif not os.access(out_directory, os.X_OK | os.W_OK):
+                print("Cannot write file path {} permission denied.".format(file_path))
+            else:
+                break
 
         time_start = time.time()
-
-        chunk_size = FILE_TRANSFER_P2P_CHUNK_SIZE
-
-        def unguarded_print_received_progress(final=False):
-            utils.print_status(
-                *utils.get_progress(int.from_bytes(progress.buf[0:4], byteorder='little'),
-                                    int.from_bytes(progress.buf[4:8], byteorder='little'), chunk_size), "received",
-                final)
-
-        def print_received_progress():
-            while True:
-                with lock:
-                    if status_sentinel.buf[0] == 1:
-                        break
-                    unguarded_print_received_progress()
-                time.sleep(0.03)
-
-        status_thread = Thread(target=print_received_progress)
-        status_thread.start()
         try:
-            p2p_server_process.join()
+            await transfer.accept(out_directory, Progress(sinks=[TerminalSink("received")]))
         except KeyboardInterrupt:
             raise RuntimeError("User requested abort")
-        finally:
-            if p2p_server_process.is_alive():
-                p2p_server_process.terminate()
-            with lock:
-                status_sentinel.buf[0] = 1
-            status_thread.join()
-            unguarded_print_received_progress(final=True)
-            progress.close()
-            progress.unlink()
-            server_sentinel.close()
-            server_sentinel.unlink()
-            status_sentinel.close()
-            status_sentinel.unlink()
-            listen_port.close()
-            listen_port.unlink()
-
-            time_end = time.time()
-
-        print("File transfer completed successfully in {} seconds.".format(time_end - time_start))
+        except RuntimeError as e:
+            print("File transfer failed: ", str(e))
+            return False
+
+        print("File transfer completed successfully in {} seconds.".format(time.time() - time_start))
         return True
 
     # X
-    async def send_file(self):
-        msg = None
+    async def shell_send_file(self):
         try:
-            # 1. `X -> Y/F -> S`: X wants to send F to Y
-
-            recipient_email = input("Enter the recipient's email address: ")
-            file_path = os.path.abspath(input("Enter the file path: "))
-            valid_email = validate_and_normalize_email(recipient_email)
-            if valid_email is None:
-                raise RuntimeError("Invalid Email Address.")
+            recipient_email = await self.console.input("Enter the recipient's email address: ")
+            file_path = await self.console.input("Enter the file or directory path: ")
             if not file_path:
                 raise RuntimeError("Empty file path.")
-            if not os.path.exists(file_path):
-                raise RuntimeError("Cannot find file: {}".format(file_path))
-            if not os.path.isfile(file_path):
-                raise RuntimeError("Not a file: {}".format(file_path))
-
-            file_base = os.path.basename(file_path)
-            file_size = os.path.getsize(file_path)
-            file_sha256 = sha256_file(file_path)
-            file_info = {
-                "name": file_base,
-                "size": file_size,
-                "SHA256": file_sha256,
-            }
-
-            # send request
-            await self.write(bytes(FileTransferRequestPackets(valid_email, file_info)))
-
-            # this only checks if the request is valid
-            # this does not check if the recipient accepted or denied the request
-            msg = StatusPackets(data=(await self.read())[4:]).message
-            if msg != "":
-                raise RuntimeError(msg)
-
-            # 7. `S -> Token/Port -> X`: S sends the same token and port to X
-
-            # denied request is indicated by empty token and port
-            port_and_token = FileTransferSendPortTokenPackets(data=(await self.read())[4:])
-            port, token = port_and_token.port, port_and_token.token
-            if token and port:
-                print("User {} accepted the file transfer Connecting to recipient on port ".format(valid_email, port))
-            else:
-                raise RuntimeError("User {} declined the file transfer request".format(valid_email))
-
-            progress = shared_memory.SharedMemory(create=True, size=8)
-            progress_lock = Lock()
-            p2p_client = P2PClient(port, token, file_path, file_size, file_sha256, progress.name, progress_lock)
 
             time_start = time.time()
-            sentinel = False
-
-            chunk_size = FILE_TRANSFER_P2P_CHUNK_SIZE
-
-            def unguarded_print_sent_progress(final=False):
-                utils.print_status(
-                    *utils.get_progress(int.from_bytes(progress.buf[0:4], byteorder='little'),
-                                        int.from_bytes(progress.buf[4:8], byteorder='little'), chunk_size), "sent",
-                    final)
-
-            def print_sent_progress():
-                while not sentinel:
-                    with progress_lock:
-                        unguarded_print_sent_progress()
-                    time.sleep(0.03)
-
-            # i was having trouble with asyncio.gather, so just run status printer in a new thread
-            status_thread = Thread(target=print_sent_progress)
-            status_thread.start()
-
             # wait until p2p transfer completes, unless keyboard interrupt
             try:
-                await p2p_client.main()
+                await self.send_file(recipient_email, file_path, Progress(sinks=[TerminalSink("sent")]),
+                                     [TerminalSink("hashed")])
             except KeyboardInterrupt:
                 raise RuntimeError("User requested abort")
-            finally:
-                sentinel = True
-                status_thread.join()
-                unguarded_print_sent_progress(final=True)
-                progress.close()
-                progress.unlink()
-                time_end = time.time()
-
-            print("\nFile transfer completed in {} seconds.".format(time_end - time_start))
 
+            print("\nFile transfer completed in {} seconds.".format(time.time() - time_start))
         except RuntimeError as e:
-            msg = str(e)
-        if msg != "":
-            print("Failed to send file: ", msg)
+            print("Failed to send file: ", str(e))
 
 
 def main(hostname=None, port=None, filename=None, debug=None):
-    nest_asyncio.apply()
     hostname = hostname if hostname is not None else DEFAULT_HOSTNAME
     port = port if port is not None else DEFAULT_PORT
     filename = filename if filename is not None else DEFAULT_FILENAME
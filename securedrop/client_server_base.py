@@ -1,21 +1,74 @@
-import ssl
+import asyncio
+import base64
+import contextlib
+import contextvars
+import json
+import os
+import re
+import signal
+import time
 import traceback
 
-from logging import getLogger
-from tornado.ioloop import IOLoop, PeriodicCallback
-from tornado.iostream import StreamClosedError
+from logging import getLogger, DEBUG
+from tornado.ioloop import IOLoop
+from tornado.iostream import IOStream, StreamClosedError, UnsatisfiableReadError
+from tornado.concurrent import Future
+from tornado.locks import Condition, Semaphore
+from tornado.queues import Queue
 from tornado.tcpclient import TCPClient
 from tornado.tcpserver import TCPServer
-from tornado.netutil import bind_sockets
-from multiprocessing import shared_memory
+from tornado.netutil import add_accept_handler, bind_sockets, bind_unix_socket
+
+from securedrop.handoff import receive_listeners, send_listeners
+from securedrop.metrics import CONNECTIONS_ACTIVE, MESSAGES_RECEIVED, BYTES_RECEIVED, MESSAGES_SENT, BYTES_SENT, \
+    HANDLER_SECONDS, HANDLER_ERRORS, TLS_HANDSHAKES, start_metrics_server
+from securedrop.profiling import HandlerProfiler
+from securedrop.timer_wheel import TimerWheel
+from securedrop.tracing import TraceBuffer, DEFAULT_TRACE_EVENTS, ACCEPT, RECEIVE, SEND, ERROR, CLOSE
+from securedrop.tls import client_ssl_context, server_ssl_context
 
 MESSAGE_SENTINEL = b"\n" * 2
 
+# matches the 4 byte prefix of a message, or a whole message that is shorter than that. A prefix ending in a newline
+# takes one more byte, so that the sentinel of the message can't be split between the prefix and the rest. The prefix
+# may follow a request tag, see tag_request(); what may still become a tag doesn't count as a prefix.
+MESSAGE_PREFIX = rb"(?:.{0,3}?\n\n|.{3}[^\n]|.{3}\n[^\n])"
+MESSAGE_PREFIX_REGEX = re.compile(rb"(?s)\A(?:#\d{1,10} %s|(?!#\d{0,10}(?: |\Z))%s)" % (MESSAGE_PREFIX, MESSAGE_PREFIX))
+
+# "#<request id> " in front of a message, which the reply to it carries as well
+REQUEST_TAG_REGEX = re.compile(rb"#(\d{1,10}) ")
+MAX_REQUEST_ID = 10**10 - 1
+
+# tagged requests a server handles concurrently per connection before it stops reading from it
+MAX_PIPELINED_REQUESTS = 32
+
+# seconds a stopping server waits for in-flight requests before dropping them
+DEFAULT_DRAIN_TIMEOUT = 10
+
+# seconds a server waits for MemoryBudget to have room for a message before dropping the connection
+DEFAULT_MEMORY_BUDGET_TIMEOUT = 5
+
+# tornado reads sockets in chunks of this size, so a stream buffers at most this much beyond the message being read
+READ_CHUNK_SIZE = 64 * 1024
+
 log = getLogger()
 
 
-async def read(stream):
-    data = await stream.read_until(MESSAGE_SENTINEL)
+async def read(stream, max_bytes=None, limits=None):
+    # max_bytes limits the size of a message (sentinel excluded). With limits, a dict of prefix to the maximum size of
+    # messages with that prefix, the prefix is read first so that nothing beyond the limit for its type is buffered.
+    # A stream sending a message that is too large is closed, and StreamClosedError raised.
+    head, tag = b"", b""
+    if limits:
+        head = await stream.read_until_regex(MESSAGE_PREFIX_REGEX, max_bytes=17)
+        if head.endswith(MESSAGE_SENTINEL):
+            return head[:-len(MESSAGE_SENTINEL)]
+        tag = REQUEST_TAG_REGEX.match(head)
+        tag = tag.group(0) if tag is not None else b""
+        max_bytes = limits.get(head[len(tag):len(tag) + 4], max_bytes)
+    if max_bytes is not None:
+        max_bytes = max(0, max_bytes + len(tag) - len(head)) + len(MESSAGE_SENTINEL)
+    data = head + await stream.read_until(MESSAGE_SENTINEL, max_bytes=max_bytes)
     if len(data) >= 2 and data[len(data) - 2:] == MESSAGE_SENTINEL:
         data = data[0:len(data) - 2]
     return data
@@ -25,13 +78,43 @@ async def write(stream, data: bytes):
     await stream.write(data + MESSAGE_SENTINEL)
 
 
+def tag_request(data, request_id):
+    return b"#%d " % request_id + data
+
+
+def split_request_id(data):
+    # returns the request id of a tagged message, or None, and the message without its tag
+    if data[:1] != b"#":
+        return None, data
+    match = REQUEST_TAG_REGEX.match(data)
+    if match is None:
+        return None, data
+    return int(match.group(1)), data[match.end():]
+
+
+# the stream and request id of the tagged request being handled, whose replies ServerBase.write tags
+current_request = contextvars.ContextVar("current_request", default=None)
+
+
 class ClientBase:
-    def __init__(self, host, port, server_cert_path="server.pem"):
+    def __init__(self, host, port, server_cert_path="server.pem", tls=True):
         super().__init__()
         self.stream = None
         self.host = host
         self.port = port
         self.server_cert_path = server_cert_path
+        # plain TCP without tls, e.g. for benchmarks over loopback
+        self.tls = tls
+        # see SessionCachingContext
+        self.tls_sessions_by_port = True
+        self.tls_session_pending = False
+        # see request()
+        self.requests = dict()
+        self.last_request_id = 0
+        self.reconnecting = False
+        self.reader = None
+        self.reader_error = None
+        self.unsolicited = None
 
     def run(self, timeout=None):
         log.debug("Client starting main loop")
@@ -42,88 +125,573 @@ class ClientBase:
 
     async def main(self):
         log.debug("Client starting connection to {}".format((self.host, self.port)))
-        ssl_ctx = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
-        if self.server_cert_path:
-            ssl_ctx.load_verify_locations(self.server_cert_path)
-            ssl_ctx.load_cert_chain(self.server_cert_path)
-        ssl_ctx.check_hostname = False
+        ssl_ctx = None
+        if self.tls:
+            ssl_ctx = client_ssl_context(self.server_cert_path, self.tls_sessions_by_port)
         try:
             self.stream = await TCPClient().connect(self.host, self.port, ssl_options=ssl_ctx)
         except StreamClosedError:
             raise RuntimeError("Can't connect to server at {}".format((self.host, self.port)))
+        if ssl_ctx is not None:
+            TLS_HANDSHAKES.labels("client", str(self.stream.socket.session_reused).lower()).inc()
+            self.tls_session_pending = True
+        # pipelined requests are small writes in a row, which Nagle's algorithm would hold back until acked
+        self.stream.set_nodelay(True)
         log.debug("Client connected to {}".format((self.host, self.port)))
 
-    async def read(self):
+    async def read_message(self):
         data = await read(self.stream)
-        log.debug("Client read bytes: {}".format(data[:80].rstrip(MESSAGE_SENTINEL)))
+        if self.tls_session_pending:
+            self.tls_session_pending = False
+            self.stream.socket.context.save_session(self.stream.socket)
+        if log.isEnabledFor(DEBUG):
+            log.debug("Client read bytes: {}".format(data[:80].rstrip(MESSAGE_SENTINEL)))
+        return data
+
+    async def read(self):
+        # the next message; once request() was used, the next one that isn't a reply to a request
+        if self.reader is None:
+            return await self.read_message()
+        data = await self.unsolicited.get()
+        if isinstance(data, Exception):
+            self.unsolicited.put_nowait(data)
+            raise data
         return data
 
+    async def request(self, data: bytes):
+        # Sends data tagged with a new request id and returns the reply carrying the same id. Requests may overlap:
+        # the server handles tagged requests concurrently and a reader matches replies to requests as they arrive.
+        # Only use this for messages the server replies to, and wait for requests that others depend on (e.g. login).
+        self.start_reader()
+        if self.reader_error is not None:
+            raise self.reader_error
+        request_id, future, data = self.new_request(data)
+        if self.reconnecting:
+            # sent once connected again, see reconnect()
+            return await future
+        try:
+            await self.write(data)
+        except Exception:
+            self.requests.pop(request_id, None)
+            raise
+        return await future
+
+    def new_request(self, data):
+        # the requests waiting for their reply are kept with their tagged message, to be sent again by reconnect()
+        self.last_request_id = self.last_request_id % MAX_REQUEST_ID + 1
+        future, data = Future(), tag_request(data, self.last_request_id)
+        self.requests[self.last_request_id] = (future, data)
+        return self.last_request_id, future, data
+
+    async def reconnect(self, hello=None):
+        # Connects again, e.g. when the server hands over to a new one (see ServerBase.hand_off), and sends the
+        # requests that are waiting for their reply again. hello, if given, is sent first (e.g. to log in) and its
+        # reply returned; requests made meanwhile wait for it.
+        self.reconnecting = True
+        try:
+            if self.reader is not None:
+                self.reader.cancel()
+                self.reader = None
+            self.stream.close()
+            await ClientBase.main(self)
+            self.reader_error = None
+            self.start_reader()
+            reply = None
+            if hello is not None:
+                request_id, future, data = self.new_request(hello)
+                await self.write(data)
+                reply = await future
+            self.reconnecting = False
+            for _, data in list(self.requests.values()):
+                await self.write(data)
+        except Exception as e:
+            self.reconnecting = False
+            self.fail_requests(e)
+            raise
+        return reply
+
+    def start_reader(self):
+        # from now on, read() only returns messages that aren't replies to requests
+        if self.unsolicited is None:
+            self.unsolicited = Queue()
+        if self.reader is None:
+            self.reader = asyncio.ensure_future(self.read_replies())
+
+    async def read_replies(self):
+        try:
+            while True:
+                request_id, data = split_request_id(await self.read_message())
+                future, _ = self.requests.pop(request_id, (None, None)) if request_id is not None else (None, None)
+                if future is not None:
+                    if not future.done():
+                        future.set_result(data)
+                elif request_id is None:
+                    self.unsolicited.put_nowait(data)
+        except Exception as e:
+            # unless the session failed for another reason first, see SecureDropSession.read_pushes
+            if self.reader_error is None:
+                self.reader_error = e
+            self.fail_requests(e)
+            self.unsolicited.put_nowait(e)
+
+    def fail_requests(self, e):
+        for future, _ in self.requests.values():
+            if not future.done():
+                future.set_exception(e)
+        self.requests.clear()
+
     async def write(self, data: bytes):
         await write(self.stream, data)
-        log.debug("Client wrote bytes: {}".format(data[:80].rstrip(MESSAGE_SENTINEL)))
+        if log.isEnabledFor(DEBUG):
+            log.debug("Client wrote bytes: {}".format(data[:80].rstrip(MESSAGE_SENTINEL)))
+
+
+class ShutdownController:
+    # Self-pipe used to stop a server without polling. request() only writes a byte to the pipe, so it is safe to call
+    # from signal handlers and from any process that inherited the pipe (e.g. the parent of a forked server).
+
+    def __init__(self):
+        self.read_fd, self.write_fd = os.pipe()
+        os.set_blocking(self.read_fd, False)
+        os.set_blocking(self.write_fd, False)
+
+    def request(self):
+        try:
+            os.write(self.write_fd, b"\0")
+        except BlockingIOError:
+            # the pipe is full, so a stop request is pending anyway
+            pass
+
+    def attach(self, callback):
+        def on_readable(fd, events):
+            try:
+                os.read(fd, 4096)
+            except BlockingIOError:
+                return
+            callback()
+
+        IOLoop.current().add_handler(self.read_fd, on_readable, IOLoop.READ)
+
+    def detach(self):
+        IOLoop.current().remove_handler(self.read_fd)
+
+    def close(self):
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+
+
+class MemoryBudget:
+    # Accounts for the bytes of messages that servers have read but not finished handling, so that a few clients
+    # sending large messages can't exhaust memory. acquire() waits while the budget is used up, which applies
+    # backpressure since the waiting connection isn't read from meanwhile, and gives up after a timeout.
+
+    def __init__(self, limit, timeout=DEFAULT_MEMORY_BUDGET_TIMEOUT):
+        self.limit, self.timeout = limit, timeout
+        self.used, self.peak, self.waits, self.rejected = 0, 0, 0, 0
+        self.freed = Condition()
+
+    async def acquire(self, nbytes):
+        # a message larger than the whole budget is still let through when nothing else is in use
+        if self.used and self.used + nbytes > self.limit:
+            self.waits += 1
+            deadline = IOLoop.current().time() + self.timeout
+            while self.used and self.used + nbytes > self.limit:
+                if not await self.freed.wait(timeout=deadline):
+                    self.rejected += 1
+                    return False
+        self.used += nbytes
+        self.peak = max(self.peak, self.used)
+        return True
+
+    def release(self, nbytes):
+        self.used -= nbytes
+        self.freed.notify_all()
 
 
 class ServerBase(TCPServer):
-    def __init__(self, cert_path="server.pem"):
-        ssl_ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-        if cert_path:
-            ssl_ctx.load_cert_chain(cert_path)
-        super().__init__(ssl_options=ssl_ctx)
-        self.shm = None
+    def __init__(self,
+                 cert_path="server.pem",
+                 max_message_size=None,
+                 max_message_sizes=None,
+                 memory_budget=None,
+                 packet_types=None,
+                 idle_timeout=None,
+                 tls=True,
+                 trace_events=DEFAULT_TRACE_EVENTS):
+        ssl_ctx = server_ssl_context(cert_path) if tls else None
+        # metrics are labelled with these packet prefixes (by default those with size limits), others count as "other"
+        if packet_types is None:
+            packet_types = max_message_sizes or dict()
+        self.packet_types = {prefix: prefix.decode('ascii') for prefix in packet_types}
+        # limits for messages read from clients, see read(); unlimited by default
+        self.max_message_size = max_message_size
+        self.max_message_sizes = max_message_sizes
+        self.memory_budget = memory_budget
+        max_buffer_size = None
+        if max_message_size is not None:
+            max_buffer_size = max([max_message_size, *(max_message_sizes or dict()).values()]) + 2 * READ_CHUNK_SIZE
+        super().__init__(ssl_options=ssl_ctx, max_buffer_size=max_buffer_size, read_chunk_size=READ_CHUNK_SIZE)
+        self.shutdown = None
         self.listen_ports = set()
+        self.listeners = []
+        self.streams = set()
+        self.in_flight = 0
+        self.idle = Condition()
+        # notified when the last connection closes
+        self.disconnected = Condition()
+        self.stopping = False
+        # set once the listening sockets were handed over to a new server, see hand_off()
+        self.handed_off = False
+        self.handoff_socket, self.handoff_path = None, None
+        # the connection to the server handed over to, while messages are forwarded to it, see forward()
+        self.successor = None
+        self.drain_timeout = DEFAULT_DRAIN_TIMEOUT
+        self.profiler = None
+        self.metrics_server = None
+        # what happened to the last trace_events messages, see run() for how to get it
+        self.trace = TraceBuffer(trace_events)
+        self.connection_ids = dict()
+        # timeouts of this server, which runs them while it listens; connections that send nothing for idle_timeout
+        # seconds are closed
+        self.timers = TimerWheel()
+        self.idle_timeout = idle_timeout
+        self.last_received = dict()
+        self.idle_timers = dict()
 
-    def listen(self, port: int, address: str = ""):
+    def listen(self, port: int, address: str = "", reuse_port=False):
         # this essentially calls self.listen(port), but stores the listening ports for posterity
-        socks = bind_sockets(port)
+        # with reuse_port, several processes can listen on the same port and the kernel balances connections
+        socks = bind_sockets(port, address, reuse_port=reuse_port)
+        self.add_listeners(socks)
+
+    def add_listeners(self, socks):
         self.add_sockets(socks)
+        self.listeners = socks
         self.listen_ports = {sock.getsockname()[1] for sock in socks}
+        self.timers.start()
         self.on_listen()
 
+    def stop(self):
+        super().stop()
+        self.timers.stop()
+
     def on_listen(self):
         log.info("Server listening on port(s) {}".format(self.listen_ports))
 
-    def run(self, port, shm_name):
+    def packet_type(self, data):
+        return self.packet_types.get(data[:4], "other")
+
+    def make_profiler(self, dump_dir=None):
+        # attributes samples to the packet type dispatch is handling
+        return HandlerProfiler(dump_dir, handler_code=ServerBase.dispatch.__code__)
+
+    def run(self,
+            port,
+            shutdown=None,
+            reuse_port=False,
+            metrics_port=None,
+            profile_dir=None,
+            trace_dir=None,
+            handoff_path=None):
+        # SIGUSR1 starts the profiler, or dumps and stops it; with profile_dir, it starts right away and dumps there.
+        # SIGUSR2 dumps the trace to trace_dir (the temporary directory by default), which also happens on a crash.
+        # With handoff_path, the server takes over from one that runs with the same path, if any, and later hands over
+        # to the next one, see hand_off().
         log.debug("Server starting")
-        self.shm = shared_memory.SharedMemory(shm_name)
+        # run() is the entry point of server processes; a forked child must not share its parent's event loop (and
+        # with it the parent's epoll fd), so always start on a fresh one
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        own_shutdown = shutdown is None
+        if own_shutdown:
+            shutdown = ShutdownController()
+        self.shutdown = shutdown
 
-        # only listen() once!
-        if not self.listen_ports:
-            self.listen(port)
+        if handoff_path is None or not IOLoop.current().run_sync(lambda: self.take_over(handoff_path)):
+            self.listen(port, reuse_port=reuse_port)
+        if handoff_path is not None:
+            self.serve_handoff(handoff_path)
+        if metrics_port is not None:
+            self.metrics_server = start_metrics_server(metrics_port)
+        shutdown.attach(self.request_stop)
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda *_: shutdown.request())
+        self.profiler = self.make_profiler(profile_dir)
+        signal.signal(signal.SIGUSR1, lambda *_: self.profiler.toggle())
+        signal.signal(signal.SIGUSR2, lambda *_: self.trace.dump(dump_dir=trace_dir))
+        if profile_dir is not None:
+            self.profiler.start()
 
         log.debug("Server starting main loop")
         try:
-            PeriodicCallback(self.check_stop, 100).start()
             IOLoop.current().start()
-        except:
-            # this is necessary because parent try/catch can't catch anything here for some reason
+        except KeyboardInterrupt:
+            raise
+        except BaseException:
+            self.trace.dump(dump_dir=trace_dir)
             raise
         finally:
-            self.shm.close()
-            self.shm = None
+            shutdown.detach()
+            self.close_handoff()
+            for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGUSR1, signal.SIGUSR2):
+                signal.signal(signum, signal.SIG_DFL)
+            if self.profiler.running:
+                self.profiler.dump()
+                self.profiler.stop()
+            if self.metrics_server is not None:
+                self.metrics_server.stop()
+                self.metrics_server = None
+            if own_shutdown:
+                shutdown.close()
+            self.shutdown = None
             log.debug("Server exiting main loop")
 
-    def check_stop(self):
-        if self.shm.buf[0] == 1:
-            IOLoop.current().add_callback(IOLoop.current().stop)
+    def request_stop(self):
+        if not self.stopping:
+            self.stopping = True
+            IOLoop.current().add_callback(self.graceful_stop)
 
-    async def handle_stream(self, stream, address):
-        await stream.wait_for_handshake()
-        await self.on_stream_accepted(stream, address)
-        while True:
-            try:
-                data = await read(stream)
-                await self.on_data_received(data, stream)
-            except StreamClosedError:
-                await self.on_stream_closed(stream, address)
+    async def graceful_stop(self):
+        log.info("Server stopping, draining {} in-flight request(s)".format(self.in_flight))
+        # stop accepting connections, then give in-flight requests a chance to finish before dropping everything
+        self.stop()
+        await self.drain()
+        for stream in list(self.streams):
+            stream.close()
+        IOLoop.current().stop()
+
+    async def drain(self):
+        deadline = IOLoop.current().time() + self.drain_timeout
+        while self.in_flight:
+            if not await self.idle.wait(timeout=deadline):
+                log.warning("Server dropping {} in-flight request(s)".format(self.in_flight))
+                break
+
+    async def take_over(self, path):
+        # Takes over the listening sockets of the server serving path, which then drains its in-flight requests and
+        # passes what export_state() returns to import_state(), then the messages it got too late, see forward().
+        # Returns False if no server serves path.
+        conn, listeners = await IOLoop.current().run_in_executor(None, receive_listeners, path)
+        if listeners is None:
+            return False
+        self.add_listeners(listeners)
+        log.info("Server took over listening port(s) {} from {}".format(self.listen_ports, path))
+        stream = IOStream(conn)
+        try:
+            await self.import_state(json.loads(await read(stream)))
+            # the old server tells its clients to reconnect once the state they resume is here
+            await write(stream, b"imported")
+        except Exception:
+            stream.close()
+            raise
+        IOLoop.current().spawn_callback(self.receive_forwarded, stream)
+        return True
+
+    async def receive_forwarded(self, stream):
+        try:
+            while True:
+                message = json.loads(await read(stream))
+                try:
+                    await self.on_forwarded(message["key"], base64.b64decode(message["data"]))
+                except Exception as e:
+                    log.error("Server caught exception: {}".format(e))
+        except StreamClosedError:
+            pass
+        finally:
+            stream.close()
+
+    def serve_handoff(self, path):
+        # the next server takes over by connecting to path, see take_over()
+        self.handoff_socket, self.handoff_path = bind_unix_socket(path), path
+        add_accept_handler(self.handoff_socket, lambda conn, _: IOLoop.current().spawn_callback(self.hand_off, conn))
+
+    def close_handoff(self):
+        if self.handoff_socket is None:
+            return
+        IOLoop.current().remove_handler(self.handoff_socket)
+        self.handoff_socket.close()
+        self.handoff_socket = None
+        # unless another server serves it already
+        with contextlib.suppress(OSError):
+            os.unlink(self.handoff_path)
+
+    async def hand_off(self, conn):
+        # Passes the listening sockets to the server that connected to the handoff socket, so that connections are
+        # never refused meanwhile. Then drains in-flight requests, passes export_state() to the new server and, once
+        # it imported it, lets on_handed_off() tell clients to reconnect. Messages that come in meanwhile are sent
+        # again by the clients if they are requests, and forwarded to the new server otherwise, see forward(). Stops
+        # once the clients reconnected, or drain_timeout later.
+        if self.stopping:
+            conn.close()
+            return
+        self.stopping = True
+        self.close_handoff()
+        # the new server serves metrics on the same port
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+        send_listeners(conn, self.listeners)
+        log.info("Server handed listening port(s) {} over, draining {} in-flight request(s)".format(
+            self.listen_ports, self.in_flight))
+        self.stop()
+        await self.drain()
+        self.handed_off = True
+        self.successor = IOStream(conn)
+        try:
+            await write(self.successor, json.dumps(await self.export_state()).encode())
+            await read(self.successor)
+            await self.on_handed_off()
+        except StreamClosedError:
+            log.error("Server lost the server it handed over to")
+        deadline = IOLoop.current().time() + self.drain_timeout
+        while self.streams:
+            if not await self.disconnected.wait(timeout=deadline):
                 break
-            except Exception as e:
-                log.error("Server caught exception: {}".format(e))
+        for stream in list(self.streams):
+            stream.close()
+        self.successor.close()
+        self.successor = None
+        if self.shutdown is not None:
+            IOLoop.current().stop()
+
+    async def export_state(self):
+        return dict()
+
+    async def import_state(self, state):
+        pass
+
+    async def on_handed_off(self):
+        pass
+
+    async def forward(self, stream, data):
+        # passes a message that came in after the hand off to the new server's on_forwarded(), with the key
+        # forwarding_key() gives for stream; clients send requests again themselves
+        key = self.forwarding_key(stream)
+        if key is None or self.successor is None or split_request_id(data)[0] is not None:
+            return
+        try:
+            await write(self.successor,
+                        json.dumps({
+                            "key": key,
+                            "data": base64.b64encode(data).decode('ascii')
+                        }).encode())
+        except StreamClosedError:
+            log.warning("Server could not forward a message to the server it handed over to")
+
+    def forwarding_key(self, stream):
+        return None
+
+    async def on_forwarded(self, key, data):
+        pass
+
+    async def handle_stream(self, stream, address):
+        self.streams.add(stream)
+        CONNECTIONS_ACTIVE.inc()
+        connection_id = self.connection_ids[stream] = self.trace.new_connection()
+        self.trace.record(connection_id, ACCEPT)
+        if self.idle_timeout is not None:
+            self.last_received[stream] = IOLoop.current().time()
+            self.idle_timers[stream] = self.timers.schedule(self.idle_timeout, self.check_idle, stream, address)
+        try:
+            if self.ssl_options is not None:
+                await stream.wait_for_handshake()
+                TLS_HANDSHAKES.labels("server", str(stream.socket.session_reused).lower()).inc()
+            await self.on_stream_accepted(stream, address)
+            # see ClientBase.main
+            stream.set_nodelay(True)
+            pipeline = Semaphore(MAX_PIPELINED_REQUESTS)
+            while True:
+                try:
+                    data = await read(stream, self.max_message_size, self.max_message_sizes)
+                    if self.handed_off:
+                        await self.forward(stream, data)
+                        continue
+                    size = len(data)
+                    if stream in self.last_received:
+                        self.last_received[stream] = IOLoop.current().time()
+                    if self.memory_budget is not None and not await self.memory_budget.acquire(size):
+                        log.warning("Server out of memory budget, dropping client at host {}".format(address))
+                        stream.close()
+                        raise StreamClosedError()
+                    request_id, data = split_request_id(data)
+                    self.in_flight += 1
+                    if request_id is None:
+                        # untagged messages are handled one after the other, as clients that don't tag expect
+                        await self.dispatch(data, size, stream, connection_id)
+                    else:
+                        await pipeline.acquire()
+                        asyncio.ensure_future(
+                            self.dispatch_pipelined(data, size, stream, connection_id, request_id, pipeline))
+                except StreamClosedError:
+                    if isinstance(stream.error, UnsatisfiableReadError):
+                        log.warning("Server dropping client at host {}: {}".format(address, stream.error))
+                    await self.on_stream_closed(stream, address)
+                    break
+                except Exception as e:
+                    log.error("Server caught exception: {}".format(e))
+        finally:
+            self.trace.record(connection_id, CLOSE)
+            del self.connection_ids[stream]
+            self.last_received.pop(stream, None)
+            timer = self.idle_timers.pop(stream, None)
+            if timer is not None:
+                timer.cancel()
+            self.streams.discard(stream)
+            CONNECTIONS_ACTIVE.dec()
+            if not self.streams:
+                self.disconnected.notify_all()
+
+    def check_idle(self, stream, address):
+        # rather than being rescheduled for every message, the timer checks when it runs if one came in meanwhile
+        if stream not in self.last_received:
+            return
+        remaining = self.last_received[stream] + self.idle_timeout - IOLoop.current().time()
+        if remaining > 0:
+            self.idle_timers[stream] = self.timers.schedule(remaining, self.check_idle, stream, address)
+            return
+        log.info("Server closing idle connection at host {}".format(address))
+        stream.close()
+
+    async def dispatch(self, data, size, stream, connection_id):
+        # hands a message to on_data_received; size is that of the message as read, which self.in_flight and the memory
+        # budget were charged with
+        packet_type = self.packet_type(data)
+        MESSAGES_RECEIVED.labels(packet_type).inc()
+        BYTES_RECEIVED.labels(packet_type).inc(len(data))
+        start, kind = time.perf_counter(), RECEIVE
+        try:
+            await self.on_data_received(data, stream)
+        except Exception:
+            HANDLER_ERRORS.labels(packet_type).inc()
+            kind = ERROR
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            HANDLER_SECONDS.labels(packet_type).observe(elapsed)
+            # a single event per message, an error instead of a receive if its handler raised
+            self.trace.record(connection_id, kind, data[:4], len(data), elapsed)
+            self.in_flight -= 1
+            if not self.in_flight:
+                self.idle.notify_all()
+            if self.memory_budget is not None:
+                self.memory_budget.release(size)
+
+    async def dispatch_pipelined(self, data, size, stream, connection_id, request_id, pipeline):
+        # runs in its own task, whose replies to stream write() tags with request_id
+        current_request.set((stream, request_id))
+        try:
+            await self.dispatch(data, size, stream, connection_id)
+        except StreamClosedError:
+            pass
+        except Exception as e:
+            log.error("Server caught exception: {}".format(e))
+        finally:
+            pipeline.release()
 
+    # messages are traced in self.trace instead of logged, which would format every one of them
     async def on_data_received(self, data, stream):
-        log.debug("Server read bytes: {}".format(data[:80].rstrip(MESSAGE_SENTINEL)))
+        pass
 
     async def on_data_written(self, data, stream):
-        log.debug("Server wrote bytes: {}".format(data[:80].rstrip(MESSAGE_SENTINEL)))
+        pass
 
     async def on_stream_accepted(self, stream, address):
         log.info("Server accepted connection at host {}".format(address))
@@ -132,5 +700,15 @@ class ServerBase(TCPServer):
         log.info("Server lost client at host {}".format(address))
 
     async def write(self, stream, data: bytes):
-        await write(stream, data)
+        start = time.perf_counter()
+        request = current_request.get()
+        if request is not None and request[0] is stream:
+            await write(stream, tag_request(data, request[1]))
+        else:
+            await write(stream, data)
+        # streams this server no longer handles count as connection 0
+        self.trace.record(self.connection_ids.get(stream, 0), SEND, data[:4], len(data), time.perf_counter() - start)
+        packet_type = self.packet_type(data)
+        MESSAGES_SENT.labels(packet_type).inc()
+        BYTES_SENT.labels(packet_type).inc(len(data))
         await self.on_data_written(data, stream)
@@ -0,0 +1,171 @@
+import asyncio
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from tornado.ioloop import IOLoop
+from tornado.locks import Condition
+
+from securedrop.metrics import DISK_IO_QUEUE_DEPTH, DISK_IO_SECONDS, DISK_IO_WAITS
+
+# threads of the pool shared by transfers that don't bring their own DiskIO
+DISK_IO_THREADS = 4
+# items a ReadAhead reads before they are asked for, or a WriteBehind holds before submit() waits
+DISK_IO_DEPTH = 8
+
+READ, WRITE = "read", "write"
+
+shared_disk_io = None
+
+
+class DiskIO:
+    # Runs blocking file I/O on a small thread pool instead of the IOLoop, which would otherwise stall socket reads
+    # and timers for every slow read or write. Reads and writes are told apart in the metrics.
+
+    def __init__(self, threads=DISK_IO_THREADS):
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix="disk-io")
+
+    @staticmethod
+    def shared():
+        global shared_disk_io
+        if shared_disk_io is None:
+            shared_disk_io = DiskIO()
+        return shared_disk_io
+
+    @staticmethod
+    def timed(fn, args):
+        start = time.perf_counter()
+        return fn(*args), time.perf_counter() - start
+
+    async def run(self, direction, fn, *args):
+        depth = DISK_IO_QUEUE_DEPTH.labels(direction)
+        depth.inc()
+        try:
+            result, seconds = await IOLoop.current().run_in_executor(self.executor, DiskIO.timed, fn, args)
+        finally:
+            depth.dec()
+        DISK_IO_SECONDS.labels(direction).observe(seconds)
+        return result
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+class ReadAhead:
+    # Iterates a blocking iterator (e.g. a generator reading a file) on a DiskIO, keeping up to depth items ready
+    # before next() asks for them. Errors of the iterator are raised by next() once the items before them are used.
+
+    def __init__(self, iterator, disk_io=None, depth=DISK_IO_DEPTH):
+        self.iterator = iterator
+        self.disk_io = disk_io if disk_io is not None else DiskIO.shared()
+        self.depth = max(1, depth)
+        self.ready = deque()
+        self.changed = Condition()
+        self.fetcher = None
+        self.ended, self.error = False, None
+        # times next() found nothing ready, i.e. the disk rather than the consumer was the limit
+        self.waits = 0
+
+    def start(self):
+        if (self.fetcher is None or self.fetcher.done()) and not self.ended and len(self.ready) < self.depth:
+            self.fetcher = asyncio.ensure_future(self.fetch())
+
+    async def fetch(self):
+        # one item at a time, since an iterator can't run in two threads at once
+        while not self.ended and len(self.ready) < self.depth:
+            try:
+                item = await self.disk_io.run(READ, next, self.iterator, None)
+            except Exception as e:
+                self.error, item = e, None
+            if self.ended:
+                # closed meanwhile
+                break
+            if item is None:
+                self.ended = True
+            else:
+                self.ready.append(item)
+            self.changed.notify_all()
+
+    async def next(self):
+        # the next item, or None at the end
+        self.start()
+        if not self.ready and not self.ended:
+            self.waits += 1
+            DISK_IO_WAITS.labels(READ).inc()
+            while not self.ready and not self.ended:
+                await self.changed.wait()
+        if self.ready:
+            item = self.ready.popleft()
+            self.start()
+            return item
+        if self.error is not None:
+            raise self.error
+        return None
+
+    def close(self):
+        self.ended = True
+        self.ready.clear()
+        close = getattr(self.iterator, "close", None)
+        if close is None:
+            return
+        # a generator can't be closed while a thread runs it, so wait for the item being read
+        if self.fetcher is not None and not self.fetcher.done():
+            self.fetcher.add_done_callback(lambda _: close())
+        else:
+            close()
+
+
+class WriteBehind:
+    # Runs blocking writes on a DiskIO in the order they were submitted, one at a time. submit() returns as soon as
+    # the write is queued and only waits while depth writes are pending, so the caller can go on reading from the
+    # network. done(result, error) is awaited on the IOLoop after each write, with what it returned or the exception
+    # it raised; writes after a failed one are dropped.
+
+    def __init__(self, done, disk_io=None, depth=DISK_IO_DEPTH):
+        self.done = done
+        self.disk_io = disk_io if disk_io is not None else DiskIO.shared()
+        self.depth = max(1, depth)
+        self.pending = deque()
+        self.changed = Condition()
+        self.writer = None
+        self.failed = False
+        # times submit() found the queue full, i.e. the disk rather than the network was the limit
+        self.waits = 0
+
+    async def submit(self, fn, *args):
+        if len(self.pending) >= self.depth:
+            self.waits += 1
+            DISK_IO_WAITS.labels(WRITE).inc()
+            while len(self.pending) >= self.depth and not self.failed:
+                await self.changed.wait()
+        if self.failed:
+            return
+        self.pending.append((fn, args))
+        if self.writer is None or self.writer.done():
+            self.writer = asyncio.ensure_future(self.write())
+
+    async def write(self):
+        while self.pending and not self.failed:
+            fn, args = self.pending[0]
+            result, error = None, None
+            try:
+                result = await self.disk_io.run(WRITE, fn, *args)
+            except Exception as e:
+                error = e
+                self.failed = True
+            self.pending.popleft()
+            self.changed.notify_all()
+            await self.done(result, error)
+        self.pending.clear()
+        self.changed.notify_all()
+
+    async def flush(self):
+        # waits until every write submitted so far ran, or one of them failed
+        while self.writer is not None and not self.writer.done():
+            await self.writer
+
+    async def close(self, fn, *args):
+        # runs fn after the pending writes, even if one of them failed, e.g. to close a file
+        await self.flush()
+        self.failed = True
+        await self.disk_io.run(WRITE, fn, *args)
@@ -23,8 +23,10 @@ import json
 # Part 2: Transfer Protocol
 
 # 1. `X -> Hash(F)/Chunks(F)/UniqueToken -> Y`: X sends the hash of F, the number of chunks in F, and a rand token to Y
-# 2. `X -> NextChunk(F) -> Y`: X sends next chunk of file to Y
-# 3. `Y -> Success/Failure -> X`: after all chunks received, Y sends success/failure to X
+# 1a. `Y -> Address -> X`: if X offered to, Y asks X to pass F's file descriptor over a unix socket instead of chunks
+# 2. `X -> NextChunk(F) -> Y`: X sends next chunk of file to Y, as long as it has credits left
+# 3. `Y -> Ack/Window -> X`: Y acknowledges written chunks, which grants X credits for more chunks
+# 4. `Y -> Success/Failure -> X`: after all chunks received, Y sends success/failure to X
 
 # ****************************************************************
 
@@ -155,18 +157,29 @@ FILE_TRANSFER_SEND_PORT_TOKEN_PACKETS_NAME = b"FTPT"
 
 
 class FileTransferSendPortTokenPackets:
-    def __init__(self, port: int = None, token: bytes = None, data=None):
-        # If port is empty, the request was denied
-        self.port, self.token = port, token
+    def __init__(self,
+                 port: int = None,
+                 token: bytes = None,
+                 recipient_email: str = None,
+                 message: str = None,
+                 data=None):
+        # If port is empty, the request was denied, or message tells why it failed otherwise (e.g. it timed out). The
+        # recipient tells X which of its requests this answers, older servers leave it out.
+        self.port, self.token, self.recipient_email, self.message = port, token, recipient_email, message
         self.jdict = dict()
         if data is not None:
             self.jdict = json.loads(data)
             self.port, self.token = self.jdict["port"], base64.b64decode(self.jdict["token"])
+            self.recipient_email, self.message = self.jdict.get("recipient_email"), self.jdict.get("message")
         elif port is not None and token is not None:
             self.jdict = {
                 "port": self.port,
                 "token": str(base64.b64encode(self.token), encoding='ascii'),
             }
+            if recipient_email is not None:
+                self.jdict["recipient_email"] = self.recipient_email
+            if message:
+                self.jdict["message"] = self.message
 
     def __bytes__(self):
         return FILE_TRANSFER_SEND_PORT_TOKEN_PACKETS_NAME + bytes(json.dumps(self.jdict), encoding='ascii')
@@ -176,7 +189,11 @@ class FileTransferSendPortTokenPackets:
 
 # 1. `X -> Hash(F)/Chunks(F)/UniqueToken -> Y`: X sends the hash of F and the number of chunks in F to Y
 
+# chunk size a sender starts with, and the bounds it adapts it within, see ChunkSizeTuner
 FILE_TRANSFER_P2P_CHUNK_SIZE = 256 * 256
+FILE_TRANSFER_P2P_MIN_CHUNK_SIZE = 16 * 1024
+FILE_TRANSFER_P2P_MAX_CHUNK_SIZE = 1024 * 1024
+FILE_TRANSFER_P2P_WINDOW = 16
 FILE_TRANSFER_P2P_FILEINFO_PACKETS_NAME = b"FTPF"
 
 
@@ -197,7 +214,29 @@ class FileTransferP2PFileInfoPackets:
         return FILE_TRANSFER_P2P_FILEINFO_PACKETS_NAME + bytes(json.dumps(self.jdict), encoding='ascii')
 
 
-# 2. `X -> NextChunk(F) -> Y`: X sends next chunk of file to Y
+# 1a. `Y -> Address -> X`: if X offered to, Y asks X to pass F's file descriptor over a unix socket instead of chunks
+
+FILE_TRANSFER_P2P_LOCAL_PACKETS_NAME = b"FTPL"
+
+
+class FileTransferP2PLocalPackets:
+    def __init__(self, address: str = None, data=None):
+        # name of the unix socket in the abstract namespace, without the leading null byte
+        self.address = address
+        self.jdict = dict()
+        if data is not None:
+            self.jdict = json.loads(data)
+            self.address = self.jdict["address"]
+        elif address is not None:
+            self.jdict = {
+                "address": self.address,
+            }
+
+    def __bytes__(self):
+        return FILE_TRANSFER_P2P_LOCAL_PACKETS_NAME + bytes(json.dumps(self.jdict), encoding='ascii')
+
+
+# 2. `X -> NextChunk(F) -> Y`: X sends next chunk of file to Y, as long as it has credits left
 
 FILE_TRANSFER_P2P_CHUNK_PACKETS_NAME = b"FTPC"
 
@@ -226,6 +265,33 @@ class FileTransferP2PSentinelPackets:
         return FILE_TRANSFER_P2P_SENTINEL_PACKETS_NAME
 
 
-# 3. `Y -> Success/Failure -> X`: after all chunks received, Y sends success/failure to X
+# 3. `Y -> Ack/Window -> X`: Y acknowledges written chunks, which grants X credits for more chunks
+
+FILE_TRANSFER_P2P_ACK_PACKETS_NAME = b"FTPA"
+
+
+class FileTransferP2PAckPackets:
+    def __init__(self, acked: int = None, window: int = None, max_chunk_size: int = None, data=None):
+        # X may have at most (acked + window) chunks sent in total. Y's first ack tells X the largest chunk it takes,
+        # older receivers leave it out.
+        self.acked, self.window, self.max_chunk_size = acked, window, max_chunk_size
+        self.jdict = dict()
+        if data is not None:
+            self.jdict = json.loads(data)
+            self.acked, self.window = self.jdict["acked"], self.jdict["window"]
+            self.max_chunk_size = self.jdict.get("max_chunk_size")
+        elif acked is not None and window is not None:
+            self.jdict = {
+                "acked": self.acked,
+                "window": self.window,
+            }
+            if max_chunk_size is not None:
+                self.jdict["max_chunk_size"] = self.max_chunk_size
+
+    def __bytes__(self):
+        return FILE_TRANSFER_P2P_ACK_PACKETS_NAME + bytes(json.dumps(self.jdict), encoding='ascii')
+
+
+# 4. `Y -> Success/Failure -> X`: after all chunks received, Y sends success/failure to X
 
 # Status packets
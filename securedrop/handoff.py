@@ -0,0 +1,39 @@
+import socket
+
+# Hot restart: a server started with the handoff path of a running one takes over its listening sockets, passed over
+# the unix socket at that path, so that no connection attempt is refused meanwhile; see ServerBase.take_over() and
+# ServerBase.hand_off() for the rest of the exchange.
+
+# seconds a new server waits for the running one to pass its listening sockets
+HANDOFF_TIMEOUT = 10
+# more than a server listens on, one per address family
+MAX_LISTENERS = 16
+
+
+def receive_listeners(path):
+    # Blocking. Asks the server serving path for its listening sockets; returns the connection to it and the sockets,
+    # or (None, None) if no server serves path.
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        conn.close()
+        return None, None
+    try:
+        conn.settimeout(HANDOFF_TIMEOUT)
+        _, fds, _, _ = socket.recv_fds(conn, 16, MAX_LISTENERS)
+    except OSError:
+        conn.close()
+        raise
+    if not fds:
+        conn.close()
+        raise RuntimeError("Server at {} passed no listening sockets".format(path))
+    listeners = [socket.socket(fileno=fd) for fd in fds]
+    for listener in listeners:
+        listener.setblocking(False)
+    conn.setblocking(False)
+    return conn, listeners
+
+
+def send_listeners(conn, listeners):
+    socket.send_fds(conn, [b"listeners"], [listener.fileno() for listener in listeners])
@@ -4,17 +4,25 @@ LOGIN_PACKETS_NAME = b"LGIN"
 
 
 class LoginPackets:
-    def __init__(self, email: str = None, password: str = None, data=None):
-        self.email, self.password = email, password
+    # resume, instead of the password, logs in with the token of a session on the server this one took over from, see
+    # Server.resume()
+    def __init__(self, email: str = None, password: str = None, resume: str = None, data=None):
+        self.email, self.password, self.resume = email, password, resume
         self.jdict = dict()
         if data is not None:
             self.jdict = json.loads(data)
-            self.email, self.password = self.jdict["email"], self.jdict["password"]
+            self.email, self.password, self.resume = self.jdict["email"], self.jdict.get("password"), self.jdict.get(
+                "resume")
         elif email is not None and password is not None:
             self.jdict = {
                 "email": self.email,
                 "password": self.password,
             }
+        elif email is not None and resume is not None:
+            self.jdict = {
+                "email": self.email,
+                "resume": self.resume,
+            }
 
     def __bytes__(self):
         return LOGIN_PACKETS_NAME + bytes(json.dumps(self.jdict), encoding='ascii')
@@ -0,0 +1,201 @@
+import bisect
+import time
+from logging import getLogger
+
+from tornado.httpserver import HTTPServer
+from tornado.web import Application, RequestHandler
+
+# upper bounds of latency histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+log = getLogger()
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for v in values)
+    return "{" + ",".join("{}=\"{}\"".format(n, v) for n, v in zip(names, escaped)) + "}"
+
+
+def format_value(value):
+    return repr(float(value)) if value != float("inf") else "+Inf"
+
+
+class CounterValue:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def samples(self, name, labels):
+        yield name + "_total" + labels, self.value
+
+
+class GaugeValue(CounterValue):
+    def dec(self, n=1):
+        self.value -= n
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self, name, labels):
+        yield name + labels, self.value
+
+
+class HistogramValue:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self, name, labels):
+        # buckets are cumulative in the exposition format
+        cumulative = 0
+        label_prefix = labels[:-1] + "," if labels else "{"
+        for bound, count in zip((*self.buckets, float("inf")), self.counts):
+            cumulative += count
+            yield "{}_bucket{}le=\"{}\"}}".format(name, label_prefix, format_value(bound)), cumulative
+        yield name + "_sum" + labels, self.sum
+        yield name + "_count" + labels, cumulative
+
+
+class Metric:
+    # A metric family; values are kept per combination of label values, see labels(). Metrics without labels can be
+    # updated directly, e.g. counter.inc() instead of counter.labels().inc(). make_value creates the value kept for a
+    # new combination of label values.
+    kind = ""
+
+    def __init__(self, name, description, make_value, labels=(), registry=None):
+        self.name, self.description, self.label_names = name, description, tuple(labels)
+        self.make_value = make_value
+        self.values = dict()
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def labels(self, *values):
+        value = self.values.get(values)
+        if value is None:
+            value = self.values[values] = self.make_value()
+        return value
+
+    def expose(self):
+        lines = ["# HELP {} {}".format(self.name, self.description), "# TYPE {} {}".format(self.name, self.kind)]
+        for values, value in self.values.items():
+            for sample, number in value.samples(self.name, format_labels(self.label_names, values)):
+                lines.append("{} {}".format(sample, format_value(number)))
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name, description, labels=(), registry=None):
+        super().__init__(name, description, CounterValue, labels, registry)
+
+    def inc(self, n=1):
+        self.labels().inc(n)
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name, description, labels=(), registry=None):
+        super().__init__(name, description, GaugeValue, labels, registry)
+
+    def inc(self, n=1):
+        self.labels().inc(n)
+
+    def dec(self, n=1):
+        self.labels().dec(n)
+
+    def set(self, value):
+        self.labels().set(value)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, description, labels=(), registry=None, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, description, lambda: HistogramValue(self.buckets), labels, registry)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+
+class Timer:
+    # context manager observing the seconds spent in its block in a histogram value
+    def __init__(self, histogram_value):
+        self.histogram_value = histogram_value
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.histogram_value.observe(time.perf_counter() - self.start)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = dict()
+
+    def register(self, metric):
+        if metric.name in self.metrics:
+            raise RuntimeError("Metric {} registered twice".format(metric.name))
+        self.metrics[metric.name] = metric
+
+    def expose(self):
+        # Prometheus text exposition format, version 0.0.4
+        return "".join(metric.expose() + "\n" for metric in self.metrics.values())
+
+
+REGISTRY = Registry()
+
+
+class MetricsHandler(RequestHandler):
+    def initialize(self, registry):
+        self.registry = registry
+
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(self.registry.expose())
+
+
+def start_metrics_server(port, address="127.0.0.1", registry=None):
+    # serves the registry at http://address:port/metrics on the current IOLoop
+    app = Application([("/metrics", MetricsHandler, {"registry": registry if registry is not None else REGISTRY})])
+    server = HTTPServer(app)
+    server.listen(port, address)
+    log.info("Metrics available at http://{}:{}/metrics".format(address, port))
+    return server
+
+
+# server metrics; packet types are the prefixes a server has message size limits for, see ServerBase
+CONNECTIONS_ACTIVE = Gauge("securedrop_connections_active", "Connections currently open.")
+MESSAGES_RECEIVED = Counter("securedrop_messages_received", "Messages received, by packet type.", ["type"])
+BYTES_RECEIVED = Counter("securedrop_received_bytes", "Bytes of messages received, by packet type.", ["type"])
+MESSAGES_SENT = Counter("securedrop_messages_sent", "Messages sent, by packet type.", ["type"])
+BYTES_SENT = Counter("securedrop_sent_bytes", "Bytes of messages sent, by packet type.", ["type"])
+HANDLER_SECONDS = Histogram("securedrop_handler_seconds", "Time spent handling messages, by packet type.", ["type"])
+HANDLER_ERRORS = Counter("securedrop_handler_errors", "Messages whose handler raised, by packet type.", ["type"])
+KDF_QUEUE_DEPTH = Gauge("securedrop_kdf_queue_depth", "Password key derivations waiting or running.")
+KDF_SECONDS = Histogram("securedrop_kdf_seconds", "Time spent deriving password keys.")
+DB_WRITE_SECONDS = Histogram("securedrop_db_write_seconds", "Time spent writing the user database.")
+DISK_IO_QUEUE_DEPTH = Gauge("securedrop_disk_io_queue_depth", "File reads or writes of transfers waiting or running.",
+                            ["direction"])
+DISK_IO_SECONDS = Histogram("securedrop_disk_io_seconds", "Time spent reading or writing files of transfers.",
+                            ["direction"])
+DISK_IO_WAITS = Counter(
+    "securedrop_disk_io_waits",
+    "Times a transfer waited for the disk: a chunk wasn't read ahead yet or too many were written "
+    "behind.", ["direction"])
+LIST_CONTACTS_RESPONSES = Counter("securedrop_list_contacts_responses",
+                                  "Contact lists sent, by kind: the whole list, the changes or not modified.", ["kind"])
+TLS_HANDSHAKES = Counter("securedrop_tls_handshakes",
+                         "TLS handshakes, by side and whether they resumed an earlier session.", ["side", "resumed"])
@@ -1,85 +1,558 @@
+import asyncio
+import errno
+import hmac
 import os
+import secrets
+import socket
+import stat
+import sys
+import time
 import zlib
 from base64 import b64encode, b64decode
+from collections import deque
+from functools import partial
+from logging import getLogger
 from math import ceil
-from multiprocessing import shared_memory
+
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+from tornado.locks import Condition
 
 from securedrop import ClientBase, ServerBase
-from securedrop.file_transfer_packets import FILE_TRANSFER_P2P_CHUNK_SIZE, FileTransferP2PChunkPackets, \
+from securedrop.archive import ArchiveReader, ArchiveWriter, DIRECTORY
+from securedrop.disk_io import DiskIO, ReadAhead, WriteBehind, DISK_IO_DEPTH, READ, WRITE
+from securedrop.file_transfer_packets import FILE_TRANSFER_P2P_CHUNK_SIZE, FILE_TRANSFER_P2P_MIN_CHUNK_SIZE, \
+    FILE_TRANSFER_P2P_MAX_CHUNK_SIZE, FileTransferP2PChunkPackets, \
     FileTransferP2PFileInfoPackets, FILE_TRANSFER_P2P_FILEINFO_PACKETS_NAME, FILE_TRANSFER_P2P_CHUNK_PACKETS_NAME, \
-    FILE_TRANSFER_P2P_SENTINEL_PACKETS_NAME, FileTransferP2PSentinelPackets
-from securedrop.status_packets import StatusPackets
-from securedrop.utils import sha256_file
+    FILE_TRANSFER_P2P_SENTINEL_PACKETS_NAME, FileTransferP2PSentinelPackets, FILE_TRANSFER_P2P_WINDOW, \
+    FILE_TRANSFER_P2P_ACK_PACKETS_NAME, FileTransferP2PAckPackets, FILE_TRANSFER_P2P_LOCAL_PACKETS_NAME, \
+    FileTransferP2PLocalPackets
+from securedrop.progress import Progress
+from securedrop.status_packets import STATUS_PACKETS_NAME, StatusPackets
+from securedrop.utils import sha256_file, sizeof_fmt
+
+log = getLogger()
+
+# Same-host transfers pass the file's descriptor over a unix socket instead of sending chunks, which needs
+# socket.send_fds() and, for a socket without a file, the abstract namespace of Linux
+SAME_HOST_SUPPORTED = sys.platform.startswith("linux") and hasattr(socket, "send_fds")
+# seconds to wait for the other side of the unix socket
+SAME_HOST_TIMEOUT = 10
+# bytes copied per call, between which the progress is updated
+SAME_HOST_COPY_SIZE = 16 * 1024 * 1024
+SAME_HOST_ACCEPTED, SAME_HOST_DECLINED = b"\x01", b"\x00"
+# errors of copy_file_range() and sendfile() for files they can't copy between, e.g. on different file systems
+COPY_FALLBACK_ERRNOS = (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP)
+
+# events a P2PServer traces: one is created for every transfer, which needs far fewer than a long running server
+P2P_TRACE_EVENTS = 1024
+
+# seconds a chunk should take to send at the measured throughput, see ChunkSizeTuner
+CHUNK_TARGET_SECONDS = 0.01
+
+
+def p2p_max_message_size(chunk_size):
+    # chunks are base64 encoded twice (once by P2PClient, once by the packet), which makes them 16/9 as large, plus
+    # some JSON and whatever zlib held back from earlier chunks
+    return 2 * (chunk_size + 64 * 1024)
+
+
+class P2PTransferStats:
+    def __init__(self):
+        self.started = None
+        # bytes of the file, before compression
+        self.bytes_acked = 0
+        self.acks = 0
+        self.stalls = 0
+        self.rtt_min = None
+        self.srtt = None
+        # seconds spent waiting for chunks to be read from the disk and encoded, as opposed to for credits
+        self.disk_seconds = 0
+
+    def add_rtt(self, sample):
+        self.rtt_min = sample if self.rtt_min is None else min(self.rtt_min, sample)
+        # smoothed like TCP's SRTT (RFC 6298) so a single slow disk write doesn't dominate
+        self.srtt = sample if self.srtt is None else 0.875 * self.srtt + 0.125 * sample
+
+    def throughput(self):
+        elapsed = time.monotonic() - self.started if self.started is not None else 0
+        return self.bytes_acked / elapsed if elapsed > 0 else 0
+
+    def __str__(self):
+        return "{}/s acked, srtt {:.1f} ms, min rtt {:.1f} ms, {} acks, {} stalls, {:.2f} s disk wait".format(
+            sizeof_fmt(self.throughput()), 1000 * (self.srtt or 0), 1000 * (self.rtt_min or 0), self.acks, self.stalls,
+            self.disk_seconds)
+
+
+class CreditWindow:
+    # Sender side view of the credits granted by the receiver. Chunks are only sent while credits are left, so at
+    # most `size` chunks are ever buffered between X and Y, regardless of the disk and network speeds on each end.
+
+    def __init__(self):
+        self.sent, self.acked, self.size = 0, 0, 0
+        self.in_flight = deque()
+        self.changed = Condition()
+        self.stats = P2PTransferStats()
+        self.error = None
+
+    def credits(self):
+        return self.acked + self.size - self.sent
+
+    async def acquire(self, nbytes):
+        if self.credits() <= 0 and self.error is None:
+            self.stats.stalls += 1
+            while self.credits() <= 0 and self.error is None:
+                await self.changed.wait()
+        if self.error is not None:
+            raise self.error
+        if self.stats.started is None:
+            self.stats.started = time.monotonic()
+        self.sent += 1
+        self.in_flight.append((time.monotonic(), nbytes))
+
+    def on_ack(self, acked, size):
+        now = time.monotonic()
+        sent_time = None
+        while self.acked < acked and self.in_flight:
+            sent_time, nbytes = self.in_flight.popleft()
+            self.stats.bytes_acked += nbytes
+            self.acked += 1
+        if sent_time is not None:
+            self.stats.add_rtt(now - sent_time)
+        self.stats.acks += 1
+        self.acked, self.size = acked, size
+        self.changed.notify_all()
+
+    def fail(self, error):
+        self.error = error
+        self.changed.notify_all()
+
+
+class ChunkSizeTuner:
+    # Size of the chunks P2PClient reads next, adapted to the link between min_size and max_size: a chunk should take
+    # about CHUNK_TARGET_SECONDS to send at the measured throughput, so the overhead per chunk doesn't dominate fast
+    # links and progress stays fine grained on slow ones, and the window of chunks should cover a round trip, so the
+    # link stays busy. The size doubles or halves at most once per ack, and only when the target is twice as far off.
+
+    def __init__(self, size, min_size, max_size, window=FILE_TRANSFER_P2P_WINDOW):
+        self.min_size, self.max_size, self.window = min_size, max_size, window
+        self.size = self.clamp(size)
+        # throughput in bytes of the file per second, smoothed over acks
+        self.rate = None
+        self.last = None
+
+    def clamp(self, size):
+        return max(self.min_size, min(self.max_size, size))
+
+    def limit(self, max_size):
+        # Y takes chunks of at most max_size
+        self.max_size = max(self.min_size, min(self.max_size, max_size))
+        self.size = self.clamp(self.size)
+
+    def update(self, bytes_acked, srtt, now=None):
+        now = time.monotonic() if now is None else now
+        if self.last is not None and now > self.last[0]:
+            sample = (bytes_acked - self.last[1]) / (now - self.last[0])
+            self.rate = sample if self.rate is None else 0.75 * self.rate + 0.25 * sample
+        self.last = (now, bytes_acked)
+        if self.rate is None or srtt is None:
+            return
+        target = self.rate * max(CHUNK_TARGET_SECONDS, srtt / self.window)
+        if target >= 2 * self.size:
+            self.size = self.clamp(2 * self.size)
+        elif target < self.size / 2:
+            self.size = self.clamp(self.size // 2)
+
+
+def file_chunks(path, chunk_size, compress, skip=0, tuner=None):
+    # the chunk packets P2PClient sends for the file (or directory, see archive.py) at path, as (packet, compressed
+    # size, bytes of the file in it); zlib's output only depends on the input so far, so these are the same every
+    # time, unless a ChunkSizeTuner picks the size of each chunk instead. The first skip packets are left out, though
+    # their chunks are still compressed for the sake of those that follow.
+    with ArchiveReader(path) if os.path.isdir(path) else open(path, "rb") as file:
+        compressor = zlib.compressobj() if compress else None
+        index = 0
+        while chunk := file.read(tuner.size if tuner is not None else chunk_size):
+            size = len(chunk)
+            chunk = compressor.compress(chunk) if compressor is not None else chunk
+            if index >= skip:
+                yield bytes(FileTransferP2PChunkPackets(b64encode(chunk))), len(chunk), size
+            index += 1
+        if compressor is not None:
+            chunk = compressor.flush()
+            if index >= skip:
+                yield bytes(FileTransferP2PChunkPackets(b64encode(chunk))), len(chunk), 0
+
+
+def copy_range(in_fd, out_fd, offset, count):
+    # copies up to count bytes at offset in in_fd to the same offset in out_fd, within the kernel where it can, and
+    # returns the number of bytes copied, which is 0 at the end of in_fd
+    try:
+        return os.copy_file_range(in_fd, out_fd, count, offset, offset)
+    except OSError as e:
+        if e.errno not in COPY_FALLBACK_ERRNOS:
+            raise
+    try:
+        os.lseek(out_fd, offset, os.SEEK_SET)
+        return os.sendfile(out_fd, in_fd, offset, count)
+    except OSError as e:
+        if e.errno not in COPY_FALLBACK_ERRNOS:
+            raise
+    return os.pwrite(out_fd, os.pread(in_fd, count, offset), offset)
+
+
+class SharedChunks:
+    # Chunk packets of one file for several P2PClients sending it to different recipients, so that the file is read,
+    # compressed and encoded once. Each reader has its own position in a buffer of the newest max_lag chunks. A reader
+    # that falls further behind, or starts after the first chunks were dropped, goes on with chunks of its own from
+    # file_chunks(), so a slow recipient neither stalls the others nor holds on to memory. Chunks are read ahead on
+    # disk_io, see ReadAhead.
+
+    def __init__(self,
+                 path,
+                 chunk_size=FILE_TRANSFER_P2P_CHUNK_SIZE,
+                 compress=True,
+                 max_lag=FILE_TRANSFER_P2P_WINDOW * 4,
+                 disk_io=None,
+                 read_ahead=DISK_IO_DEPTH):
+        self.path, self.chunk_size, self.compress, self.max_lag = path, chunk_size, compress, max_lag
+        self.disk_io = disk_io if disk_io is not None else DiskIO.shared()
+        self.read_ahead = read_ahead
+        self.chunks = ReadAhead(file_chunks(path, chunk_size, compress), self.disk_io, read_ahead)
+        # buffer[i - first] is chunk i
+        self.buffer = deque()
+        self.first = 0
+        self.finished = False
+        self.fetching = False
+        self.changed = Condition()
+        self.readers = set()
+        self.detached = 0
+
+    def reader(self):
+        reader = SharedChunksReader(self)
+        if self.first > 0:
+            self.detach(reader)
+        else:
+            self.readers.add(reader)
+        return reader
+
+    async def get(self, reader):
+        # the reader's next chunk, or None after the last one; other readers may read chunks meanwhile
+        while reader.index >= self.first + len(self.buffer) and not self.finished and reader.own_chunks is None:
+            if self.fetching:
+                # another reader reads the next chunk, which may be the one this reader needs
+                await self.changed.wait()
+                continue
+            self.fetching = True
+            try:
+                chunk = await self.chunks.next()
+            finally:
+                self.fetching = False
+                self.changed.notify_all()
+            if chunk is None:
+                self.finished = True
+            else:
+                self.buffer.append(chunk)
+                if len(self.buffer) > self.max_lag:
+                    self.buffer.popleft()
+                    self.first += 1
+                    for lagging in [r for r in self.readers if r.index < self.first]:
+                        self.detach(lagging)
+        if reader.own_chunks is not None:
+            return await reader.next()
+        if reader.index >= self.first + len(self.buffer):
+            return None
+        chunk = self.buffer[reader.index - self.first]
+        reader.index += 1
+        return chunk
+
+    def detach(self, reader):
+        self.readers.discard(reader)
+        self.detached += 1
+        # compressing the chunks already sent again takes a while, but zlib lets other threads run meanwhile
+        reader.own_chunks = ReadAhead(file_chunks(self.path, self.chunk_size, self.compress, reader.index),
+                                      self.disk_io, self.read_ahead)
+
+    def release(self, reader):
+        self.readers.discard(reader)
+        if reader.own_chunks is not None:
+            reader.own_chunks.close()
+
+    def close(self):
+        # once no more readers start
+        self.chunks.close()
+
+
+class SharedChunksReader:
+    def __init__(self, shared):
+        self.shared = shared
+        self.index = 0
+        # a ReadAhead of the chunks from index on once detached, see SharedChunks
+        self.own_chunks = None
+
+    async def next(self):
+        # the next chunk, or None after the last one
+        if self.own_chunks is None:
+            return await self.shared.get(self)
+        chunk = await self.own_chunks.next()
+        if chunk is not None:
+            self.index += 1
+        return chunk
+
+    def close(self):
+        self.shared.release(self)
 
 
 class P2PClient(ClientBase):
-    def __init__(self, port, token, in_filename, in_file_size, in_file_sha256, progress_shm_name, progress_lock):
-        super().__init__("localhost", port)
-        self.token, self.in_filename, self.in_file_size, self.in_file_sha256, self.progress_shm_name,\
-            self.progress_lock = token, in_filename, in_file_size, in_file_sha256, progress_shm_name, progress_lock
+    def __init__(self,
+                 port,
+                 token,
+                 in_filename,
+                 in_file_size,
+                 in_file_sha256,
+                 progress=None,
+                 chunk_size=FILE_TRANSFER_P2P_CHUNK_SIZE,
+                 compress=True,
+                 tls=True,
+                 shared_chunks=None,
+                 same_host=True,
+                 disk_io=None,
+                 read_ahead=DISK_IO_DEPTH,
+                 min_chunk_size=FILE_TRANSFER_P2P_MIN_CHUNK_SIZE,
+                 max_chunk_size=FILE_TRANSFER_P2P_MAX_CHUNK_SIZE,
+                 adaptive=True):
+        super().__init__("localhost", port, tls=tls)
+        # every P2PServer listens on a new port, but those of a process share their TLS sessions, see server_ssl_context
+        self.tls_sessions_by_port = False
+        self.token, self.in_filename, self.in_file_size, self.in_file_sha256 = \
+            token, in_filename, in_file_size, in_file_sha256
+        self.chunk_size, self.compress = chunk_size, compress
+        # a SharedChunks of the same file when sending it to several recipients at once
+        self.shared_chunks = shared_chunks
+        if shared_chunks is not None:
+            self.chunk_size, self.compress = shared_chunks.chunk_size, shared_chunks.compress
+        # reads and encodes chunks ahead of sending them, unless shared_chunks does
+        self.disk_io, self.read_ahead = disk_io, read_ahead
+        # chunk_size is where the tuner starts; chunks shared with other clients keep their size
+        self.tuner = None
+        if adaptive and shared_chunks is None:
+            self.tuner = ChunkSizeTuner(chunk_size, min(min_chunk_size, chunk_size), max(max_chunk_size, chunk_size))
+        # counts bytes of the file sent
+        self.progress = progress if progress is not None else Progress()
+        self.window = CreditWindow()
+        # offer Y the file's descriptor instead of chunks, which Y takes if it runs on the same host
+        self.same_host = same_host and SAME_HOST_SUPPORTED and os.path.isfile(in_filename)
+        # resolves to the address Y sent, or None if Y wants chunks
+        self.local_address = Future()
+
+    @property
+    def stats(self):
+        return self.window.stats
+
+    async def read_acks(self):
+        # runs alongside main() and returns the message of Y's final status packet, or None if Y went away or sent
+        # something invalid
+        msg = None
+        try:
+            while True:
+                data = await self.read()
+                prefix = data[:4]
+                data = data[4:]
+                if prefix == FILE_TRANSFER_P2P_LOCAL_PACKETS_NAME:
+                    if not self.local_address.done():
+                        self.local_address.set_result(FileTransferP2PLocalPackets(data=data).address)
+                elif prefix == FILE_TRANSFER_P2P_ACK_PACKETS_NAME:
+                    # Y sends its address before the first ack, if at all
+                    if not self.local_address.done():
+                        self.local_address.set_result(None)
+                    ack = FileTransferP2PAckPackets(data=data)
+                    self.window.on_ack(ack.acked, ack.window)
+                    if self.tuner is not None:
+                        if self.window.stats.acks == 1:
+                            # receivers that don't say how large chunks may be take those of the size they were told
+                            self.tuner.limit(ack.max_chunk_size or self.chunk_size)
+                        self.tuner.update(self.stats.bytes_acked, self.stats.srtt)
+                elif prefix == STATUS_PACKETS_NAME:
+                    msg = StatusPackets(data=data).message
+                    return msg
+        except StreamClosedError:
+            self.window.fail(RuntimeError("Recipient closed the connection"))
+        except Exception as e:
+            self.window.fail(RuntimeError("Invalid message from recipient: {}".format(e)))
+        finally:
+            if not self.local_address.done():
+                self.local_address.set_result(None)
+            # no credits come once Y stopped acking, e.g. after a failure status, so chunks must not wait for them
+            if self.window.error is None:
+                self.window.fail(RuntimeError(msg or "Recipient ended the transfer"))
+
+    def send_fd(self, address):
+        # passes the file's descriptor to Y, which confirms it copies the file; runs in an executor
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(SAME_HOST_TIMEOUT)
+            sock.connect("\0" + address)
+            fd = os.open(self.in_filename, os.O_RDONLY)
+            try:
+                socket.send_fds(sock, [self.token], [fd])
+            finally:
+                os.close(fd)
+            return sock.recv(1) == SAME_HOST_ACCEPTED
+
+    async def send_local(self):
+        # whether Y copies the file itself; if not, X sends chunks as usual
+        address = await self.local_address
+        if address is None:
+            return False
+        try:
+            return await IOLoop.current().run_in_executor(None, self.send_fd, address)
+        except OSError as e:
+            log.info("Sending chunks, the file descriptor couldn't be passed: {}".format(e))
+            return False
+
+    async def send_chunk(self, packet, size):
+        await self.window.acquire(size)
+        await self.write(packet)
 
     async def main(self):
         await super().main()
 
-        progress = shared_memory.SharedMemory(self.progress_shm_name)
+        ack_reader = asyncio.ensure_future(self.read_acks())
         try:
-            total_chunks = ceil(self.in_file_size / FILE_TRANSFER_P2P_CHUNK_SIZE)
             file_info = {
                 "name": os.path.basename(self.in_filename),
-                "chunks": total_chunks,
+                "size": self.in_file_size,
+                # for receivers that predate "size"
+                "chunks": ceil(self.in_file_size / self.chunk_size),
                 "SHA256": self.in_file_sha256,
+                "chunk_size": self.chunk_size,
+                "compression": "zlib" if self.compress else "none",
             }
+            if os.path.isdir(self.in_filename):
+                # in_file_size and in_file_sha256 are those of archive_info()
+                file_info["type"] = DIRECTORY
+            if self.same_host:
+                file_info["same_host"] = True
 
             await self.write(bytes(FileTransferP2PFileInfoPackets(file_info, self.token)))
 
-            chunks_sent = 0
-            with self.progress_lock:
-                progress.buf[0:4] = chunks_sent.to_bytes(4, byteorder='little')
-                progress.buf[4:8] = total_chunks.to_bytes(4, byteorder='little')
-
-            with open(self.in_filename, "rb") as file:
-                compressor = zlib.compressobj()
-                while chunk := file.read(FILE_TRANSFER_P2P_CHUNK_SIZE):
-                    await self.write(bytes(FileTransferP2PChunkPackets(b64encode(compressor.compress(chunk)))))
-                    chunks_sent += 1
-                    with self.progress_lock:
-                        progress.buf[0:4] = chunks_sent.to_bytes(4, byteorder='little')
-
-                await self.write(bytes(FileTransferP2PChunkPackets(b64encode(compressor.flush()))))
-                await self.write(bytes(FileTransferP2PSentinelPackets()))
+            self.progress.total, self.progress.unit = self.in_file_size, 1
+
+            if self.same_host and await self.send_local():
+                log.debug("Recipient copies the file on the same host")
+            else:
+                await self.send_chunks()
+
+            # 4. `Y -> Success/Failure -> X`: after all chunks received, Y sends success/failure to X
+            msg = await ack_reader
+            log.debug("P2P transfer stats: {}".format(self.stats))
+            if msg is None:
+                raise self.window.error
+            if msg != "":
+                raise RuntimeError(msg)
+            if self.progress.done < self.in_file_size:
+                self.progress.update(self.in_file_size - self.progress.done)
         finally:
-            progress.close()
+            if not ack_reader.done():
+                ack_reader.cancel()
+            self.progress.finish()
+
+    async def send_chunks(self):
+        if self.shared_chunks is not None:
+            reader = self.shared_chunks.reader()
+        else:
+            reader = ReadAhead(file_chunks(self.in_filename, self.chunk_size, self.compress, tuner=self.tuner),
+                               self.disk_io, self.read_ahead)
+        try:
+            while True:
+                start = time.monotonic()
+                chunk = await reader.next()
+                self.stats.disk_seconds += time.monotonic() - start
+                if chunk is None:
+                    break
+                packet, _, file_bytes = chunk
+                await self.send_chunk(packet, file_bytes)
+                self.progress.update(file_bytes)
+        finally:
+            reader.close()
+        await self.write(bytes(FileTransferP2PSentinelPackets()))
 
 
 class P2PServer(ServerBase):
-    def __init__(self, token, out_dir, progress_shm_name, lock, listen_port_shm_name, status_sentinel):
-        super().__init__()
+    # Receives a single file. The server either runs in-process on the current IOLoop (start()/wait()/close()), or
+    # standalone in its own process via run().
+
+    def __init__(self,
+                 token,
+                 out_dir,
+                 progress=None,
+                 window=FILE_TRANSFER_P2P_WINDOW,
+                 max_chunk_size=FILE_TRANSFER_P2P_MAX_CHUNK_SIZE,
+                 tls=True,
+                 same_host=True,
+                 disk_io=None,
+                 write_behind=DISK_IO_DEPTH):
+        super().__init__(max_message_size=p2p_max_message_size(max_chunk_size), tls=tls, trace_events=P2P_TRACE_EVENTS)
         self.token = token
-        self.out_dir, self.lock = out_dir, lock
-        self.received_chunks, self.total_chunks, self.sha256 = 0, 0, ""
-        self.progress = shared_memory.SharedMemory(progress_shm_name)
-        self.listen_port_shm = shared_memory.SharedMemory(listen_port_shm_name)
-        self.sentinel = None
-        self.status_sentinel = shared_memory.SharedMemory(status_sentinel)
+        self.max_chunk_size = max_chunk_size
+        self.window = window
+        # acking every chunk would double the packet rate, so batch acks while keeping X from stalling
+        self.ack_interval = max(1, window // 4)
+        self.out_dir = out_dir
+        # counts bytes of the file received
+        self.progress = progress if progress is not None else Progress()
+        self.received_chunks, self.size, self.sha256 = 0, 0, ""
         self.out_filename = ""
-        self.verified = False
+        self.verified_stream = None
         self.out_path = ""
         self.decompressor = None
+        # chunks are decoded and written on disk_io while the next ones are read from X, see WriteBehind
+        self.disk_io = disk_io if disk_io is not None else DiskIO.shared()
+        self.write_behind = write_behind
+        self.writer = None
+        self.out_file = None
+        # set when receiving a directory
+        self.archive = None
+        # take the file's descriptor when X offers it, see receive_local()
+        self.same_host = same_host and SAME_HOST_SUPPORTED
+        self.local_socket, self.local_task = None, None
+        # set once copying the file X passed, after which chunks are ignored
+        self.local = False
+        self.done = None
+        self.finished = False
 
-    def run(self, port, server_sentinel):
-        self.sentinel = shared_memory.SharedMemory(server_sentinel)
-        self.sentinel.buf[0] = 0
-        try:
-            self.listen(port)
-            with self.lock:
-                self.listen_port_shm.buf[0:4] = int(next(iter(self.listen_ports))).to_bytes(4, byteorder='little')
+    def start(self, port=0):
+        # listen on the current IOLoop and return the port the OS chose
+        self.done = Future()
+        self.listen(port)
+        return next(iter(self.listen_ports))
 
-            super().run(port, server_sentinel)
-        finally:
-            self.progress.close()
-            self.listen_port_shm.close()
-            self.sentinel.close()
-            self.status_sentinel.close()
+    async def wait(self):
+        # returns the status message sent to X, which is empty on success
+        return await self.done
+
+    def close(self):
+        self.close_local()
+        self.stop()
+
+    def close_local(self):
+        # stops waiting for X to connect to the unix socket
+        if self.local_socket is not None:
+            self.local_task.cancel()
+
+    def finish(self, msg):
+        if self.finished:
+            return
+        self.finished = True
+        self.close_local()
+        if self.writer is not None:
+            asyncio.ensure_future(self.writer.close(self.close_out_file, msg))
+        self.progress.finish()
+        if self.done is not None:
+            self.done.set_result(msg)
+        # standalone mode: stop the server's process
+        if self.shutdown is not None:
+            self.request_stop()
 
     # suppress output with these empty functions
 
@@ -90,7 +563,8 @@ class P2PServer(ServerBase):
         pass
 
     async def on_stream_closed(self, stream, address):
-        pass
+        if stream is self.verified_stream:
+            self.finish("Sender closed the connection")
 
     async def on_data_received(self, data, stream):
         prefix = data[:4]
@@ -98,44 +572,188 @@ class P2PServer(ServerBase):
 
         if prefix == FILE_TRANSFER_P2P_FILEINFO_PACKETS_NAME:
             await self.process_fileinfo(FileTransferP2PFileInfoPackets(data=data), stream)
-        elif not self.verified:
+        elif stream is not self.verified_stream:
             print("Connection not verified!")
             stream.close()
         elif prefix == FILE_TRANSFER_P2P_CHUNK_PACKETS_NAME:
-            await self.process_chunk(FileTransferP2PChunkPackets(data=data))
+            await self.process_chunk(FileTransferP2PChunkPackets(data=data), stream)
         elif prefix == FILE_TRANSFER_P2P_SENTINEL_PACKETS_NAME:
             await self.complete_transfer(stream)
 
     async def process_fileinfo(self, file_info, stream):
-        if self.token != file_info.token:
+        if self.token != file_info.token or self.verified_stream is not None:
             print("Token doesn't match!")
             stream.close()
+            return
+        # senders that predate these fields use the defaults
+        chunk_size = file_info.file_info.get("chunk_size", FILE_TRANSFER_P2P_CHUNK_SIZE)
+        if chunk_size > self.max_chunk_size:
+            print("Chunk size {} is too large!".format(chunk_size))
+            stream.close()
+            return
 
-        self.verified = True
-        self.out_filename = file_info.file_info["name"]
-        self.total_chunks = file_info.file_info["chunks"]
+        name = file_info.file_info["name"]
+        if name in ("", ".", "..") or os.path.basename(name) != name:
+            print("Invalid file name {}!".format(name))
+            stream.close()
+            return
+
+        self.verified_stream = stream
+        self.out_filename = name
+        # senders that predate "size" only tell the number of chunks
+        self.size = file_info.file_info.get("size")
+        if self.size is None:
+            self.size = file_info.file_info["chunks"] * chunk_size
         self.sha256 = file_info.file_info["SHA256"]
-        self.decompressor = zlib.decompressobj()
+        if file_info.file_info.get("compression", "zlib") == "zlib":
+            self.decompressor = zlib.decompressobj()
+        self.progress.total, self.progress.unit = self.size, 1
+        if file_info.file_info.get("type") == DIRECTORY:
+            self.out_path = os.path.join(self.out_dir, self.out_filename)
+            try:
+                self.archive = ArchiveWriter(self.out_path)
+            except OSError as e:
+                await self.send_status(stream, str(e))
+                return
+
+        if self.same_host and file_info.file_info.get("same_host") and self.archive is None:
+            # 1a. `Y -> Address -> X`: X is on the same host, so ask for the file's descriptor; if X doesn't pass it,
+            # it sends chunks with the credits granted below
+            address = secrets.token_hex(16)
+            self.local_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.local_socket.setblocking(False)
+            self.local_socket.bind("\0" + address)
+            self.local_socket.listen(1)
+            await self.write(stream, bytes(FileTransferP2PLocalPackets(address)))
+            self.local_task = asyncio.ensure_future(self.receive_local(stream))
+
+        self.writer = WriteBehind(partial(self.on_chunk_written, stream), self.disk_io, self.write_behind)
+        # grant X its initial credits, and tell it how large chunks may get
+        await self.write(stream, bytes(FileTransferP2PAckPackets(self.received_chunks, self.window,
+                                                                 self.max_chunk_size)))
+
+    async def receive_local(self, stream):
+        loop = asyncio.get_running_loop()
+        try:
+            conn, _ = await asyncio.wait_for(loop.sock_accept(self.local_socket), SAME_HOST_TIMEOUT)
+        except (asyncio.TimeoutError, OSError):
+            # X sends chunks instead
+            return
+        finally:
+            self.local_socket.close()
+            self.local_socket = None
+        with conn:
+            conn.settimeout(SAME_HOST_TIMEOUT)
+            try:
+                token, fds, _, _ = await loop.run_in_executor(None, socket.recv_fds, conn, len(self.token) + 1, 1)
+            except OSError:
+                return
+            if not fds:
+                return
+            try:
+                # anyone on the host may connect, so the descriptor is only used along with the token
+                if self.finished or not hmac.compare_digest(token, self.token) or not stat.S_ISREG(
+                        os.fstat(fds[0]).st_mode):
+                    conn.sendall(SAME_HOST_DECLINED)
+                    return
+                self.local = True
+                conn.sendall(SAME_HOST_ACCEPTED)
+                msg = await self.copy_local(fds[0])
+            finally:
+                for fd in fds:
+                    os.close(fd)
+        await self.send_status(stream, msg)
+
+    async def copy_local(self, in_fd):
+        # copies the file X passed into out_path at disk speed and returns the status message for X
+        self.out_path = os.path.join(self.out_dir, self.out_filename)
+        try:
+            out_fd = os.open(self.out_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        except OSError as e:
+            return str(e)
+        try:
+            offset = 0
+            while copied := await self.disk_io.run(WRITE, copy_range, in_fd, out_fd, offset, SAME_HOST_COPY_SIZE):
+                offset += copied
+                self.progress.update(copied)
+        except OSError as e:
+            return str(e)
+        finally:
+            os.close(out_fd)
+        compare_sha256 = await self.disk_io.run(READ, sha256_file, self.out_path)
+        return "" if self.sha256 == compare_sha256 else "File hashes don't match!"
+
+    async def process_chunk(self, chunk, stream):
+        if self.finished or self.local:
+            return
+        # only waits if the disk is behind by write_behind chunks already
+        await self.writer.submit(self.write_chunk, chunk.chunk)
+
+    def write_chunk(self, data):
+        # runs on disk_io, and returns the bytes of the file written
+        data = b64decode(data)
+        data = self.decompressor.decompress(data) if self.decompressor is not None else data
+        if self.archive is not None:
+            self.archive.write(data)
+        else:
+            if self.out_file is None:
+                self.out_path = os.path.join(self.out_dir, self.out_filename)
+                self.out_file = open(self.out_path, "ab")
+            self.out_file.write(data)
+        return len(data)
+
+    async def on_chunk_written(self, stream, written, error):
+        if self.finished:
+            return
+        if error is not None:
+            await self.send_status(stream, str(error))
+            return
+        self.received_chunks += 1
+        self.progress.update(written)
 
-        with self.lock:
-            self.progress.buf[0:4] = self.received_chunks.to_bytes(4, byteorder='little')
-            self.progress.buf[4:8] = self.total_chunks.to_bytes(4, byteorder='little')
+        # only ack chunks once they hit the disk, so a slow disk throttles X instead of piling up in memory
+        if self.received_chunks % self.ack_interval == 0:
+            await self.write(stream, bytes(FileTransferP2PAckPackets(self.received_chunks, self.window)))
 
-    async def process_chunk(self, chunk):
-        if not self.out_path:
+    def close_out_file(self, msg=""):
+        if self.out_file is not None:
+            self.out_file.close()
+            self.out_file = None
+        # don't leave part of a directory behind
+        if msg and self.archive is not None:
+            self.archive.abort()
+
+    def complete_file(self):
+        # runs on disk_io once every chunk was written, and returns the status message for X
+        if self.archive is not None:
+            if self.decompressor is not None:
+                self.archive.write(self.decompressor.flush())
+            return "" if self.sha256 == self.archive.close() else "Directory hashes don't match!"
+        if self.out_file is None:
+            # an empty file has no chunks
             self.out_path = os.path.join(self.out_dir, self.out_filename)
-        with open(self.out_path, "ab") as file:
-            file.write(self.decompressor.decompress(b64decode(chunk.chunk)))
-            self.received_chunks += 1
-            with self.lock:
-                self.progress.buf[0:4] = self.received_chunks.to_bytes(4, byteorder='little')
+            self.out_file = open(self.out_path, "ab")
+        if self.decompressor is not None:
+            self.out_file.write(self.decompressor.flush())
+        self.close_out_file()
+        compare_sha256 = sha256_file(self.out_path)
+        return "" if self.sha256 == compare_sha256 else "File hashes don't match!"
 
     async def complete_transfer(self, stream):
-        with self.lock:
-            self.status_sentinel.buf[0] = 1
-        with open(self.out_path, "ab") as file:
-            file.write(self.decompressor.flush())
-        compare_sha256 = sha256_file(self.out_path)
-        msg = "" if self.sha256 == compare_sha256 else "File hashes don't match!"
+        if self.finished or self.local:
+            return
+        await self.writer.flush()
+        if self.finished:
+            # a write failed, and X was told so
+            return
+        try:
+            msg = await self.disk_io.run(WRITE, self.complete_file)
+        except (RuntimeError, OSError) as e:
+            msg = str(e)
+        log.debug("P2P receiver waited for the disk {} times".format(self.writer.waits))
+        await self.send_status(stream, msg)
+
+    async def send_status(self, stream, msg):
+        # sends X the final status, which is empty on success
         await self.write(stream, bytes(StatusPackets(msg)))
-        self.sentinel.buf[0] = 1
+        self.finish(msg)
@@ -0,0 +1,165 @@
+import collections
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+from logging import getLogger
+
+from tornado.ioloop import PeriodicCallback
+
+# seconds of CPU time between two stack samples
+DEFAULT_SAMPLE_INTERVAL = 0.005
+
+# seconds the IOLoop may be blocked before it's reported as stalled
+DEFAULT_STALL_THRESHOLD = 0.1
+
+# stalls kept for the next dump
+MAX_STALLS = 100
+
+log = getLogger()
+
+
+def collapse_stack(frame):
+    # "file:function;file:function" from the outermost frame to the innermost, as flamegraph.pl expects
+    names = []
+    while frame is not None:
+        names.append("{}:{}".format(os.path.basename(frame.f_code.co_filename), frame.f_code.co_name))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class HandlerProfiler:
+    # Opt-in profiler for servers. While running, it samples the stack of the IOLoop's thread on every interval of CPU
+    # time (SIGPROF) and counts the samples per packet type of the message being handled, and a watchdog thread
+    # reports the IOLoop as stalled when it doesn't get to run for longer than stall_threshold, along with the stack
+    # and packet type that blocks it. Stopped, it costs nothing. See ServerBase.run for the signal that toggles it.
+
+    def __init__(self,
+                 dump_dir=None,
+                 interval=DEFAULT_SAMPLE_INTERVAL,
+                 stall_threshold=DEFAULT_STALL_THRESHOLD,
+                 handler_code=None):
+        self.dump_dir = dump_dir if dump_dir is not None else tempfile.gettempdir()
+        self.interval, self.stall_threshold = interval, stall_threshold
+        # the code of the coroutine that dispatches messages, with the packet type in a local, see packet_type()
+        self.handler_code = handler_code
+        self.samples = collections.defaultdict(collections.Counter)
+        self.stalls = collections.deque(maxlen=MAX_STALLS)
+        self.running = False
+        self.started = None
+        self.heartbeat = 0
+        self.heartbeat_callback = None
+        self.watchdog = None
+        self.thread_id = None
+
+    def packet_type(self, frame):
+        while frame is not None:
+            if frame.f_code is self.handler_code:
+                return frame.f_locals.get("packet_type") or "idle"
+            frame = frame.f_back
+        return "idle"
+
+    def on_sample(self, signum, frame):
+        self.samples[self.packet_type(frame)][collapse_stack(frame)] += 1
+
+    @staticmethod
+    def interrupted_frame(frame):
+        # the frame on_sample interrupted, if the watchdog caught the thread running it (and whatever it calls)
+        innermost = frame
+        while frame is not None:
+            if frame.f_code is HandlerProfiler.on_sample.__code__:
+                return frame.f_back
+            frame = frame.f_back
+        return innermost
+
+    def beat(self):
+        self.heartbeat = time.monotonic()
+
+    def watch(self):
+        reported = None
+        while self.running:
+            time.sleep(self.stall_threshold / 2)
+            heartbeat = self.heartbeat
+            blocked = time.monotonic() - heartbeat
+            if blocked > self.stall_threshold and heartbeat != reported:
+                reported = heartbeat
+                frame = self.interrupted_frame(sys._current_frames().get(self.thread_id))
+                if frame is None:
+                    continue
+                stall = {
+                    "time": time.time(),
+                    "blocked": blocked,
+                    "packet_type": self.packet_type(frame),
+                    "stack": collapse_stack(frame),
+                }
+                self.stalls.append(stall)
+                log.warning("IOLoop stalled for over {:.3f}s handling {}".format(blocked, stall["packet_type"]))
+
+    def start(self):
+        # must be called on the IOLoop's thread, which has to be the main thread to receive SIGPROF
+        if self.running:
+            return
+        self.running = True
+        self.started = time.time()
+        self.thread_id = threading.get_ident()
+        self.beat()
+        self.heartbeat_callback = PeriodicCallback(self.beat, self.stall_threshold * 1000 / 4)
+        self.heartbeat_callback.start()
+        self.watchdog = threading.Thread(target=self.watch, name="profiler-watchdog", daemon=True)
+        self.watchdog.start()
+        signal.signal(signal.SIGPROF, self.on_sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        log.info("Profiler started")
+
+    def stop(self):
+        if not self.running:
+            return
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+        self.running = False
+        self.heartbeat_callback.stop()
+        self.watchdog.join()
+        log.info("Profiler stopped")
+
+    def toggle(self):
+        # start, or dump and stop
+        if self.running:
+            self.dump()
+            self.stop()
+        else:
+            self.start()
+
+    def report(self):
+        lines = ["# profile of pid {} since {}".format(os.getpid(), time.ctime(self.started))]
+        lines.append("# samples every {}s of CPU time per packet type, as collapsed stacks".format(self.interval))
+        for packet_type, stacks in sorted(self.samples.items()):
+            lines.append("# {}: {} samples".format(packet_type, sum(stacks.values())))
+            for stack, count in stacks.most_common():
+                lines.append("{};{} {}".format(packet_type, stack, count))
+        lines.append("# {} stall(s) above {}s".format(len(self.stalls), self.stall_threshold))
+        for stall in self.stalls:
+            lines.append("# stall at {} for at least {:.3f}s handling {}".format(time.ctime(stall["time"]),
+                                                                                 stall["blocked"],
+                                                                                 stall["packet_type"]))
+            lines.append("stall;{};{} 1".format(stall["packet_type"], stall["stack"]))
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path=None):
+        # writes report() and clears the samples and stalls; returns the path written to
+        if path is None:
+            path = os.path.join(self.dump_dir, "securedrop-profile-{}-{}.txt".format(os.getpid(), int(time.time())))
+        # no samples may be added while the report is built
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        try:
+            report = self.report()
+            self.samples.clear()
+            self.stalls.clear()
+        finally:
+            if self.running:
+                signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        with open(path, "w") as f:
+            f.write(report)
+        log.info("Profile written to {}".format(path))
+        return path
@@ -0,0 +1,92 @@
+import time
+from logging import getLogger, INFO
+
+# minimum number of seconds between two events emitted by the same Progress
+DEFAULT_PROGRESS_INTERVAL = 0.1
+
+log = getLogger()
+
+
+def sizeof_fmt(num, suffix='B'):
+    for unit in ['', 'Ki', 'Mi', 'Gi', 'Ti', 'Pi', 'Ei', 'Zi']:
+        if abs(num) < 1024.0:
+            return "%3.1f%s%s" % (num, unit, suffix)
+        num /= 1024.0
+    return "%.1f%s%s" % (num, 'Yi', suffix)
+
+
+def format_status(progress, total, percent, verb, rate=None, eta=None):
+    status = "{}/{} {} ({})".format(progress, total, verb, percent)
+    if rate is not None:
+        status += " {}/s".format(sizeof_fmt(rate))
+    if eta is not None:
+        status += " ETA {}s".format(int(eta))
+    return status
+
+
+class ProgressEvent:
+    def __init__(self, done, total, unit=1, rate=None, eta=None, final=False):
+        self.done, self.total, self.unit, self.rate, self.eta, self.final = done, total, unit, rate, eta, final
+
+    def percent(self):
+        return 100 * (self.done / self.total) if self.total else 0
+
+    def format(self):
+        return sizeof_fmt(self.done * self.unit), sizeof_fmt(self.total * self.unit), "{}%".format(int(self.percent()))
+
+
+class Progress:
+    # Counts how far along an operation is. Updates only bump a counter; an event is built and handed to the sinks at
+    # most once per interval, plus once more when the operation finishes. Sinks are callables taking a ProgressEvent.
+
+    def __init__(self, total=0, unit=1, sinks=None, interval=DEFAULT_PROGRESS_INTERVAL):
+        self.done, self.total, self.unit = 0, total, unit
+        self.sinks = list(sinks) if sinks is not None else []
+        self.interval = interval
+        self.started = time.monotonic()
+        self.next_emit = 0
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def update(self, n=1):
+        self.done += n
+        now = time.monotonic()
+        if now >= self.next_emit:
+            self.emit(now)
+
+    def finish(self):
+        self.emit(time.monotonic(), final=True)
+
+    def event(self, now, final=False):
+        elapsed = now - self.started
+        rate = self.done * self.unit / elapsed if elapsed > 0 else None
+        eta = None
+        if rate and self.total >= self.done:
+            eta = (self.total - self.done) * self.unit / rate
+        return ProgressEvent(self.done, self.total, self.unit, rate, eta, final)
+
+    def emit(self, now, final=False):
+        self.next_emit = now + self.interval
+        if self.sinks:
+            event = self.event(now, final)
+            for sink in self.sinks:
+                sink(event)
+
+
+class TerminalSink:
+    def __init__(self, verb):
+        self.verb = verb
+
+    def __call__(self, event):
+        status = format_status(*event.format(), self.verb, event.rate, None if event.final else event.eta)
+        print(status, end='\n' if event.final else '\r', flush=True)
+
+
+class LogSink:
+    def __init__(self, verb, level=INFO):
+        self.verb, self.level = verb, level
+
+    def __call__(self, event):
+        if log.isEnabledFor(self.level):
+            log.log(self.level, format_status(*event.format(), self.verb, event.rate, event.eta))
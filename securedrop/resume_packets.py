@@ -0,0 +1,20 @@
+import json
+
+RESUME_PACKETS_NAME = b"RSUM"
+
+
+class ResumePackets:
+    # pushed to clients by a server that handed over to a new one: the token to log in to the new one with
+    def __init__(self, token: str = None, data=None):
+        self.token = token
+        self.jdict = dict()
+        if data is not None:
+            self.jdict = json.loads(data)
+            self.token = self.jdict["token"]
+        elif token is not None:
+            self.jdict = {
+                "token": self.token,
+            }
+
+    def __bytes__(self):
+        return RESUME_PACKETS_NAME + bytes(json.dumps(self.jdict), encoding='ascii')
@@ -1,34 +1,95 @@
 #!/usr/bin/env python3
 
+import asyncio
 import base64
+import contextlib
+import fcntl
+import hmac
 import json
 import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from logging import getLogger
-from multiprocessing import shared_memory
+from multiprocessing import Process
 
 import Crypto.Util.Padding
 from Crypto.Cipher import AES
 from Crypto.Hash import SHAKE256, SHA256, SHA512
 from Crypto.Protocol.KDF import PBKDF2
 from Crypto.Random import get_random_bytes
-
-from securedrop import ServerBase
-from securedrop.List_Contacts_Packets import LIST_CONTACTS_PACKETS_NAME
-from securedrop.List_Contacts_Response_Packets import ListContactsResponsePackets
-from securedrop.add_contact_packets import ADD_CONTACT_PACKETS_NAME, AddContactPackets
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+from tornado.netutil import bind_unix_socket
+
+from securedrop import ServerBase, ShutdownController, MemoryBudget
+from securedrop.client_server_base import current_request
+from securedrop.List_Contacts_Packets import LIST_CONTACTS_PACKETS_NAME, ListContactsPackets
+from securedrop.List_Contacts_Response_Packets import ListContactsResponsePackets, LIST_CONTACTS_RESPONSE_PACKETS_NAME
+from securedrop.add_contact_packets import ADD_CONTACT_PACKETS_NAME, AddContactPackets, ADD_CONTACTS_PACKETS_NAME, \
+    AddContactsPackets
 from securedrop.file_transfer_packets import FILE_TRANSFER_REQUEST_TRANSFER_PACKETS_NAME, FileTransferRequestPackets, \
     FILE_TRANSFER_CHECK_REQUESTS_PACKETS_NAME, FileTransferCheckRequestsPackets, \
     FILE_TRANSFER_ACCEPT_REQUEST_PACKETS_NAME, FileTransferAcceptRequestPackets, \
     FileTransferSendTokenPackets, FILE_TRANSFER_SEND_PORT_PACKETS_NAME, FileTransferSendPortPackets, \
-    FileTransferSendPortTokenPackets
+    FileTransferSendPortTokenPackets, FILE_TRANSFER_CHECK_REQUESTS_RESPONSE_PACKETS_NAME, \
+    FILE_TRANSFER_SEND_TOKEN_PACKETS_NAME, FILE_TRANSFER_SEND_PORT_TOKEN_PACKETS_NAME
 from securedrop.login_packets import LOGIN_PACKETS_NAME, LoginPackets
+from securedrop.metrics import KDF_QUEUE_DEPTH, KDF_SECONDS, DB_WRITE_SECONDS, LIST_CONTACTS_RESPONSES, Timer
 from securedrop.register_packets import REGISTER_PACKETS_NAME, RegisterPackets
-from securedrop.status_packets import StatusPackets
+from securedrop.resume_packets import RESUME_PACKETS_NAME, ResumePackets
+from securedrop.session_directory import LocalSessionDirectory, BrokerSessionDirectory, SessionBroker
+from securedrop.status_packets import StatusPackets, STATUS_PACKETS_NAME, BatchStatusPackets, BATCH_STATUS_PACKETS_NAME
 from securedrop.utils import validate_and_normalize_email
 
 DEFAULT_filename = 'server.json'
 DEFAULT_PORT = 6969
 
+# largest message accepted from clients for each packet type, and for anything else
+MAX_MESSAGE_SIZES = {
+    REGISTER_PACKETS_NAME: 4 * 1024,
+    LOGIN_PACKETS_NAME: 4 * 1024,
+    ADD_CONTACT_PACKETS_NAME: 4 * 1024,
+    # room for a few thousand contacts
+    ADD_CONTACTS_PACKETS_NAME: 1024 * 1024,
+    LIST_CONTACTS_PACKETS_NAME: 256,
+    FILE_TRANSFER_REQUEST_TRANSFER_PACKETS_NAME: 64 * 1024,
+    FILE_TRANSFER_CHECK_REQUESTS_PACKETS_NAME: 64,
+    FILE_TRANSFER_ACCEPT_REQUEST_PACKETS_NAME: 4 * 1024,
+    FILE_TRANSFER_SEND_PORT_PACKETS_NAME: 256,
+}
+DEFAULT_MAX_MESSAGE_SIZE = 4 * 1024
+
+# packet types metrics are labelled with: those received from and those sent to clients
+PACKET_TYPES = {
+    *MAX_MESSAGE_SIZES, STATUS_PACKETS_NAME, BATCH_STATUS_PACKETS_NAME, LIST_CONTACTS_RESPONSE_PACKETS_NAME,
+    FILE_TRANSFER_CHECK_REQUESTS_RESPONSE_PACKETS_NAME, FILE_TRANSFER_SEND_TOKEN_PACKETS_NAME,
+    FILE_TRANSFER_SEND_PORT_TOKEN_PACKETS_NAME, RESUME_PACKETS_NAME
+}
+
+# changes of each user's contact list kept to answer clients that ask for the changes since their version
+CONTACT_VIEW_HISTORY = 32
+
+# seconds a file transfer request waits for the recipient to answer, and a recipient that accepted one has to send the
+# port it listens on, before the sender is told it failed
+DEFAULT_REQUEST_TIMEOUT = 5 * 60
+DEFAULT_TOKEN_TIMEOUT = 30
+
+# seconds the users that were online on the server this one took over from have to log in again with their resume
+# token, see Server.import_state()
+DEFAULT_RESUME_TIMEOUT = 60
+
+# seconds a connection may send nothing before it's closed; clients poll for requests every second or so
+DEFAULT_IDLE_TIMEOUT = 10 * 60
+
+# bytes of messages a server process handles at once, across all clients
+DEFAULT_MEMORY_BUDGET = 64 * 1024 * 1024
+
 log = getLogger()
 
 
@@ -36,7 +97,14 @@ def make_salt():
     return get_random_bytes(32)
 
 
+def hash_email(email):
+    # users are known by the SHA256 of their email, see RegisteredUsers; the file has it in hex
+    return SHA256.new(email.encode()).digest()
+
+
 class Authentication:
+    __slots__ = ("salt", "key")
+
     salt: bytes
     key: bytes
 
@@ -57,6 +125,12 @@ class Authentication:
     def __eq__(self, other):
         return self.salt == other.salt and self.key == other.key
 
+    @staticmethod
+    def timed(key, salt=None):
+        start = time.perf_counter()
+        auth = Authentication(key, salt)
+        return auth, time.perf_counter() - start
+
     def make_dict(self):
         return {"salt": base64.b64encode(self.salt).decode('utf-8'), "key": base64.b64encode(self.key).decode('utf-8')}
 
@@ -68,15 +142,22 @@ class AESWrapper(object):
         self.key = shake.read(32)
 
     def encrypt(self, raw):
+        return base64.b64encode(self.encrypt_bytes(raw)).decode('utf-8')
+
+    def encrypt_bytes(self, raw):
         raw = Crypto.Util.Padding.pad(raw.encode('utf-8'), self.bs)
         iv = get_random_bytes(AES.block_size)
         cipher = AES.new(self.key, AES.MODE_CBC, iv)
-        bytes_ = base64.b64encode(iv + cipher.encrypt(raw))
-        return bytes_.decode('utf-8')
+        return iv + cipher.encrypt(raw)
 
     def decrypt(self, enc):
         try:
-            data = base64.b64decode(enc)
+            return self.decrypt_bytes(base64.b64decode(enc))
+        except ValueError:
+            raise RuntimeError("Decryption was not successful, could not verify input")
+
+    def decrypt_bytes(self, data):
+        try:
             iv = data[:AES.block_size]
             cipher = AES.new(self.key, AES.MODE_CBC, iv)
             result = Crypto.Util.Padding.unpad(cipher.decrypt(data[AES.block_size:]), self.bs).decode('utf-8')
@@ -85,33 +166,62 @@ class AESWrapper(object):
             raise RuntimeError("Decryption was not successful, could not verify input")
 
 
+class KeyDerivation:
+    # Derives password keys on a thread pool instead of the IOLoop, which would otherwise stall for every login and
+    # registration. PyCryptodome computes PBKDF2 in C, outside the GIL.
+
+    def __init__(self, threads=None):
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix="kdf")
+
+    async def authentication(self, password, salt=None):
+        KDF_QUEUE_DEPTH.inc()
+        try:
+            auth, seconds = await IOLoop.current().run_in_executor(self.executor, Authentication.timed, password, salt)
+        finally:
+            KDF_QUEUE_DEPTH.dec()
+        KDF_SECONDS.observe(seconds)
+        return auth
+
+
 class ClientData:
+    # One per registered user, so kept small: slots instead of a __dict__, the email hash as a digest and the
+    # encrypted name and contacts as bytes rather than in hex and base64 as in the file, and interned emails, which
+    # the contacts of other users and the server's sessions share.
+    __slots__ = ("name", "email", "contacts", "auth", "email_hash", "enc_name", "enc_contacts")
+
     name: str
     email: str
     contacts: dict
     auth: Authentication
-    email_hash: str
-    enc_name: str
-    enc_contacts: str
+    email_hash: bytes
+    enc_name: bytes
+    enc_contacts: bytes
 
-    def __init__(self, name=None, email=None, contacts=None, password=None, jdict=None):
+    def __init__(self, name=None, email=None, contacts=None, password=None, jdict=None, auth=None):
         if jdict is not None:
             self.enc_name, self.email_hash, self.enc_contacts, self.auth = \
-                jdict["name"], jdict["email"], jdict["contacts"], Authentication(jdict=jdict["auth"])
+                base64.b64decode(jdict["name"]), bytes.fromhex(jdict["email"]), base64.b64decode(jdict["contacts"]), \
+                Authentication(jdict=jdict["auth"])
+            # only known once the user logs in
+            self.name, self.email, self.contacts = None, None, None
         else:
-            self.name, self.email, self.contacts, self.auth = name, email, contacts, Authentication(password)
-            self.email_hash = SHA256.new(self.email.encode()).hexdigest()
+            self.name, self.email, self.contacts = name, sys.intern(email), contacts
+            self.auth = auth if auth is not None else Authentication(password)
+            self.email_hash = hash_email(self.email)
+            self.enc_name, self.enc_contacts = None, None
 
     def __eq__(self, other):
         return self.name == other.name
 
     def make_dict(self):
-        self.email_hash = SHA256.new(self.email.encode()).hexdigest()
-        self.encrypt_name_contacts()
+        # users that haven't logged in since the file was loaded can only be written back as they were read
+        if self.email is not None:
+            self.email_hash = hash_email(self.email)
+            self.encrypt_name_contacts()
         return {
-            "name": self.enc_name,
-            "email": self.email_hash,
-            "contacts": self.enc_contacts,
+            "name": base64.b64encode(self.enc_name).decode('utf-8'),
+            "email": self.email_hash.hex(),
+            "contacts": base64.b64encode(self.enc_contacts).decode('utf-8'),
             "auth": self.auth.make_dict()
         }
 
@@ -119,78 +229,170 @@ class ClientData:
         if self.email is None:
             raise RuntimeError("Encrypt: A email/key must be provided")
         enc = AESWrapper(self.email)
-        self.enc_name = enc.encrypt(self.name)
+        self.enc_name = enc.encrypt_bytes(self.name)
         dump = json.dumps(self.contacts)
-        self.enc_contacts = enc.encrypt(dump)
+        self.enc_contacts = enc.encrypt_bytes(dump)
 
     def decrypt_name_contacts(self):
         if self.email is None:
             raise RuntimeError("Decrypt: A email/key must be provided")
         enc = AESWrapper(self.email)
-        self.name = enc.decrypt(self.enc_name)
-        self.contacts = json.loads(enc.decrypt(self.enc_contacts))
+        self.name = enc.decrypt_bytes(self.enc_name)
+        self.contacts = {
+            sys.intern(email): name
+            for email, name in json.loads(enc.decrypt_bytes(self.enc_contacts)).items()
+        }
 
 
 class RegisteredUsers:
-    users = dict()
+    # users by hash_email() of their email
+    users: dict
     filename: str
 
+    # The file may be shared by several server processes (see ServerSupervisor), so reads and writes hold a lock on
+    # the file's directory, writes merge with what is on disk and unknown users are reloaded on demand.
+
     def __init__(self, filename):
         self.filename = filename
-        if os.path.exists(filename):
-            with open(filename, 'r') as f:
-                jdict = json.load(f)
-                for email, cd in jdict.items():
-                    self.users[email] = ClientData(jdict=cd)
+        self.users = dict()
+        self.reload()
+
+    @contextlib.contextmanager
+    def locked(self, operation):
+        fd = os.open(os.path.dirname(os.path.abspath(self.filename)), os.O_RDONLY)
+        try:
+            fcntl.flock(fd, operation)
+            yield
+        finally:
+            os.close(fd)
+
+    def read_json(self):
+        if not os.path.exists(self.filename):
+            return dict()
+        with open(self.filename, 'r') as f:
+            return json.load(f)
+
+    def merge(self, jdict):
+        for email, cd in jdict.items():
+            email_hash = bytes.fromhex(email)
+            if email_hash not in self.users:
+                self.users[email_hash] = ClientData(jdict=cd)
+
+    def reload(self):
+        with self.locked(fcntl.LOCK_SH):
+            self.merge(self.read_json())
 
     def make_dict(self):
-        return {email: data.make_dict() for email, data in self.users.items()}
+        return {email_hash.hex(): data.make_dict() for email_hash, data in self.users.items()}
 
     def write_json(self):
-        with open(self.filename, 'w') as f:
-            json.dump(self.make_dict(), f)
-
-    def register_new_user(self, name, email, password):
-        valid_email = validate_and_normalize_email(email)
-        if valid_email is None:
-            return "Invalid Email Address."
-        email_hash = SHA256.new(valid_email.encode()).hexdigest()
-        if email_hash in self.users:
-            return "User already exists."
-        self.users[email_hash] = ClientData(name=name, email=valid_email, password=password, contacts=dict())
-        self.write_json()
-        log.info("User Registered.")
-        return ""
+        with Timer(DB_WRITE_SECONDS.labels()), self.locked(fcntl.LOCK_EX):
+            jdict = self.read_json()
+            # users that are only known encrypted may have been changed by another process since we read them
+            jdict.update({
+                email_hash.hex(): data.make_dict()
+                for email_hash, data in self.users.items() if data.email is not None
+            })
+            tmp_filename = self.filename + ".tmp"
+            with open(tmp_filename, 'w') as f:
+                json.dump(jdict, f)
+            os.replace(tmp_filename, self.filename)
+        self.merge(jdict)
+
+    def register_new_user(self, name, email, password, auth=None):
+        # auth, if given, is the already derived Authentication of password
+        return self.register_new_users([(name, email, password, auth)])[0]
+
+    def register_new_users(self, entries):
+        # Registers (name, email, password, auth) entries, where auth may be None, with a single write of the file.
+        # Returns a message per entry, empty for those that were registered.
+        messages, registered, reloaded = [], 0, False
+        for name, email, password, auth in entries:
+            valid_email = validate_and_normalize_email(email)
+            if valid_email is None:
+                messages.append("Invalid Email Address.")
+                continue
+            email_hash = hash_email(valid_email)
+            if email_hash not in self.users and not reloaded:
+                # another process may have registered it meanwhile
+                self.reload()
+                reloaded = True
+            if email_hash in self.users:
+                messages.append("User already exists.")
+                continue
+            self.users[email_hash] = ClientData(name=name,
+                                                email=valid_email,
+                                                password=password,
+                                                contacts=dict(),
+                                                auth=auth)
+            messages.append("")
+            registered += 1
+        if registered:
+            self.write_json()
+            log.info("{} User(s) Registered.".format(registered))
+        return messages
+
+    def get_salt(self, email):
+        email_hash = hash_email(email)
+        if email_hash not in self.users:
+            self.reload()
+        return self.users[email_hash].auth.salt if email_hash in self.users else None
 
-    def login(self, email, password):
-        email_hash = SHA256.new(email.encode()).hexdigest()
+    def login(self, email, password, auth=None):
+        # auth, if given, is the already derived Authentication of password with the user's salt, see get_salt
+        email_hash = hash_email(email)
+        if email_hash not in self.users:
+            self.reload()
         if email_hash not in self.users:
             log.info("Email and Password Combination Invalid.")
             return "Email and Password Combination Invalid."
 
         user = self.users[email_hash]
-        auth = Authentication(str(password), user.auth.salt)
+        if auth is None:
+            auth = Authentication(str(password), user.auth.salt)
         if auth != self.users[email_hash].auth:
             log.info("Email and Password Combination Invalid.")
             return "Email and Password Combination Invalid."
 
-        user.email = email
+        user.email = sys.intern(email)
+        user.decrypt_name_contacts()
+        return ""
+
+    def resume(self, email):
+        # logs in a user that the server vouches for without a password, see Server.resume()
+        email_hash = hash_email(email)
+        if email_hash not in self.users:
+            self.reload()
+        if email_hash not in self.users:
+            return "User not found."
+        user = self.users[email_hash]
+        user.email = sys.intern(email)
         user.decrypt_name_contacts()
         return ""
 
     def add_contact(self, email, contact_name, contact_email):
-        valid_contact_email = validate_and_normalize_email(contact_email)
-        if not valid_contact_email:
-            return "Invalid Email Address."
-        if not contact_name:
-            return "Invalid contact name."
-        email_hash = SHA256.new(email.encode()).hexdigest()
+        return self.add_contacts(email, [(contact_name, contact_email)])[0]
+
+    def add_contacts(self, email, contacts):
+        # Adds (name, email) pairs to the user's contacts with a single write of the file. Returns a message per
+        # contact, empty for those that were added.
+        email_hash = hash_email(email)
         user = self.users[email_hash]
         if not user.contacts:
             user.contacts = dict()
-        user.contacts[valid_contact_email] = contact_name
-        self.write_json()
-        return ""
+        messages = []
+        for contact_name, contact_email in contacts:
+            valid_contact_email = validate_and_normalize_email(contact_email)
+            if not valid_contact_email:
+                messages.append("Invalid Email Address.")
+            elif not contact_name:
+                messages.append("Invalid contact name.")
+            else:
+                user.contacts[sys.intern(valid_contact_email)] = contact_name
+                messages.append("")
+        if "" in messages:
+            self.write_json()
+        return messages
 
     def contacts_contains(self, user1_email, user2_email):
         valid_contact_email1 = validate_and_normalize_email(user1_email)
@@ -198,26 +400,114 @@ class RegisteredUsers:
         if not valid_contact_email1 or not valid_contact_email2:
             return "Invalid Email Address."
 
-        email1_hash = SHA256.new(valid_contact_email1.encode()).hexdigest()
+        email1_hash = hash_email(valid_contact_email1)
         user = self.users[email1_hash]
         return user.contacts and valid_contact_email2 in user.contacts
 
     def get_contacts(self, email):
         if not email:
             return "Invalid email address"
-        email_hash = SHA256.new(email.encode()).hexdigest()
+        email_hash = hash_email(email)
         return self.users[email_hash].contacts if email_hash in self.users else dict()
 
 
+class ContactView:
+    # The contacts a user was last sent by list_contacts, at a version that goes up each time they change, and the
+    # changes of the last CONTACT_VIEW_HISTORY versions. A client that kept the list at some version gets the changes
+    # since then, or nothing if there are none, instead of the whole list. The epoch tells views apart, so that a
+    # version of a view the server no longer has (e.g. after a restart) is never taken for one of the current view.
+
+    def __init__(self, history=CONTACT_VIEW_HISTORY):
+        self.epoch = base64.b64encode(get_random_bytes(12)).decode("ascii")
+        self.version = 0
+        self.contacts = dict()
+        # (version, added, removed) for each of the last versions
+        self.changes = deque(maxlen=history)
+
+    def update(self, contacts):
+        added = {email: name for email, name in contacts.items() if self.contacts.get(email) != name}
+        removed = [email for email in self.contacts if email not in contacts]
+        if added or removed:
+            self.version += 1
+            self.changes.append((self.version, added, removed))
+            self.contacts = contacts
+
+    def changes_since(self, epoch, version):
+        # (added, removed) that turn the list at version into the current one, or None if they aren't known
+        if epoch != self.epoch or version is None or not 0 <= version <= self.version:
+            return None
+        if version < self.version and (not self.changes or self.changes[0][0] > version + 1):
+            return None
+        net = dict()
+        for changed_version, added, removed in self.changes:
+            if changed_version > version:
+                net.update(dict.fromkeys(removed))
+                net.update(added)
+        return {email: name for email, name in net.items() if name is not None}, \
+            [email for email, name in net.items() if name is None]
+
+    def response(self, epoch, version):
+        changes = self.changes_since(epoch, version)
+        if changes is None or sum(map(len, changes)) >= max(1, len(self.contacts)):
+            # the whole list is no larger than the changes
+            LIST_CONTACTS_RESPONSES.labels("full").inc()
+            return ListContactsResponsePackets(self.contacts, self.epoch, self.version)
+        LIST_CONTACTS_RESPONSES.labels("changes" if any(changes) else "not_modified").inc()
+        return ListContactsResponsePackets(epoch=self.epoch, version=self.version, added=changes[0], removed=changes[1])
+
+
+class Session:
+    # A connection to this server process and what the server keeps for it
+
+    __slots__ = ("stream", "address", "email", "accepted", "contact_view")
+
+    def __init__(self, stream, address):
+        self.stream, self.address = stream, address
+        # of the user that logged in on this connection, if any
+        self.email = None
+        # the request the user accepted last, until it sends the port to pass on: the sender, token and Timer
+        self.accepted = None
+        # the user's contact list as last sent, if the client keeps it, see ContactView
+        self.contact_view = None
+
+
+class Resumable:
+    # A user that was online on the server this one took over from, until it logs in again, see Server.import_state()
+
+    __slots__ = ("token", "accepted", "timer", "queued", "forwarded")
+
+    def __init__(self, token, accepted, timer):
+        self.token, self.timer = token, timer
+        # the sender and token of the request the user accepted and hasn't sent the port for, if any
+        self.accepted = accepted
+        # what was delivered to the user meanwhile, and what the user sent the old server too late, see on_forwarded()
+        self.queued = []
+        self.forwarded = []
+
+
 class Server(ServerBase):
-    def __init__(self, filename):
+    def __init__(self, filename, directory=None):
         self.users = RegisteredUsers(filename)
-        self.email_to_sock = dict()
-        self.sock_to_email = dict()
-        self.sock_to_address = dict()
-        self.file_transfer_requests = dict()
-        self.file_transfer_recipients = dict()
-        super().__init__()
+        # Session of each connection to this process, and of the one each user logged in on last
+        self.sessions = dict()
+        self.online = dict()
+        # who is online and pending file transfer requests, possibly shared with other server processes
+        self.directory = directory if directory is not None else LocalSessionDirectory()
+        self.directory.on_deliver = self.deliver_local
+        # sender -> recipient -> Timer that expires the sender's pending request to recipient
+        self.request_timers = dict()
+        self.request_timeout, self.token_timeout = DEFAULT_REQUEST_TIMEOUT, DEFAULT_TOKEN_TIMEOUT
+        # users that may log in with a resume token instead of their password, see import_state(), and the tokens of
+        # the users online here, once handed over to another server, see export_state()
+        self.resumable = dict()
+        self.resume_timeout = DEFAULT_RESUME_TIMEOUT
+        self.resume_tokens = dict()
+        self.kdf = KeyDerivation()
+        super().__init__(max_message_size=DEFAULT_MAX_MESSAGE_SIZE,
+                         max_message_sizes=MAX_MESSAGE_SIZES,
+                         memory_budget=MemoryBudget(DEFAULT_MEMORY_BUDGET),
+                         packet_types=PACKET_TYPES,
+                         idle_timeout=DEFAULT_IDLE_TIMEOUT)
 
     async def on_data_received(self, data, stream):
         await super().on_data_received(data, stream)
@@ -233,8 +523,10 @@ class Server(ServerBase):
             await self.process_login(LoginPackets(data=data), stream)
         elif prefix == ADD_CONTACT_PACKETS_NAME:
             await self.add_contact(AddContactPackets(data=data), stream)
+        elif prefix == ADD_CONTACTS_PACKETS_NAME:
+            await self.add_contacts(AddContactsPackets(data=data), stream)
         elif prefix == LIST_CONTACTS_PACKETS_NAME:
-            await self.list_contacts(stream)
+            await self.list_contacts(ListContactsPackets(data=data), stream)
         elif prefix == FILE_TRANSFER_REQUEST_TRANSFER_PACKETS_NAME:
             await self.process_file_transfer_request(FileTransferRequestPackets(data=data), stream)
         elif prefix == FILE_TRANSFER_CHECK_REQUESTS_PACKETS_NAME:
@@ -246,82 +538,288 @@ class Server(ServerBase):
 
     async def on_stream_accepted(self, stream, address):
         await super().on_stream_accepted(stream, address)
-        self.sock_to_address[stream] = address
+        self.sessions[stream] = Session(stream, address)
 
     async def on_stream_closed(self, stream, address):
         await super().on_stream_closed(stream, address)
-        if stream not in self.sock_to_email:
+        session = self.sessions.pop(stream, None)
+        if session is None or session.email is None or self.handed_off:
+            # users that were handed over to another server are still online there
             return
-        email = self.sock_to_email[stream]
-        del self.sock_to_email[stream]
-        del self.email_to_sock[email]
-        del self.sock_to_address[stream]
+        email = session.email
+        if session.accepted is not None:
+            sender_email, _, timer = session.accepted
+            timer.cancel()
+            await self.fail_request(sender_email, email, "User [{}] went offline".format(email))
+        if self.online.get(email) is session:
+            del self.online[email]
+            await self.directory.disconnect(email)
+            await self.drop_requests(email)
         log.info("removed {} from online connections".format(email))
 
+    async def drop_requests(self, email):
+        # requests from a user that is gone can't be answered, and those to them won't be
+        for recipient_email, timer in self.request_timers.pop(email, dict()).items():
+            timer.cancel()
+            await self.directory.pop_requests(recipient_email, email)
+        for sender_email in (await self.directory.pop_requests(email)).keys():
+            await self.fail_request(sender_email, email, "User [{}] went offline".format(email))
+
+    def email_of(self, stream):
+        email = self.sessions[stream].email
+        if email is None:
+            raise RuntimeError("Not logged in")
+        return email
+
     async def write_status(self, stream, msg):
         await self.write(stream, bytes(StatusPackets(msg)))
 
-    async def write_list_contacts_response(self, stream, contacts_dict):
-        await self.write(stream, bytes(ListContactsResponsePackets(contacts_dict)))
+    async def deliver(self, email, data):
+        # writes data to a user that is connected to this or, through the session directory, to another process
+        if email in self.online:
+            await self.write(self.online[email].stream, data)
+        elif email in self.resumable:
+            self.resumable[email].queued.append(data)
+        elif not await self.directory.deliver(email, data):
+            log.error("Could not deliver data to {}: not online".format(email))
+
+    async def deliver_local(self, email, data):
+        if email in self.online:
+            await self.write(self.online[email].stream, data)
+
+    def drop_request_timer(self, sender_email, recipient_email):
+        timers = self.request_timers.get(sender_email, dict())
+        timer = timers.pop(recipient_email, None)
+        if timer is not None:
+            timer.cancel()
+        if not timers:
+            self.request_timers.pop(sender_email, None)
+
+    async def fail_request(self, sender_email, recipient_email, msg):
+        # tells the sender that its request to recipient failed, like a denied one
+        self.drop_request_timer(sender_email, recipient_email)
+        await self.deliver(sender_email, bytes(FileTransferSendPortTokenPackets(0, b"", recipient_email, msg)))
+
+    async def expire_request(self, recipient_email, sender_email):
+        if await self.directory.pop_requests(recipient_email, sender_email):
+            await self.fail_request(
+                sender_email, recipient_email,
+                "User [{}] did not answer the file transfer request in time".format(recipient_email))
+        else:
+            # it was answered, by a recipient connected to another worker
+            self.drop_request_timer(sender_email, recipient_email)
+
+    def schedule_request_timer(self, sender_email, recipient_email, timeout):
+        # replaces the timer of an earlier request to the same recipient, which the new one replaced as well
+        self.drop_request_timer(sender_email, recipient_email)
+        self.request_timers.setdefault(sender_email, dict())[recipient_email] = self.timers.schedule(
+            timeout,
+            IOLoop.current().spawn_callback, self.expire_request, recipient_email, sender_email)
+
+    async def accept_request(self, session, sender_email, token):
+        # the user of session has token_timeout seconds to send the port for the request of sender it accepted
+        if session.accepted is not None:
+            # the server keeps a single accepted request per connection, the one accepted before won't get its port
+            displaced_email, _, displaced_timer = session.accepted
+            session.accepted = None
+            displaced_timer.cancel()
+            if displaced_email != sender_email:
+                await self.fail_request(
+                    displaced_email, session.email,
+                    "User [{}] accepted another file transfer request instead".format(session.email))
+        timer = self.timers.schedule(self.token_timeout, IOLoop.current().spawn_callback, self.expire_token, session)
+        session.accepted = (sender_email, token, timer)
+
+    async def expire_token(self, session):
+        if session.accepted is not None:
+            sender_email, _, _ = session.accepted
+            session.accepted = None
+            await self.fail_request(sender_email, session.email,
+                                    "User [{}] did not start the file transfer in time".format(session.email))
+
+    async def add_online(self, email, stream):
+        session = self.sessions[stream]
+        session.email = sys.intern(email)
+        self.online[session.email] = session
+        await self.directory.connect(session.email, session.address[0], self.users.get_contacts(email).keys())
+        log.info("added {} to online connections".format(email))
 
     async def process_register(self, reg, stream):
-        msg = self.users.register_new_user(reg.name, reg.email, reg.password)
+        auth = await self.kdf.authentication(reg.password)
+        msg = self.users.register_new_user(reg.name, reg.email, reg.password, auth)
         if msg == "":
-            self.email_to_sock[reg.email] = stream
-            self.sock_to_email[stream] = reg.email
-            log.info("added {} to online connections".format(reg.email))
+            await self.add_online(reg.email, stream)
         await self.write_status(stream, msg)
 
     async def process_login(self, login, stream):
-        msg = self.users.login(login.email, login.password)
+        if login.resume is not None:
+            await self.resume(login.email, login.resume, stream)
+            return
+        salt = self.users.get_salt(login.email)
+        auth = await self.kdf.authentication(str(login.password), salt) if salt is not None else None
+        msg = self.users.login(login.email, login.password, auth)
+        if msg == "":
+            await self.add_online(login.email, stream)
+        await self.write_status(stream, msg)
+
+    async def resume(self, email, token, stream):
+        # logs in a user that was online on the server this one took over from, with the token it got from there
+        resumable = self.resumable.get(email)
+        try:
+            valid = resumable is not None and hmac.compare_digest(resumable.token, base64.b64decode(token))
+        except (ValueError, TypeError):
+            valid = False
+        if not valid:
+            await self.write_status(stream, "Session expired, log in again.")
+            return
+        del self.resumable[email]
+        resumable.timer.cancel()
+        msg = self.users.resume(email)
         if msg == "":
-            self.email_to_sock[login.email] = stream
-            self.sock_to_email[stream] = login.email
-            log.info("added {} to online connectionds".format(login.email))
+            await self.add_online(email, stream)
+            if resumable.accepted is not None:
+                await self.accept_request(self.sessions[stream], *resumable.accepted)
         await self.write_status(stream, msg)
+        if msg != "":
+            return
+        # what follows doesn't answer the login, so it mustn't be tagged as its reply
+        current_request.set(None)
+        for data in resumable.queued:
+            await self.write(stream, data)
+        for data in resumable.forwarded:
+            await self.on_data_received(data, stream)
+
+    async def expire_resumable(self, email):
+        resumable = self.resumable.pop(email, None)
+        if resumable is None:
+            return
+        if resumable.accepted is not None:
+            await self.fail_request(resumable.accepted[0], email, "User [{}] went offline".format(email))
+        await self.drop_requests(email)
+
+    async def export_state(self):
+        # Pending file transfer requests, with the seconds left to answer them, and the users online here, with a
+        # token to log in to the next server with and the request they accepted, if they haven't sent the port yet.
+        # Only a LocalSessionDirectory is handed over; workers share theirs through the supervisor.
+        requests = []
+        for recipient_email, senders in self.directory.requests.items():
+            for sender_email, file_info in senders.items():
+                timer = self.request_timers.get(sender_email, dict()).get(recipient_email)
+                timeout = self.timers.remaining(timer) if timer is not None else self.request_timeout
+                requests.append({
+                    "recipient": recipient_email,
+                    "sender": sender_email,
+                    "file_info": file_info,
+                    "timeout": timeout,
+                })
+        sessions = dict()
+        for email, session in self.online.items():
+            token = self.resume_tokens[email] = get_random_bytes(32)
+            sessions[email] = {"token": base64.b64encode(token).decode('utf-8')}
+            if session.accepted is not None:
+                sender_email, accepted_token, _ = session.accepted
+                sessions[email]["accepted"] = {
+                    "sender": sender_email,
+                    "token": base64.b64encode(accepted_token).decode('utf-8')
+                }
+        return {"requests": requests, "sessions": sessions}
+
+    async def import_state(self, state):
+        for request in state.get("requests", []):
+            await self.directory.add_request(request["recipient"], request["sender"], request["file_info"])
+            self.schedule_request_timer(request["sender"], request["recipient"], request["timeout"])
+        for email, session in state.get("sessions", dict()).items():
+            accepted = session.get("accepted")
+            if accepted is not None:
+                accepted = (accepted["sender"], base64.b64decode(accepted["token"]))
+            timer = self.timers.schedule(self.resume_timeout,
+                                         IOLoop.current().spawn_callback, self.expire_resumable, email)
+            self.resumable[email] = Resumable(base64.b64decode(session["token"]), accepted, timer)
+        log.info("Server imported {} request(s) and {} session(s)".format(len(state.get("requests", [])),
+                                                                          len(self.resumable)))
+
+    async def on_handed_off(self):
+        # tells the users online here to log in to the new server, which imported the tokens
+        for email, session in self.online.items():
+            try:
+                token = base64.b64encode(self.resume_tokens[email]).decode('utf-8')
+                await self.write(session.stream, bytes(ResumePackets(token)))
+            except StreamClosedError:
+                pass
+
+    def forwarding_key(self, stream):
+        session = self.sessions.get(stream)
+        return session.email if session is not None else None
+
+    async def on_forwarded(self, email, data):
+        # e.g. the port for an accepted request or a deny, which the user sent before being told to reconnect
+        if email in self.online:
+            await self.on_data_received(data, self.online[email].stream)
+        elif email in self.resumable:
+            self.resumable[email].forwarded.append(data)
 
     async def add_contact(self, addc, stream):
-        msg = self.users.add_contact(self.sock_to_email[stream], addc.name, addc.email)
+        email = self.email_of(stream)
+        msg = self.users.add_contact(email, addc.name, addc.email)
+        if msg == "":
+            await self.directory.update_contacts(email, self.users.get_contacts(email).keys())
         await self.write_status(stream, msg)
 
-    async def list_contacts(self, stream):
+    async def add_contacts(self, addcs, stream):
+        email = self.email_of(stream)
+        messages = self.users.add_contacts(email, addcs.contacts)
+        if "" in messages:
+            await self.directory.update_contacts(email, self.users.get_contacts(email).keys())
+        await self.write(stream, bytes(BatchStatusPackets(messages)))
+
+    async def list_contacts(self, lcp, stream):
         # three verification steps
-        current_user_email = self.sock_to_email[stream]
+        current_user_email = self.email_of(stream)
         # 1: contacts_dict contains the names and email adresses that a user has added
         contacts_dict = self.users.get_contacts(current_user_email)
         contacts_dict_send = dict()
 
+        # 3: check if the user is online.
+        online = await self.directory.lookup(contacts_dict.keys())
         for email, name in contacts_dict.items():
             # 2: check if a user's contacts have also added the current user as a contact.
-            # 3: check if the user is online.
-            if email in self.email_to_sock and current_user_email in self.users.get_contacts(email):
+            if email in online and current_user_email in online[email]["contacts"]:
                 contacts_dict_send[email] = name
 
-        await self.write_list_contacts_response(stream, contacts_dict_send)
+        if lcp.epoch is None:
+            # clients that don't keep the list get all of it
+            LIST_CONTACTS_RESPONSES.labels("full").inc()
+            await self.write(stream, bytes(ListContactsResponsePackets(contacts_dict_send)))
+            return
+        session = self.sessions[stream]
+        if session.contact_view is None:
+            session.contact_view = ContactView()
+        view = session.contact_view
+        view.update(contacts_dict_send)
+        await self.write(stream, bytes(view.response(lcp.epoch, lcp.version)))
 
     # 1. `X -> Y/F -> S`: X wants to send F to Y
     async def process_file_transfer_request(self, ftrp, stream):
-        sender_email = self.sock_to_email[stream]
+        sender_email = self.email_of(stream)
+        host = self.sessions[stream].address[0]
         recipient_email = ftrp.recipient_email
+        recipient = (await self.directory.lookup([recipient_email])).get(recipient_email)
         msg = ""
-        if recipient_email not in self.email_to_sock:
+        if recipient is None:
             msg = "User [{}] is not online".format(recipient_email)
-        elif not self.users.contacts_contains(recipient_email, sender_email):
+        elif sender_email not in recipient["contacts"]:
             msg = "User [{}] has not added you as a contact".format(recipient_email)
-        elif self.sock_to_address[stream][0] != self.sock_to_address[self.email_to_sock[recipient_email]][0]:
-            msg = "User [{}] is not on the same network [{}] as you".format(recipient_email,
-                                                                            self.sock_to_address[stream][0])
+        elif host != recipient["host"]:
+            msg = "User [{}] is not on the same network [{}] as you".format(recipient_email, host)
         else:
-            if recipient_email not in self.file_transfer_requests:
-                self.file_transfer_requests[recipient_email] = dict()
-            self.file_transfer_requests[recipient_email][self.sock_to_email[stream]] = ftrp.file_info
+            await self.directory.add_request(recipient_email, sender_email, ftrp.file_info)
+            self.schedule_request_timer(sender_email, recipient_email, self.request_timeout)
         await self.write_status(stream, msg)
 
     # 2. `Y -> S`: every one second, Y asks server for any requests
     # 3. `S -> X/F -> Y`: server responds with active requests
     async def send_active_file_transfer_requests(self, stream):
-        email = self.sock_to_email[stream]
-        requests = self.file_transfer_requests[email] if email in self.file_transfer_requests else dict()
+        requests = await self.directory.get_requests(self.email_of(stream))
         await self.write(stream, bytes(FileTransferCheckRequestsPackets(requests)))
 
     # 5. `S -> Token -> Y`: if Y accepted, server sends a unique token Y
@@ -329,30 +827,146 @@ class Server(ServerBase):
     async def process_file_transfer_request_accept(self, ftar, stream):
         deny = not ftar.sender_email
         token = get_random_bytes(32) if not deny else b""
+        recipient_email = self.email_of(stream)
+        session = self.sessions[stream]
         if deny:
-            for sender_email in self.file_transfer_requests[self.sock_to_email[stream]].keys():
-                await self.write(self.email_to_sock[sender_email], bytes(FileTransferSendPortTokenPackets(0, token)))
-            del self.file_transfer_requests[self.sock_to_email[stream]]
+            for sender_email in (await self.directory.pop_requests(recipient_email)).keys():
+                self.drop_request_timer(sender_email, recipient_email)
+                await self.deliver(sender_email, bytes(FileTransferSendPortTokenPackets(0, token, recipient_email)))
         else:
-            del self.file_transfer_requests[self.sock_to_email[stream]][ftar.sender_email]
-            sender_sock = self.email_to_sock[ftar.sender_email]
-            self.file_transfer_recipients[stream] = {"token": token, "sender": sender_sock}
+            await self.directory.pop_requests(recipient_email, ftar.sender_email)
+            self.drop_request_timer(ftar.sender_email, recipient_email)
+            await self.accept_request(session, ftar.sender_email, token)
             await self.write(stream, bytes(FileTransferSendTokenPackets(token)))
 
     # 6. `Y -> Port -> S`: Y binds to 0 (OS chooses) and sends the port it's listening on to S
     # 7. `S -> Token/Port -> X`: S sends the same token and port to X
     async def process_file_transfer_received_port(self, ftsp, stream):
-        recipient = self.file_transfer_recipients[stream]
-        await self.write(recipient["sender"], bytes(FileTransferSendPortTokenPackets(ftsp.port, recipient["token"])))
+        session = self.sessions[stream]
+        if session.accepted is None:
+            raise RuntimeError("No accepted file transfer request")
+        sender_email, token, timer = session.accepted
+        session.accepted = None
+        timer.cancel()
+        await self.deliver(sender_email, bytes(FileTransferSendPortTokenPackets(ftsp.port, token, session.email)))
+
+
+class ServerSupervisor:
+    # Runs a Server in each of several worker processes sharing the listening port through SO_REUSEPORT, so that TLS
+    # handshakes and key derivation are spread over several cores. Workers share who is online and the pending file
+    # transfer requests through a SessionBroker that runs in the supervisor process, and store users in the same file.
+
+    def __init__(self, port, filename, workers, metrics_port=None, profile_dir=None, trace_dir=None):
+        self.port, self.filename, self.workers = int(port), filename, workers
+        # each worker serves its own metrics, on consecutive ports
+        self.metrics_port = int(metrics_port) if metrics_port is not None else None
+        # each worker dumps its own profile and trace, named after its pid
+        self.profile_dir, self.trace_dir = profile_dir, trace_dir
+        self.processes = []
+        self.worker_shutdowns = []
+
+    def reserve_port(self):
+        # bound but not listening, so it never gets connections; with port 0 this picks the port that workers share
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(("", self.port))
+        self.port = sock.getsockname()[1]
+        return sock
+
+    def run_worker(self, broker_path, shutdown, metrics_port):
+        directory = BrokerSessionDirectory(broker_path)
+        try:
+            Server(self.filename, directory).run(self.port,
+                                                 shutdown,
+                                                 reuse_port=True,
+                                                 metrics_port=metrics_port,
+                                                 profile_dir=self.profile_dir,
+                                                 trace_dir=self.trace_dir)
+        except KeyboardInterrupt:
+            log.info("Caught KeyboardInterrupt. Exiting.")
+        finally:
+            directory.close()
+
+    def run(self, shutdown=None):
+        own_shutdown = shutdown is None
+        if own_shutdown:
+            shutdown = ShutdownController()
+        broker_dir = tempfile.mkdtemp(prefix="securedrop-")
+        broker_path = os.path.join(broker_dir, "broker.sock")
+        broker_sock = bind_unix_socket(broker_path)
+        port_sock = self.reserve_port()
+        try:
+            # fork before this process has an event loop, see ServerBase.run
+            for i in range(self.workers):
+                worker_shutdown = ShutdownController()
+                metrics_port = self.metrics_port + i if self.metrics_port is not None else None
+                process = Process(target=self.run_worker, args=(broker_path, worker_shutdown, metrics_port))
+                process.start()
+                self.processes.append(process)
+                self.worker_shutdowns.append(worker_shutdown)
+            log.info("Server supervisor started {} worker(s) on port {}".format(self.workers, self.port))
+
+            asyncio.set_event_loop(asyncio.new_event_loop())
+            broker = SessionBroker()
+            broker.add_socket(broker_sock)
+            shutdown.attach(lambda: IOLoop.current().add_callback(self.stop_workers))
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                signal.signal(signum, lambda *_: shutdown.request())
+            for signum in (signal.SIGUSR1, signal.SIGUSR2):
+                signal.signal(signum, lambda signum, _: self.forward_signal(signum))
+            try:
+                IOLoop.current().start()
+            finally:
+                shutdown.detach()
+                for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGUSR1, signal.SIGUSR2):
+                    signal.signal(signum, signal.SIG_DFL)
+                broker.stop()
+        finally:
+            for process in self.processes:
+                if process.is_alive():
+                    process.terminate()
+                process.join()
+            for worker_shutdown in self.worker_shutdowns:
+                worker_shutdown.close()
+            port_sock.close()
+            shutil.rmtree(broker_dir, ignore_errors=True)
+            if own_shutdown:
+                shutdown.close()
+
+    def forward_signal(self, signum):
+        # SIGUSR1 toggles the profiler of every worker and SIGUSR2 dumps their traces, see ServerBase.run
+        for process in self.processes:
+            if process.is_alive():
+                os.kill(process.pid, signum)
+
+    async def stop_workers(self):
+        # workers drain their own in-flight requests, which may still need the broker
+        for worker_shutdown in self.worker_shutdowns:
+            worker_shutdown.request()
+        for process in self.processes:
+            await IOLoop.current().run_in_executor(None, process.join)
+        IOLoop.current().stop()
 
 
 class ServerDriver:
-    def __init__(self, port=None, filename=None):
+    def __init__(self,
+                 port=None,
+                 filename=None,
+                 workers=None,
+                 metrics_port=None,
+                 profile_dir=None,
+                 trace_dir=None,
+                 handoff_path=None):
         port = port if port is not None else DEFAULT_PORT
         filename = filename if filename is not None else DEFAULT_filename
-        self.port, self.filename = port, filename
-        self.sentinel = shared_memory.SharedMemory(create=True, size=1)
-        self.sentinel.buf[0] = 0
+        self.port, self.filename, self.workers, self.metrics_port = port, filename, workers, metrics_port
+        self.profile_dir, self.trace_dir = profile_dir, trace_dir
+        # a server started with the handoff path of a running one takes over from it, see ServerBase.hand_off()
+        if handoff_path is not None and workers:
+            raise RuntimeError("Handoff is only supported without workers")
+        self.handoff_path = handoff_path
+        # created before run() so that a parent process can stop a forked server with stop()
+        self.shutdown = ShutdownController()
 
     def __enter__(self):
         return self
@@ -360,29 +974,61 @@ class ServerDriver:
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.close()
 
-    def sentinel_name(self):
-        return self.sentinel.name
-
     def run(self):
         try:
-            server = Server(self.filename)
-            server.run(self.port, self.sentinel_name())
+            if self.workers:
+                ServerSupervisor(self.port, self.filename, self.workers, self.metrics_port, self.profile_dir,
+                                 self.trace_dir).run(self.shutdown)
+            else:
+                server = Server(self.filename)
+                server.run(self.port,
+                           self.shutdown,
+                           metrics_port=self.metrics_port,
+                           profile_dir=self.profile_dir,
+                           trace_dir=self.trace_dir,
+                           handoff_path=self.handoff_path)
         except KeyboardInterrupt:
             log.info("Caught KeyboardInterrupt. Exiting.")
         except:
             log.error("Caught exception. Exiting.")
-        finally:
-            self.sentinel.buf[0] = 1
+
+    def stop(self):
+        self.shutdown.request()
 
     def close(self):
-        self.sentinel.close()
-        self.sentinel.unlink()
+        self.shutdown.close()
 
 
-def main(port=None, filename=None):
+def import_users(filename, entries, threads=None):
+    # Admin-side bulk registration of (name, email, password) entries straight into the users file, which running
+    # servers pick up as the users log in. Keys are derived on a thread pool, see KeyDerivation, and all users are
+    # written at once. Returns a message per entry, empty for those that were registered.
+    users = RegisteredUsers(filename)
+
+    def derive(entry):
+        _, email, password = entry
+        valid_email = validate_and_normalize_email(email)
+        if valid_email is None or hash_email(valid_email) in users.users:
+            # rejected by register_new_users without deriving a key
+            return None
+        return Authentication(password)
+
+    with ThreadPoolExecutor(threads, thread_name_prefix="kdf") as executor:
+        auths = list(executor.map(derive, entries))
+    return users.register_new_users([(name, email, password, auth)
+                                     for (name, email, password), auth in zip(entries, auths)])
+
+
+def main(port=None,
+         filename=None,
+         workers=None,
+         metrics_port=None,
+         profile_dir=None,
+         trace_dir=None,
+         handoff_path=None):
     port = port if port is not None else DEFAULT_PORT
     filename = filename if filename is not None else DEFAULT_filename
-    with ServerDriver(port, filename) as driver:
+    with ServerDriver(port, filename, workers, metrics_port, profile_dir, trace_dir, handoff_path) as driver:
         driver.run()
 
 
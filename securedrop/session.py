@@ -0,0 +1,314 @@
+import asyncio
+import os
+from logging import getLogger
+
+from tornado.concurrent import Future
+from tornado.locks import Lock
+
+from securedrop.List_Contacts_Packets import ListContactsPackets
+from securedrop.List_Contacts_Response_Packets import ListContactsResponsePackets
+from securedrop.add_contact_packets import AddContactPackets, AddContactsPackets
+from securedrop.archive import archive_info, DIRECTORY
+from securedrop.client_server_base import ClientBase
+from securedrop.file_transfer_packets import FileTransferRequestPackets, FileTransferRequestResponsePackets, \
+    FileTransferCheckRequestsPackets, FileTransferAcceptRequestPackets, FileTransferSendTokenPackets, \
+    FileTransferSendPortPackets, FileTransferSendPortTokenPackets, FILE_TRANSFER_SEND_PORT_TOKEN_PACKETS_NAME
+from securedrop.login_packets import LoginPackets
+from securedrop.p2p import P2PClient, P2PServer, SharedChunks
+from securedrop.register_packets import RegisterPackets
+from securedrop.resume_packets import RESUME_PACKETS_NAME, ResumePackets
+from securedrop.status_packets import StatusPackets, BatchStatusPackets
+from securedrop.utils import sha256_file, validate_and_normalize_email
+
+# seconds between two checks for incoming file transfer requests
+DEFAULT_POLL_INTERVAL = 1
+
+log = getLogger()
+
+
+def check_status(reply):
+    # raises the message of a status packet reply, which is empty on success
+    msg = StatusPackets(data=reply[4:]).message
+    if msg != "":
+        raise RuntimeError(msg)
+
+
+def valid_email_or_raise(email):
+    valid_email = validate_and_normalize_email(email)
+    if valid_email is None:
+        raise RuntimeError("Invalid Email Address.")
+    return valid_email
+
+
+class IncomingTransfer:
+    # A pending request of sender to send a file to the session's user, see SecureDropSession.check_incoming()
+
+    def __init__(self, session, sender, file_info):
+        self.session, self.sender, self.file_info = session, sender, file_info
+        self.name, self.size, self.sha256 = file_info["name"], int(file_info["size"]), file_info["SHA256"]
+        self.directory = file_info.get("type") == DIRECTORY
+
+    @property
+    def key(self):
+        return self.sender, self.name, self.sha256
+
+    async def accept(self, out_dir, progress=None):
+        return await self.session.accept(self, out_dir, progress)
+
+    async def deny(self):
+        await self.session.deny()
+
+
+class SecureDropSession(ClientBase):
+    # The client's operations as coroutines, for scripts and pipelines that run without a terminal; the interactive
+    # Client is built on top of it. Operations raise RuntimeError with the server's message when they fail. Requests
+    # are matched to their replies by id (see ClientBase.request), so several operations may run at once on one
+    # session, e.g. sending files to several recipients:
+    #
+    #   async with SecureDropSession("127.0.0.1", 6969) as session:
+    #       await session.login("x@example.com", password)
+    #       await asyncio.gather(*(session.send_file(email, path) for email in recipients))
+    #       async for transfer in session.incoming():
+    #           await transfer.accept(out_dir)
+
+    def __init__(self, host, port, server_cert_path="server.pem"):
+        super().__init__(host, port, server_cert_path)
+        self.email = None
+        # (epoch, version, contacts) of the last contact list, see list_online()
+        self.contacts_view = ("", 0, dict())
+        # recipient -> Future of the port and token of the file transfer request sent to them, see read_pushes()
+        self.pending_sends = dict()
+        self.pushes = None
+        # the server remembers a single accepted request per connection until it gets the port to pass on
+        self.accepting = Lock()
+
+    async def __aenter__(self):
+        await self.main()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    async def main(self):
+        # connects to the server
+        await super().main()
+        self.start_reader()
+        self.pushes = asyncio.ensure_future(self.read_pushes())
+
+    def close(self):
+        if self.pushes is not None:
+            self.pushes.cancel()
+        if self.stream is not None:
+            self.stream.close()
+
+    async def read_pushes(self):
+        # 7. `S -> Token/Port -> X`: the answers to the file transfer requests this user sent, which aren't replies
+        try:
+            while True:
+                data = await self.read()
+                if data[:4] == RESUME_PACKETS_NAME:
+                    await self.resume(ResumePackets(data=data[4:]))
+                    continue
+                if data[:4] != FILE_TRANSFER_SEND_PORT_TOKEN_PACKETS_NAME:
+                    log.warning("Session ignored unexpected message {}".format(data[:4]))
+                    continue
+                packets = FileTransferSendPortTokenPackets(data=data[4:])
+                recipient = packets.recipient_email
+                if recipient not in self.pending_sends:
+                    # servers that don't name the recipient answer a single request at a time
+                    recipient = next(iter(self.pending_sends), None)
+                future = self.pending_sends.pop(recipient, None)
+                if future is not None and not future.done():
+                    future.set_result((packets.port, packets.token, packets.message))
+        except Exception as e:
+            # without pushes, e.g. once it couldn't resume on a new server, the session is of no use: fail what waits
+            # for them, and close the connection so that later requests fail too
+            for future in self.pending_sends.values():
+                if not future.done():
+                    future.set_exception(e)
+            self.pending_sends.clear()
+            if self.reader_error is None:
+                self.reader_error = e
+            if self.stream is not None:
+                self.stream.close()
+
+    async def resume(self, packets):
+        # the server handed over to a new one, see Server.on_handed_off(): log in there with the token and send the
+        # requests without replies that the old one ignored; it forwarded the other messages
+        check_status(await self.reconnect(bytes(LoginPackets(self.email, resume=packets.token))))
+        log.info("Session resumed on the new server")
+
+    async def register(self, name, email, password):
+        # registers a new user and logs in as them
+        valid_email = valid_email_or_raise(email)
+        if not name or not password:
+            raise RuntimeError("Empty input")
+        check_status(await self.request(bytes(RegisterPackets(name, valid_email, password))))
+        self.email = valid_email
+        self.contacts_view = ("", 0, dict())
+        return valid_email
+
+    async def login(self, email, password):
+        check_status(await self.request(bytes(LoginPackets(email, password))))
+        self.email = email
+        self.contacts_view = ("", 0, dict())
+        return email
+
+    async def add_contact(self, name, email):
+        valid_email = valid_email_or_raise(email)
+        if not name:
+            raise RuntimeError("Empty name input.")
+        check_status(await self.request(bytes(AddContactPackets(name, valid_email))))
+
+    async def add_contacts(self, contacts):
+        # adds (name, email) pairs in one request; returns a message per pair, empty for those that were added
+        contacts = list(contacts)
+        if not contacts:
+            return []
+        return BatchStatusPackets(data=(await self.request(bytes(AddContactsPackets(contacts))))[4:]).messages
+
+    async def list_online(self):
+        # email -> name of the contacts that are online and have added this user as a contact
+        # the server only sends what changed since the list this session got last
+        epoch, version, contacts = self.contacts_view
+        reply = ListContactsResponsePackets(data=(await self.request(bytes(ListContactsPackets(epoch, version))))[4:])
+        contacts = reply.apply(contacts)
+        if reply.epoch is not None and (reply.epoch != self.contacts_view[0] or reply.version >= self.contacts_view[1]):
+            self.contacts_view = (reply.epoch, reply.version, contacts)
+        return dict(contacts)
+
+    @staticmethod
+    def file_info(path, hash_sinks=()):
+        if not os.path.exists(path):
+            raise RuntimeError("Cannot find file: {}".format(path))
+        if os.path.isdir(path):
+            # sent as one stream of all files in it, see archive.py
+            info = archive_info(path)
+            return {
+                "name": os.path.basename(path),
+                "size": info["size"],
+                "SHA256": info["SHA256"],
+                "type": DIRECTORY,
+                "files": info["files"],
+            }
+        if not os.path.isfile(path):
+            raise RuntimeError("Not a file or directory: {}".format(path))
+        return {
+            "name": os.path.basename(path),
+            "size": os.path.getsize(path),
+            "SHA256": sha256_file(path, list(hash_sinks)),
+        }
+
+    async def request_transfer(self, recipient, file_info):
+        # asks recipient to accept the file and returns the port and token to send it with
+        valid_email = valid_email_or_raise(recipient)
+        if valid_email in self.pending_sends:
+            raise RuntimeError("A file transfer request to {} is pending already".format(valid_email))
+
+        # 1. `X -> Y/F -> S`: X wants to send F to Y
+        # the answer may overtake the status reply, so wait for it first
+        answer = self.pending_sends[valid_email] = Future()
+        try:
+            # this only checks if the request is valid, not if the recipient accepted it
+            check_status(await self.request(bytes(FileTransferRequestPackets(valid_email, file_info))))
+            # denied request is indicated by empty token and port
+            port, token, message = await answer
+        finally:
+            if self.pending_sends.get(valid_email) is answer:
+                del self.pending_sends[valid_email]
+        if not token or not port:
+            if message:
+                raise RuntimeError(message)
+            raise RuntimeError("User {} declined the file transfer request".format(valid_email))
+        log.debug("User {} accepted the file transfer, connecting on port {}".format(valid_email, port))
+        return port, token
+
+    async def send_file(self, recipient, path, progress=None, hash_sinks=()):
+        # Sends the file or directory at path once recipient accepts it; progress counts the bytes sent and hash_sinks
+        # get the progress of hashing the file first. Raises RuntimeError when the recipient declines.
+        valid_email_or_raise(recipient)
+        path = os.path.abspath(path)
+        file_info = self.file_info(path, hash_sinks)
+        port, token = await self.request_transfer(recipient, file_info)
+        await P2PClient(port, token, path, file_info["size"], file_info["SHA256"], progress).main()
+
+    async def send_file_to_many(self, recipients, path, progress=None, hash_sinks=()):
+        # Sends the file at path to every recipient that accepts it, hashing it once and reading, compressing and
+        # encoding each chunk once for all of them, see SharedChunks. progress, if given, is called with a recipient
+        # and returns the Progress of sending to them. Returns an error message per recipient, empty for those that
+        # received the file.
+        path = os.path.abspath(path)
+        file_info = self.file_info(path, hash_sinks)
+        shared_chunks = SharedChunks(path)
+
+        async def send(recipient):
+            try:
+                port, token = await self.request_transfer(recipient, file_info)
+                await P2PClient(port,
+                                token,
+                                path,
+                                file_info["size"],
+                                file_info["SHA256"],
+                                progress(recipient) if progress is not None else None,
+                                shared_chunks=shared_chunks).main()
+            except (RuntimeError, OSError) as e:
+                return str(e)
+            return ""
+
+        try:
+            return list(await asyncio.gather(*(send(recipient) for recipient in recipients)))
+        finally:
+            shared_chunks.close()
+
+    async def check_incoming(self):
+        # 2. `Y -> S`: Y asks server for any requests
+        # 3. `S -> X/F -> Y`: server responds with active requests
+        requests = FileTransferCheckRequestsPackets(
+            data=(await self.request(bytes(FileTransferRequestResponsePackets())))[4:]).requests
+        return [IncomingTransfer(self, sender, file_info) for sender, file_info in (requests or dict()).items()]
+
+    async def incoming(self, poll_interval=DEFAULT_POLL_INTERVAL):
+        # yields each file transfer request once, as it comes in; a request that is still pending after being yielded
+        # (neither accepted nor denied) isn't yielded again
+        seen = set()
+        while True:
+            transfers = await self.check_incoming()
+            pending = set()
+            for transfer in transfers:
+                pending.add(transfer.key)
+                if transfer.key not in seen:
+                    yield transfer
+            seen = pending
+            await asyncio.sleep(poll_interval)
+
+    async def accept(self, transfer, out_dir, progress=None):
+        # receives the file or directory of transfer into out_dir and returns its path; progress counts the bytes
+        # received
+        out_path = os.path.join(out_dir, transfer.name)
+        if not os.path.isdir(out_dir):
+            raise RuntimeError("The path {} is not a directory".format(os.path.abspath(out_dir)))
+        if os.path.exists(out_path):
+            raise RuntimeError("The file {} already exists".format(out_path))
+
+        async with self.accepting:
+            # 4. `Y -> Yes/No -> S`: Y accepts or denies transfer request
+            # 5. `S -> Token -> Y`: if Y accepted, server sends a unique token Y
+            token = FileTransferSendTokenPackets(
+                data=(await self.request(bytes(FileTransferAcceptRequestPackets(transfer.sender))))[4:]).token
+
+            # 6. `Y -> Port -> S`: Y binds to 0 (OS chooses) and sends the port it's listening on to S
+            p2p_server = P2PServer(token, os.path.abspath(out_dir), progress)
+            port = p2p_server.start(0)
+            await self.write(bytes(FileTransferSendPortPackets(port)))
+
+        try:
+            msg = await p2p_server.wait()
+        finally:
+            p2p_server.close()
+        if msg != "":
+            raise RuntimeError(msg)
+        return out_path
+
+    async def deny(self):
+        # denies every pending request, the protocol has no way to deny a single one; the server doesn't reply
+        await self.write(bytes(FileTransferAcceptRequestPackets("")))
@@ -0,0 +1,204 @@
+import base64
+import json
+import socket
+from logging import getLogger
+
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from tornado.iostream import IOStream, StreamClosedError
+from tornado.locks import Lock
+from tornado.tcpserver import TCPServer
+
+from securedrop.client_server_base import read, write
+
+log = getLogger()
+
+
+class LocalSessionDirectory:
+    # Who is online (with the host they connect from and their contacts' emails) and which file transfer requests are
+    # pending. This one serves a single server process; BrokerSessionDirectory shares the same state between workers.
+
+    def __init__(self):
+        self.sessions = dict()
+        self.requests = dict()
+        # coroutine called with (email, data) when another worker delivers data to a user connected here
+        self.on_deliver = None
+
+    async def connect(self, email, host, contacts):
+        self.sessions[email] = {"host": host, "contacts": list(contacts)}
+
+    async def disconnect(self, email):
+        self.sessions.pop(email, None)
+
+    async def update_contacts(self, email, contacts):
+        if email in self.sessions:
+            self.sessions[email]["contacts"] = list(contacts)
+
+    async def lookup(self, emails):
+        return {email: self.sessions[email] for email in emails if email in self.sessions}
+
+    async def add_request(self, recipient, sender, file_info):
+        if recipient not in self.requests:
+            self.requests[recipient] = dict()
+        self.requests[recipient][sender] = file_info
+
+    async def get_requests(self, recipient):
+        return dict(self.requests.get(recipient, dict()))
+
+    async def pop_requests(self, recipient, sender=None):
+        # removes and returns the given sender's pending request to the recipient, or all of them without a sender
+        if sender is None:
+            return self.requests.pop(recipient, dict())
+        requests = self.requests.get(recipient, dict())
+        popped = {sender: requests.pop(sender)} if sender in requests else dict()
+        if not requests:
+            self.requests.pop(recipient, None)
+        return popped
+
+    async def deliver(self, email, data):
+        # there are no other workers to deliver to
+        return False
+
+    def close(self):
+        pass
+
+
+class BrokerSessionDirectory:
+    # Worker side of the SessionBroker. Every call is a JSON message over the broker's unix socket, answered with the
+    # same request id; the broker also pushes data for users connected to this worker as "deliver" messages.
+
+    def __init__(self, path):
+        self.path = path
+        self.stream = None
+        self.connect_lock = Lock()
+        self.next_id = 0
+        self.pending = dict()
+        self.on_deliver = None
+
+    async def ensure_connected(self):
+        async with self.connect_lock:
+            if self.stream is None:
+                stream = IOStream(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM))
+                await stream.connect(self.path)
+                self.stream = stream
+                IOLoop.current().spawn_callback(self.read_messages, stream)
+
+    async def read_messages(self, stream):
+        try:
+            while True:
+                msg = json.loads(await read(stream))
+                if "id" in msg:
+                    future = self.pending.pop(msg["id"], None)
+                    if future is None:
+                        continue
+                    if "error" in msg:
+                        future.set_exception(RuntimeError("Session broker error: {}".format(msg["error"])))
+                    else:
+                        future.set_result(msg["result"])
+                elif msg["op"] == "deliver" and self.on_deliver is not None:
+                    IOLoop.current().spawn_callback(self.on_deliver, msg["email"], base64.b64decode(msg["data"]))
+        except StreamClosedError:
+            log.error("Lost connection to session broker at {}".format(self.path))
+            self.stream = None
+            pending, self.pending = self.pending, dict()
+            for future in pending.values():
+                future.set_exception(RuntimeError("Lost connection to session broker"))
+
+    async def call(self, op, **args):
+        await self.ensure_connected()
+        self.next_id += 1
+        future = Future()
+        self.pending[self.next_id] = future
+        await write(self.stream, json.dumps({"id": self.next_id, "op": op, "args": args}).encode())
+        return await future
+
+    async def connect(self, email, host, contacts):
+        await self.call("connect", email=email, host=host, contacts=list(contacts))
+
+    async def disconnect(self, email):
+        await self.call("disconnect", email=email)
+
+    async def update_contacts(self, email, contacts):
+        await self.call("update_contacts", email=email, contacts=list(contacts))
+
+    async def lookup(self, emails):
+        return await self.call("lookup", emails=list(emails))
+
+    async def add_request(self, recipient, sender, file_info):
+        await self.call("add_request", recipient=recipient, sender=sender, file_info=file_info)
+
+    async def get_requests(self, recipient):
+        return await self.call("get_requests", recipient=recipient)
+
+    async def pop_requests(self, recipient, sender=None):
+        return await self.call("pop_requests", recipient=recipient, sender=sender)
+
+    async def deliver(self, email, data):
+        return await self.call("deliver", email=email, data=str(base64.b64encode(data), encoding='ascii'))
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+
+
+class SessionBroker(TCPServer):
+    # Owns the state of a LocalSessionDirectory on behalf of all workers of a supervisor, and routes deliveries to the
+    # worker that the recipient is connected to. Listens on a unix socket, see tornado.netutil.bind_unix_socket.
+
+    OPS = {"connect", "disconnect", "update_contacts", "lookup", "add_request", "get_requests", "pop_requests"}
+
+    def __init__(self):
+        super().__init__()
+        self.directory = LocalSessionDirectory()
+        self.owners = dict()
+
+    async def handle_stream(self, stream, address):
+        log.debug("Session broker accepted worker")
+        try:
+            while True:
+                data = await read(stream)
+                try:
+                    msg = json.loads(data)
+                    request_id, op, args = msg["id"], msg["op"], msg["args"]
+                except (ValueError, KeyError, TypeError) as e:
+                    # there is no id to answer, so drop the worker, which fails its pending calls
+                    log.error("Session broker got an invalid message: {}".format(e))
+                    stream.close()
+                    raise StreamClosedError()
+                try:
+                    reply = {"id": request_id, "result": await self.dispatch(op, args, stream)}
+                except StreamClosedError:
+                    raise
+                except Exception as e:
+                    log.error("Session broker operation {} failed: {}".format(op, e))
+                    reply = {"id": request_id, "error": str(e)}
+                await write(stream, json.dumps(reply).encode())
+        except StreamClosedError:
+            # the worker is gone, and so are its users
+            for email in [email for email, owner in self.owners.items() if owner is stream]:
+                del self.owners[email]
+                await self.directory.disconnect(email)
+            log.debug("Session broker lost worker")
+
+    async def dispatch(self, op, args, stream):
+        if op == "deliver":
+            owner = self.owners.get(args["email"])
+            if owner is None:
+                return False
+            try:
+                await write(owner, json.dumps({"op": "deliver", "email": args["email"], "data": args["data"]}).encode())
+            except StreamClosedError:
+                # the owner is gone, not the worker asking
+                return False
+            return True
+        if op not in self.OPS:
+            log.error("Unknown session broker operation: {}".format(op))
+            return None
+        if op == "connect":
+            self.owners[args["email"]] = stream
+        elif op == "disconnect":
+            # the user may have logged in again on another worker in the meantime
+            if self.owners.get(args["email"]) is not stream:
+                return None
+            del self.owners[args["email"]]
+        return await getattr(self.directory, op)(**args)
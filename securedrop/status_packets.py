@@ -17,3 +17,23 @@ class StatusPackets:
 
     def __bytes__(self):
         return STATUS_PACKETS_NAME + bytes(json.dumps(self.jdict), encoding='ascii')
+
+
+BATCH_STATUS_PACKETS_NAME = b"STAB"
+
+
+class BatchStatusPackets:
+    # a status message per item of a batch, in the same order; empty messages mean success
+    def __init__(self, messages: list = None, data=None):
+        self.messages = messages
+        self.jdict = dict()
+        if data is not None:
+            self.jdict = json.loads(data)
+            self.messages = self.jdict["messages"]
+        elif messages is not None:
+            self.jdict = {
+                "messages": self.messages,
+            }
+
+    def __bytes__(self):
+        return BATCH_STATUS_PACKETS_NAME + bytes(json.dumps(self.jdict), encoding='ascii')
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+import filecmp
+import os
+import random
+import stat
+import tempfile
+import unittest
+
+from securedrop.archive import ArchiveReader, ArchiveWriter, archive_info, encode_header, FILE, DIGEST_SIZE
+
+
+class Archive(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.tmp_dir.name, "src")
+        self.dst = os.path.join(self.tmp_dir.name, "dst")
+        os.makedirs(os.path.join(self.src, "a", "b"))
+        os.mkdir(os.path.join(self.src, "empty"))
+        for i in range(50):
+            with open(os.path.join(self.src, "a" if i % 2 else "", "small{}.txt".format(i)), "wb") as f:
+                f.write(os.urandom(i * 10))
+        with open(os.path.join(self.src, "a", "b", "large.bin"), "wb") as f:
+            f.write(os.urandom(1024 * 1024))
+        os.chmod(os.path.join(self.src, "a", "small1.txt"), 0o600)
+        os.symlink("a", os.path.join(self.src, "link"))
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def copy(self, data_sizes):
+        # writes the stream of src to dst in pieces of random sizes
+        writer = ArchiveWriter(self.dst)
+        with ArchiveReader(self.src) as reader:
+            while data := reader.read(random.choice(data_sizes)):
+                writer.write(data)
+        return writer.close()
+
+    def test_round_trip(self):
+        info = archive_info(self.src)
+        self.assertEqual(info["files"], 54)
+        self.assertEqual(self.copy([1, 7, 4096, 100000]), info["SHA256"])
+        comparison = filecmp.dircmp(self.src, self.dst)
+        self.assertEqual(comparison.left_only, ["link"])
+        self.assertEqual(comparison.right_only, [])
+        self.assertTrue(os.path.isdir(os.path.join(self.dst, "empty")))
+        self.assertTrue(
+            filecmp.cmp(os.path.join(self.src, "a", "b", "large.bin"),
+                        os.path.join(self.dst, "a", "b", "large.bin"),
+                        shallow=False))
+        self.assertEqual(stat.S_IMODE(os.stat(os.path.join(self.dst, "a", "small1.txt")).st_mode), 0o600)
+
+    def test_digest_covers_contents(self):
+        info = archive_info(self.src)
+        with open(os.path.join(self.src, "a", "b", "large.bin"), "r+b") as f:
+            data = f.read(1)
+            f.seek(0)
+            f.write(bytes([data[0] ^ 1]))
+        changed = archive_info(self.src)
+        self.assertEqual(changed["size"], info["size"])
+        self.assertNotEqual(changed["SHA256"], info["SHA256"])
+
+    def test_size(self):
+        with ArchiveReader(self.src) as reader:
+            self.assertEqual(len(reader.read(10 * 1024 * 1024)), archive_info(self.src)["size"])
+
+    def test_path_outside_root(self):
+        for path in ("../evil", "/etc/evil", "a/../../evil", ""):
+            with self.subTest(path=path):
+                writer = ArchiveWriter(self.dst)
+                with self.assertRaises(RuntimeError):
+                    writer.write(encode_header({"path": path, "type": FILE, "mode": 0o644, "size": 0}))
+                os.rmdir(self.dst)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir.name, "evil")))
+
+    def test_corrupt_content(self):
+        with ArchiveReader(self.src) as reader:
+            data = bytearray(reader.read(10 * 1024 * 1024))
+        # a byte of large.bin, which is the last file in the stream, followed by its digest
+        data[-DIGEST_SIZE - 100] ^= 1
+        writer = ArchiveWriter(self.dst)
+        with self.assertRaises(RuntimeError):
+            writer.write(bytes(data))
+        writer.abort()
+        self.assertFalse(os.path.exists(self.dst))
+
+    def test_truncated(self):
+        with ArchiveReader(self.src) as reader:
+            data = reader.read(1000)
+        writer = ArchiveWriter(self.dst)
+        writer.write(data)
+        with self.assertRaises(RuntimeError):
+            writer.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
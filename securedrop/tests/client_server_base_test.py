@@ -1,14 +1,19 @@
 #!/usr/bin/env python3
 
+import signal
+import socket
 import time
 from contextlib import contextmanager
 import unittest
 import os
 from multiprocessing import Process, shared_memory
 
-from tornado.testing import AsyncTestCase
+from tornado import gen
+from tornado.iostream import IOStream, StreamClosedError
+from tornado.testing import AsyncTestCase, gen_test
 
-from securedrop.client_server_base import ClientBase, ServerBase
+from securedrop.client_server_base import ClientBase, ServerBase, ShutdownController, MemoryBudget, read, write, \
+    tag_request, split_request_id, current_request
 
 HOSTNAME = "localhost"
 PORT = 6969
@@ -48,24 +53,28 @@ class EchoServer(ServerBase):
         await self.write(stream, data)
 
 
+class SlowEchoServer(EchoServer):
+    async def on_data_received(self, data, stream):
+        await gen.sleep(1)
+        await super().on_data_received(data, stream)
+
+
 @contextmanager
-def echo_server_process():
-    sentinel = shared_memory.SharedMemory(create=True, size=1)
-    sentinel.buf[0] = 0
-    server = EchoServer()
+def echo_server_process(server_class=EchoServer):
+    shutdown = ShutdownController()
+    server = server_class()
     process = Process(target=server.run, args=(
         PORT,
-        sentinel.name,
+        shutdown,
     ))
     try:
         process.start()
         time.sleep(0.1)
         yield process
     finally:
-        sentinel.buf[0] = 1
+        shutdown.request()
         process.join()
-        sentinel.close()
-        sentinel.unlink()
+        shutdown.close()
 
 
 class EchoSingleThread(AsyncTestCase):
@@ -97,6 +106,171 @@ class EchoSingleThread(AsyncTestCase):
             sentinel.close()
             sentinel.unlink()
 
+    def test_stop_drains_in_flight_requests(self):
+        with echo_server_process(SlowEchoServer) as process:
+            sentinel = shared_memory.SharedMemory(create=True, size=8)
+            client = Process(target=AsyncEchoClient(b"draining", sentinel.name, 0, 8).run, args=(30, ))
+            client.start()
+            time.sleep(0.5)
+            os.kill(process.pid, signal.SIGTERM)
+            client.join()
+            process.join()
+            self.assertEqual(b"draining", bytes(sentinel.buf[0:8]))
+            sentinel.close()
+            sentinel.unlink()
+
+
+class MessageLimits(AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        a, b = socket.socketpair()
+        self.writer, self.reader = IOStream(a), IOStream(b)
+
+    def tearDown(self):
+        self.writer.close()
+        self.reader.close()
+        super().tearDown()
+
+    @gen_test
+    async def test_read_within_limits(self):
+        limits = {b"AAAA": 8}
+        messages = [b"", b"a", b"a\nb", b"abc", b"AAAA", b"AAA\nxyzw", b"AAAAxyzw", b"BBBB" + b"x" * 12]
+        for message in messages:
+            await write(self.writer, message)
+        for message in messages:
+            self.assertEqual(await read(self.reader, 16, limits), message)
+
+    @gen_test
+    async def test_read_over_type_limit_closes_stream(self):
+        await write(self.writer, b"AAAA" + b"x" * 5)
+        with self.assertRaises(StreamClosedError):
+            await read(self.reader, 16, {b"AAAA": 8})
+
+    @gen_test
+    async def test_read_over_default_limit_closes_stream(self):
+        await write(self.writer, b"BBBB" + b"x" * 13)
+        with self.assertRaises(StreamClosedError):
+            await read(self.reader, 16, {b"AAAA": 8})
+
+    @gen_test
+    async def test_read_without_sentinel_closes_stream(self):
+        await self.writer.write(b"x" * 1024)
+        with self.assertRaises(StreamClosedError):
+            await read(self.reader, 16)
+
+
+class Pipelining(AsyncTestCase):
+    class DelayServer(ServerBase):
+        # replies to "<seconds>" after that many seconds, and pushes an untagged "push" first for "push"
+        def __init__(self):
+            super().__init__(tls=False)
+            self.concurrent = self.max_concurrent = 0
+
+        async def on_data_received(self, data, stream):
+            self.concurrent += 1
+            self.max_concurrent = max(self.max_concurrent, self.concurrent)
+            try:
+                if data == b"push":
+                    await self.write(stream, b"push")
+                    current_request.set(None)
+                    await self.write(stream, b"pushed")
+                    return
+                await gen.sleep(float(data))
+                await self.write(stream, data)
+            finally:
+                self.concurrent -= 1
+
+    def setUp(self):
+        super().setUp()
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            self.port = sock.getsockname()[1]
+        self.server = self.DelayServer()
+        self.server.listen(self.port, "127.0.0.1")
+        self.client = ClientBase("127.0.0.1", self.port, tls=False)
+
+    def tearDown(self):
+        if self.client.stream is not None:
+            self.client.stream.close()
+        self.server.stop()
+        super().tearDown()
+
+    @gen_test
+    async def test_replies_out_of_order(self):
+        await self.client.main()
+        replies = await gen.multi([self.client.request(delay) for delay in (b"0.3", b"0.2", b"0.1", b"0")])
+        self.assertEqual(replies, [b"0.3", b"0.2", b"0.1", b"0"])
+        self.assertEqual(self.server.max_concurrent, 4)
+
+    @gen_test
+    async def test_unsolicited_messages_are_read(self):
+        await self.client.main()
+        self.assertEqual(await self.client.request(b"push"), b"push")
+        self.assertEqual(await self.client.read(), b"pushed")
+
+    @gen_test
+    async def test_untagged_messages_are_handled_in_order(self):
+        await self.client.main()
+        for delay in (b"0.2", b"0"):
+            await self.client.write(delay)
+        self.assertEqual([await self.client.read(), await self.client.read()], [b"0.2", b"0"])
+        self.assertEqual(self.server.max_concurrent, 1)
+
+    @gen_test
+    async def test_closed_stream_fails_requests(self):
+        await self.client.main()
+        request = self.client.request(b"1")
+        await gen.sleep(0.1)
+        for stream in list(self.server.streams):
+            stream.close()
+        with self.assertRaises(StreamClosedError):
+            await request
+        with self.assertRaises(StreamClosedError):
+            await self.client.request(b"0")
+
+    @gen_test
+    async def test_read_tagged_within_limits(self):
+        a, b = socket.socketpair()
+        writer, reader = IOStream(a), IOStream(b)
+        try:
+            messages = [
+                tag_request(b"AAAA" + b"x" * 4, 1),
+                tag_request(b"a", 1234567890), b"#1", b"#x AAAA", b"#12345678901 A"
+            ]
+            for message in messages:
+                await write(writer, message)
+            for message in messages:
+                self.assertEqual(await read(reader, 16, {b"AAAA": 8}), message)
+            self.assertEqual(split_request_id(messages[1]), (1234567890, b"a"))
+            self.assertEqual(split_request_id(b"AAAA"), (None, b"AAAA"))
+            await write(writer, tag_request(b"AAAA" + b"x" * 5, 1))
+            with self.assertRaises(StreamClosedError):
+                await read(reader, 16, {b"AAAA": 8})
+        finally:
+            writer.close()
+            reader.close()
+
+
+class MemoryBudgetTest(AsyncTestCase):
+    @gen_test
+    async def test_waits_for_release(self):
+        budget = MemoryBudget(10)
+        self.assertTrue(await budget.acquire(8))
+        waiter = budget.acquire(4)
+        self.io_loop.call_later(0.1, budget.release, 8)
+        self.assertTrue(await waiter)
+        self.assertEqual((budget.used, budget.peak, budget.waits), (4, 8, 1))
+
+    @gen_test
+    async def test_gives_up_after_timeout(self):
+        budget = MemoryBudget(10, timeout=0.1)
+        self.assertTrue(await budget.acquire(8))
+        self.assertFalse(await budget.acquire(4))
+        self.assertEqual((budget.used, budget.rejected), (8, 1))
+        # too large for the budget, but nothing else is in use
+        budget.release(8)
+        self.assertTrue(await budget.acquire(20))
+
 
 if __name__ == '__main__':
     unittest.main()
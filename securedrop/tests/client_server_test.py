@@ -1,17 +1,24 @@
 #!/usr/bin/env python3
 
 import os
+import queue
 import unittest
 from unittest.mock import patch
 
+from tornado import gen
+from tornado.testing import AsyncTestCase, gen_test
+
 import securedrop.client as client
-from securedrop.client import LIST_CONTACTS_TEST_FILENAME
+from securedrop.client import LIST_CONTACTS_TEST_FILENAME, Console
 from securedrop.server import ServerDriver, Server, DEFAULT_filename, AESWrapper
 import json
 import time
 import contextlib
 
-from multiprocessing import shared_memory, Process
+from multiprocessing import Process
+
+# hash_email() of email_v@test.com
+EMAIL_HASH = bytes.fromhex("e908de13f0f86b9c15f70d34cc1a5696280b3fbf822ae09343a779b19a3214b7")
 
 
 class InputSideEffect:
@@ -36,9 +43,7 @@ def server_process():
             time.sleep(1)
             yield process
         finally:
-            sentinel = shared_memory.SharedMemory(driver.sentinel_name())
-            sentinel.buf[0] = 1
-            sentinel.close()
+            driver.stop()
             process.join()
 
 
@@ -144,8 +149,8 @@ class TestRegistration(unittest.TestCase):
 
     def assert_initial_registered_users_is_valid(self, ru):
         for email, cd in ru.items():
-            self.assertEqual(email, "e908de13f0f86b9c15f70d34cc1a5696280b3fbf822ae09343a779b19a3214b7")
-            self.assertEqual(cd.email_hash, "e908de13f0f86b9c15f70d34cc1a5696280b3fbf822ae09343a779b19a3214b7")
+            self.assertEqual(email, EMAIL_HASH)
+            self.assertEqual(cd.email_hash, EMAIL_HASH)
             self.assertTrue(cd.auth.salt)
             self.assertTrue(cd.auth.key)
 
@@ -269,7 +274,7 @@ class TestRegistration(unittest.TestCase):
     def test_aaq_login_correct_password_decrypt_contact(self):
         """Ensures that client logs in successfully with correct email/password Then decrypts contacts."""
         server = Server(DEFAULT_filename)
-        user = server.users.users["e908de13f0f86b9c15f70d34cc1a5696280b3fbf822ae09343a779b19a3214b7"]
+        user = server.users.users[EMAIL_HASH]
         user.email = "email_v@test.com"
         self.assertNotEqual(user.enc_contacts, "name_v_3")
         user.decrypt_name_contacts()
@@ -280,7 +285,7 @@ class TestRegistration(unittest.TestCase):
     def test_aar_data_in_memory_after_decrypt(self):
         """Ensures that Client data can be accessed in local memory after decryption"""
         server = Server(DEFAULT_filename)
-        user = server.users.users["e908de13f0f86b9c15f70d34cc1a5696280b3fbf822ae09343a779b19a3214b7"]
+        user = server.users.users[EMAIL_HASH]
         user.email = "email_v@test.com"
         user.decrypt_name_contacts()
         self.assertEqual(user.name, "name_v")
@@ -290,11 +295,55 @@ class TestRegistration(unittest.TestCase):
     def test_aas_test_decrypt_wrong_password(self):
         """Ensures that client throws an error when decryption is not successful (wrong key)."""
         server = Server(DEFAULT_filename)
-        user = server.users.users["e908de13f0f86b9c15f70d34cc1a5696280b3fbf822ae09343a779b19a3214b7"]
+        user = server.users.users[EMAIL_HASH]
         user.email = "email_v_@test.com"
         with self.assertRaises(RuntimeError):
             user.decrypt_name_contacts()
 
 
+class TestConsole(AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        # what the user types, one line at a time
+        self.lines = queue.Queue()
+        self.patcher = patch('builtins.input', side_effect=lambda *args: self.lines.get(timeout=5))
+        self.patcher.start()
+        self.console = Console()
+
+    def tearDown(self):
+        self.patcher.stop()
+        super().tearDown()
+
+    @gen_test
+    async def test_loop_runs_while_waiting(self):
+        line = self.console.input("> ")
+        ticks = 0
+        for _ in range(5):
+            await gen.sleep(0.01)
+            ticks += 1
+        self.assertEqual(ticks, 5)
+        self.lines.put("list")
+        self.assertEqual(await line, "list")
+
+    @gen_test
+    async def test_last_asker_gets_next_line(self):
+        shell = gen.convert_yielded(self.console.input("secure_drop> "))
+        await gen.sleep(0.01)
+        question = self.console.input("Accept? ")
+        self.lines.put("1")
+        self.assertEqual(await question, "1")
+        self.assertFalse(shell.done())
+        self.lines.put("exit")
+        self.assertEqual(await shell, "exit")
+
+    @gen_test
+    async def test_eof(self):
+        self.patcher.stop()
+        self.patcher = patch('builtins.input', side_effect=EOFError)
+        self.patcher.start()
+        with self.assertRaises(EOFError):
+            await self.console.input("> ")
+
+
 if __name__ == '__main__':
     unittest.main()
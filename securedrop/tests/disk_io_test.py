@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+import asyncio
+import threading
+import time
+import unittest
+
+from tornado.testing import AsyncTestCase, gen_test
+
+from securedrop.disk_io import DiskIO, ReadAhead, WriteBehind
+
+
+class TestDiskIO(AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        self.disk_io = DiskIO(threads=2)
+
+    def tearDown(self):
+        self.disk_io.close()
+        super().tearDown()
+
+    @gen_test(timeout=10)
+    async def test_read_ahead(self):
+        read = []
+
+        def items():
+            for i in range(20):
+                read.append(i)
+                yield i
+            raise OSError("disk gone")
+
+        reader = ReadAhead(items(), self.disk_io, depth=4)
+        self.assertEqual(await reader.next(), 0)
+        # the next items are read meanwhile, but no more than depth of them
+        while len(read) < 5:
+            await reader.changed.wait()
+        time.sleep(0.05)
+        self.assertEqual(len(read), 5)
+        for i in range(1, 20):
+            self.assertEqual(await reader.next(), i)
+        with self.assertRaises(OSError):
+            await reader.next()
+
+    @gen_test(timeout=10)
+    async def test_read_ahead_close(self):
+        def items():
+            try:
+                while True:
+                    yield b"item"
+            finally:
+                closed.set()
+
+        closed = threading.Event()
+        reader = ReadAhead(items(), self.disk_io)
+        self.assertEqual(await reader.next(), b"item")
+        reader.close()
+        while not closed.is_set():
+            await asyncio.sleep(0.01)
+        self.assertIsNone(await reader.next())
+
+    @gen_test(timeout=10)
+    async def test_write_behind(self):
+        written, done = [], []
+
+        async def on_done(result, error):
+            done.append(error if error is not None else result)
+
+        def write(i):
+            time.sleep(0.01)
+            if i == 10:
+                raise RuntimeError("disk full")
+            written.append(i)
+            return i
+
+        writer = WriteBehind(on_done, self.disk_io, depth=3)
+        for i in range(5):
+            await writer.submit(write, i)
+        # submit() only waited once depth writes were pending
+        self.assertGreater(writer.waits, 0)
+        self.assertLess(len(written), 5)
+        await writer.flush()
+        self.assertEqual(written, list(range(5)))
+        self.assertEqual(done, list(range(5)))
+
+        for i in range(10, 15):
+            await writer.submit(write, i)
+        await writer.flush()
+        self.assertEqual(written, list(range(5)))
+        self.assertEqual(len(done), 6)
+        self.assertIsInstance(done[-1], RuntimeError)
+
+        closed = []
+        await writer.close(closed.append, True)
+        self.assertEqual(closed, [True])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+import socket
+import unittest
+
+from tornado.httpclient import AsyncHTTPClient
+from tornado.testing import AsyncTestCase, gen_test
+
+from securedrop.metrics import Registry, Counter, Gauge, Histogram, start_metrics_server
+
+
+class TestMetrics(AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        self.registry = Registry()
+
+    def test_counter_and_gauge(self):
+        counter = Counter("requests", "Requests.", ["type"], registry=self.registry)
+        gauge = Gauge("connections", "Connections.", registry=self.registry)
+        counter.labels("LGIN").inc()
+        counter.labels("LGIN").inc(2)
+        counter.labels("say \"hi\"").inc()
+        gauge.inc(3)
+        gauge.dec()
+        self.assertEqual(
+            self.registry.expose(), "# HELP requests Requests.\n"
+            "# TYPE requests counter\n"
+            "requests_total{type=\"LGIN\"} 3.0\n"
+            "requests_total{type=\"say \\\"hi\\\"\"} 1.0\n"
+            "# HELP connections Connections.\n"
+            "# TYPE connections gauge\n"
+            "connections 2.0\n")
+
+    def test_histogram(self):
+        histogram = Histogram("latency", "Latency.", ["type"], registry=self.registry, buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 2):
+            histogram.labels("LGIN").observe(value)
+        self.assertEqual(
+            self.registry.expose(), "# HELP latency Latency.\n"
+            "# TYPE latency histogram\n"
+            "latency_bucket{type=\"LGIN\",le=\"0.1\"} 2.0\n"
+            "latency_bucket{type=\"LGIN\",le=\"1.0\"} 3.0\n"
+            "latency_bucket{type=\"LGIN\",le=\"+Inf\"} 4.0\n"
+            "latency_sum{type=\"LGIN\"} 2.65\n"
+            "latency_count{type=\"LGIN\"} 4.0\n")
+
+    def test_duplicate_name_fails(self):
+        Counter("requests", "Requests.", registry=self.registry)
+        with self.assertRaises(RuntimeError):
+            Gauge("requests", "Requests.", registry=self.registry)
+
+    @gen_test
+    async def test_endpoint(self):
+        Counter("requests", "Requests.", registry=self.registry).inc()
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        server = start_metrics_server(port, registry=self.registry)
+        try:
+            response = await AsyncHTTPClient().fetch("http://127.0.0.1:{}/metrics".format(port))
+            self.assertTrue(response.headers["Content-Type"].startswith("text/plain; version=0.0.4"))
+            self.assertIn(b"requests_total 1.0\n", response.body)
+        finally:
+            server.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,426 @@
+#!/usr/bin/env python3
+
+import asyncio
+import errno
+import filecmp
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+from tornado.testing import AsyncTestCase, gen_test
+
+from securedrop.archive import archive_info
+from securedrop.file_transfer_packets import FILE_TRANSFER_P2P_MAX_CHUNK_SIZE, FILE_TRANSFER_P2P_ACK_PACKETS_NAME, \
+    FILE_TRANSFER_P2P_FILEINFO_PACKETS_NAME, FileTransferP2PFileInfoPackets
+from securedrop.p2p import P2PClient, P2PServer, SharedChunks, ChunkSizeTuner, CreditWindow, SAME_HOST_SUPPORTED
+from securedrop.progress import Progress
+from securedrop.utils import sha256_file
+
+TOKEN = b"t" * 32
+
+
+class SlowP2PServer(P2PServer):
+    async def process_chunk(self, chunk, stream):
+        await asyncio.sleep(0.01)
+        await super().process_chunk(chunk, stream)
+
+
+class SlowDiskP2PServer(P2PServer):
+    def write_chunk(self, data):
+        time.sleep(0.05)
+        return super().write_chunk(data)
+
+
+class ChunkSizeRecordingP2PServer(P2PServer):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.chunk_sizes = []
+
+    def write_chunk(self, data):
+        written = super().write_chunk(data)
+        self.chunk_sizes.append(written)
+        return written
+
+
+class StalledP2PServer(P2PServer):
+    # never acks chunks, and drops the sender once it used up its credits
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.chunks = 0
+
+    async def process_chunk(self, chunk, stream):
+        self.chunks += 1
+        if self.chunks == self.window:
+            await asyncio.sleep(0.1)
+            stream.close()
+
+
+class BadAckP2PServer(P2PServer):
+    # answers the first chunk with an ack that can't be parsed
+    async def process_chunk(self, chunk, stream):
+        await self.write(stream, FILE_TRANSFER_P2P_ACK_PACKETS_NAME + b"{not json")
+
+
+class SizeOnlyP2PClient(P2PClient):
+    # a sender that leaves out "chunks", which only receivers that predate "size" need
+    async def write(self, data: bytes):
+        if data[:4] == FILE_TRANSFER_P2P_FILEINFO_PACKETS_NAME:
+            packets = FileTransferP2PFileInfoPackets(data=data[4:])
+            del packets.file_info["chunks"]
+            data = bytes(FileTransferP2PFileInfoPackets(packets.file_info, packets.token))
+        await super().write(data)
+
+
+class TestCreditWindow(AsyncTestCase):
+    @gen_test(timeout=5)
+    async def test_blocks_until_ack(self):
+        window = CreditWindow()
+        window.on_ack(0, 2)
+        await window.acquire(10)
+        await window.acquire(10)
+        blocked = asyncio.ensure_future(window.acquire(10))
+        await asyncio.sleep(0.05)
+        self.assertFalse(blocked.done())
+        self.assertEqual(window.stats.stalls, 1)
+
+        window.on_ack(1, 2)
+        await asyncio.wait_for(blocked, 1)
+        self.assertEqual((window.sent, window.acked, window.credits()), (3, 1, 0))
+        self.assertEqual(window.stats.bytes_acked, 10)
+
+    @gen_test(timeout=5)
+    async def test_fail_while_blocked(self):
+        window = CreditWindow()
+        window.on_ack(0, 1)
+        await window.acquire(10)
+        blocked = asyncio.ensure_future(window.acquire(10))
+        await asyncio.sleep(0.05)
+        self.assertFalse(blocked.done())
+        window.fail(RuntimeError("Recipient closed the connection"))
+        with self.assertRaisesRegex(RuntimeError, "closed the connection"):
+            await asyncio.wait_for(blocked, 1)
+        with self.assertRaises(RuntimeError):
+            await window.acquire(10)
+
+
+class TestChunkSizeTuner(unittest.TestCase):
+    def setUp(self):
+        self.tuner = ChunkSizeTuner(64 * 1024, 16 * 1024, 1024 * 1024, window=16)
+        self.acked, self.now = 0, 0
+
+    def feed(self, rate, srtt, steps=40, interval=0.01):
+        # acks of a transfer at rate bytes per second
+        for _ in range(steps):
+            self.acked += rate * interval
+            self.now += interval
+            self.tuner.update(self.acked, srtt, now=self.now)
+
+    def test_tuner(self):
+        # 200 MB/s: 2 MB per 10 ms
+        self.feed(200e6, 0.001)
+        self.assertEqual(self.tuner.size, 1024 * 1024)
+        self.tuner.limit(256 * 1024)
+        self.assertEqual(self.tuner.size, 256 * 1024)
+        # 100 KB/s: the smallest chunks
+        self.feed(100e3, 0.001)
+        self.assertEqual(self.tuner.size, 16 * 1024)
+        # 10 MB/s over a 320 ms round trip, which 16 chunks of 200 KB cover
+        self.feed(10e6, 0.32)
+        self.assertEqual(self.tuner.size, 128 * 1024)
+
+
+class P2PTransfer(AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.in_dir = os.path.join(self.tmp_dir.name, "in")
+        self.out_dir = os.path.join(self.tmp_dir.name, "out")
+        os.mkdir(self.in_dir)
+        os.mkdir(self.out_dir)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+        super().tearDown()
+
+    def make_file(self, data):
+        path = os.path.join(self.in_dir, "file.bin")
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def make_client(self, port, path, token=TOKEN, progress=None, **kwargs):
+        return P2PClient(port, token, path, os.path.getsize(path), sha256_file(path, []), progress, **kwargs)
+
+    @gen_test(timeout=30)
+    async def test_transfer(self):
+        for window in (1, 4, 16):
+            with self.subTest(window=window):
+                path = self.make_file(os.urandom(300000) + b"a" * 300000)
+                sent, received = [], []
+                server = P2PServer(TOKEN, self.out_dir, Progress(sinks=[received.append]), window=window)
+                port = server.start(0)
+                try:
+                    await self.make_client(port, path, progress=Progress(sinks=[sent.append]), same_host=False).main()
+                    self.assertEqual("", await server.wait())
+                finally:
+                    server.close()
+                self.assertTrue(filecmp.cmp(path, os.path.join(self.out_dir, "file.bin"), shallow=False))
+                for events in (sent, received):
+                    self.assertTrue(events[-1].final)
+                    self.assertEqual(1, sum(event.final for event in events))
+                self.assertEqual(received[-1].done, os.path.getsize(path))
+                self.assertEqual(sent[-1].done, os.path.getsize(path))
+                os.remove(os.path.join(self.out_dir, "file.bin"))
+
+    @gen_test(timeout=30)
+    async def test_transfer_options(self):
+        path = self.make_file(os.urandom(100000) + b"a" * 100000)
+        for chunk_size, compress, tls in ((4096, False, True), (200000, True, False), (1000, False, False)):
+            with self.subTest(chunk_size=chunk_size, compress=compress, tls=tls):
+                server = P2PServer(TOKEN, self.out_dir, max_chunk_size=200000, tls=tls)
+                port = server.start(0)
+                try:
+                    await self.make_client(port,
+                                           path,
+                                           chunk_size=chunk_size,
+                                           compress=compress,
+                                           tls=tls,
+                                           same_host=False).main()
+                    self.assertEqual("", await server.wait())
+                finally:
+                    server.close()
+                self.assertTrue(filecmp.cmp(path, os.path.join(self.out_dir, "file.bin"), shallow=False))
+                os.remove(os.path.join(self.out_dir, "file.bin"))
+
+    @gen_test(timeout=60)
+    async def test_shared_chunks(self):
+        # one recipient is too slow to keep up and one starts late, both go on with chunks of their own
+        path = self.make_file(os.urandom(600000) + b"a" * 600000)
+        shared = SharedChunks(path, chunk_size=4096)
+        servers = [P2PServer(TOKEN, os.path.join(self.out_dir, str(i))) for i in range(3)]
+        servers.append(SlowP2PServer(TOKEN, os.path.join(self.out_dir, "slow")))
+        try:
+            clients = []
+            for server in servers:
+                os.mkdir(server.out_dir)
+                clients.append(self.make_client(server.start(0), path, shared_chunks=shared, same_host=False).main())
+            await asyncio.gather(*clients[1:])
+            self.assertEqual(shared.detached, 1)
+            await clients[0]
+            self.assertEqual(shared.detached, 2)
+            for server in servers:
+                self.assertEqual("", await server.wait())
+                self.assertTrue(filecmp.cmp(path, os.path.join(server.out_dir, "file.bin"), shallow=False))
+        finally:
+            for server in servers:
+                server.close()
+        self.assertLessEqual(len(shared.buffer), shared.max_lag)
+
+    @gen_test(timeout=30)
+    async def test_adaptive_chunk_size(self):
+        # over loopback, the chunks grow from the initial size up to what the receiver takes
+        path = self.make_file(os.urandom(8 * 1024 * 1024))
+        server = ChunkSizeRecordingP2PServer(TOKEN, self.out_dir, max_chunk_size=64 * 1024, tls=False)
+        port = server.start(0)
+        try:
+            await self.make_client(port, path, chunk_size=16 * 1024, compress=False, tls=False, same_host=False).main()
+            self.assertEqual("", await server.wait())
+        finally:
+            server.close()
+        self.assertTrue(filecmp.cmp(path, os.path.join(self.out_dir, "file.bin"), shallow=False))
+        self.assertEqual(server.chunk_sizes[0], 16 * 1024)
+        self.assertEqual(max(server.chunk_sizes), 64 * 1024)
+
+    @gen_test(timeout=30)
+    async def test_slow_disk(self):
+        # writes run behind the IOLoop, which keeps running timers meanwhile
+        path = self.make_file(os.urandom(20 * 4096))
+        server = SlowDiskP2PServer(TOKEN, self.out_dir, write_behind=2)
+        port = server.start(0)
+        gaps = []
+
+        async def tick():
+            while True:
+                start = time.monotonic()
+                await asyncio.sleep(0.005)
+                gaps.append(time.monotonic() - start)
+
+        ticker = asyncio.ensure_future(tick())
+        try:
+            await self.make_client(port, path, chunk_size=4096, compress=False, same_host=False).main()
+            self.assertEqual("", await server.wait())
+        finally:
+            ticker.cancel()
+            server.close()
+        self.assertTrue(filecmp.cmp(path, os.path.join(self.out_dir, "file.bin"), shallow=False))
+        self.assertGreater(server.writer.waits, 0)
+        self.assertLess(max(gaps), 0.05)
+
+    @unittest.skipUnless(SAME_HOST_SUPPORTED, "passing file descriptors isn't supported")
+    @gen_test(timeout=30)
+    async def test_same_host(self):
+        path = self.make_file(os.urandom(3 * 1024 * 1024 + 1))
+        out_path = os.path.join(self.out_dir, "file.bin")
+        copy_file_range = os.copy_file_range
+        for copy_error in (None, errno.EXDEV):
+            with self.subTest(copy_error=copy_error), patch("os.copy_file_range") as copy:
+                # file systems copy_file_range() doesn't work across fall back to sendfile()
+                copy.side_effect = copy_file_range if copy_error is None else OSError(copy_error, "")
+                sent, received = [], []
+                server = P2PServer(TOKEN, self.out_dir, Progress(sinks=[received.append]))
+                port = server.start(0)
+                try:
+                    await self.make_client(port, path, progress=Progress(sinks=[sent.append])).main()
+                    self.assertEqual("", await server.wait())
+                finally:
+                    server.close()
+                self.assertTrue(server.local)
+                self.assertTrue(copy.called)
+                self.assertTrue(filecmp.cmp(path, out_path, shallow=False))
+                for events in (sent, received):
+                    self.assertTrue(events[-1].final)
+                    self.assertEqual(events[-1].done, 3 * 1024 * 1024 + 1)
+                os.remove(out_path)
+
+    @unittest.skipUnless(SAME_HOST_SUPPORTED, "passing file descriptors isn't supported")
+    @gen_test(timeout=30)
+    async def test_same_host_fallback(self):
+        # chunks are sent if Y doesn't take the file descriptor, or X can't pass it
+        path = self.make_file(os.urandom(300000))
+        for server_same_host, send_fd_error in ((False, None), (True, OSError("no unix sockets"))):
+            with self.subTest(server_same_host=server_same_host), \
+                    patch.object(P2PClient, "send_fd", side_effect=send_fd_error) as send_fd:
+                server = P2PServer(TOKEN, self.out_dir, same_host=server_same_host)
+                port = server.start(0)
+                try:
+                    await self.make_client(port, path).main()
+                    self.assertEqual("", await server.wait())
+                finally:
+                    server.close()
+                self.assertFalse(server.local)
+                self.assertEqual(send_fd.called, server_same_host)
+                self.assertTrue(filecmp.cmp(path, os.path.join(self.out_dir, "file.bin"), shallow=False))
+                os.remove(os.path.join(self.out_dir, "file.bin"))
+
+    @gen_test(timeout=30)
+    async def test_directory(self):
+        src = os.path.join(self.in_dir, "tree")
+        for i in range(300):
+            sub_dir = os.path.join(src, str(i % 7))
+            os.makedirs(sub_dir, exist_ok=True)
+            with open(os.path.join(sub_dir, "{}.txt".format(i)), "wb") as f:
+                f.write(os.urandom(i) * 3)
+        info = archive_info(src)
+        sent = []
+        server = P2PServer(TOKEN, self.out_dir)
+        port = server.start(0)
+        try:
+            await P2PClient(port,
+                            TOKEN,
+                            src,
+                            info["size"],
+                            info["SHA256"],
+                            Progress(sinks=[sent.append]),
+                            chunk_size=4096).main()
+            self.assertEqual("", await server.wait())
+        finally:
+            server.close()
+        # small files share chunks
+        self.assertLess(server.received_chunks, 300)
+        self.assertEqual(sent[-1].done, info["size"])
+        for i in range(300):
+            path = os.path.join(str(i % 7), "{}.txt".format(i))
+            self.assertTrue(
+                filecmp.cmp(os.path.join(src, path), os.path.join(self.out_dir, "tree", path), shallow=False))
+
+    @gen_test(timeout=30)
+    async def test_directory_fails(self):
+        # what was written of a directory that doesn't match its digest is removed
+        src = os.path.join(self.in_dir, "tree")
+        os.makedirs(os.path.join(src, "sub"))
+        with open(os.path.join(src, "sub", "file.bin"), "wb") as f:
+            f.write(os.urandom(10000))
+        os.chmod(os.path.join(src, "sub"), 0o500)
+        info = archive_info(src)
+        server = P2PServer(TOKEN, self.out_dir)
+        port = server.start(0)
+        try:
+            with self.assertRaisesRegex(RuntimeError, "Directory hashes don't match!"):
+                await P2PClient(port, TOKEN, src, info["size"], "0" * 64, None).main()
+            self.assertEqual("Directory hashes don't match!", await server.wait())
+        finally:
+            server.close()
+            os.chmod(os.path.join(src, "sub"), 0o700)
+        while os.path.exists(os.path.join(self.out_dir, "tree")):
+            await asyncio.sleep(0.01)
+
+    @gen_test(timeout=30)
+    async def test_size_only(self):
+        path = self.make_file(os.urandom(100000))
+        server = P2PServer(TOKEN, self.out_dir)
+        port = server.start(0)
+        try:
+            await SizeOnlyP2PClient(port, TOKEN, path, os.path.getsize(path), sha256_file(path, []), None).main()
+            self.assertEqual("", await server.wait())
+        finally:
+            server.close()
+        self.assertTrue(filecmp.cmp(path, os.path.join(self.out_dir, "file.bin"), shallow=False))
+
+    @gen_test(timeout=30)
+    async def test_chunk_size_too_large(self):
+        path = self.make_file(b"data")
+        server = P2PServer(TOKEN, self.out_dir)
+        port = server.start(0)
+        try:
+            with self.assertRaises(RuntimeError):
+                await self.make_client(port, path, chunk_size=FILE_TRANSFER_P2P_MAX_CHUNK_SIZE + 1).main()
+        finally:
+            server.close()
+
+    @gen_test(timeout=30)
+    async def test_recipient_closes_while_blocked(self):
+        # the sender runs out of credits, since nothing is acked, and fails once the recipient goes away
+        path = self.make_file(os.urandom(64 * 1024))
+        server = StalledP2PServer(TOKEN, self.out_dir, window=2)
+        port = server.start(0)
+        client = self.make_client(port, path, chunk_size=4096, adaptive=False, same_host=False)
+        try:
+            with self.assertRaisesRegex(RuntimeError, "Recipient closed the connection"):
+                await client.main()
+        finally:
+            server.close()
+        self.assertEqual(server.chunks, 2)
+        self.assertEqual(client.window.sent, 2)
+        self.assertEqual(client.stats.stalls, 1)
+
+    @gen_test(timeout=30)
+    async def test_invalid_ack(self):
+        # the sender waits for credits that won't come once the ack reader stopped, so it fails instead
+        path = self.make_file(os.urandom(64 * 1024))
+        server = BadAckP2PServer(TOKEN, self.out_dir, window=2)
+        port = server.start(0)
+        client = self.make_client(port, path, chunk_size=4096, adaptive=False, same_host=False)
+        try:
+            with self.assertRaisesRegex(RuntimeError, "Invalid message from recipient"):
+                await client.main()
+        finally:
+            server.close()
+        self.assertEqual(client.window.sent, 2)
+
+    @gen_test(timeout=30)
+    async def test_wrong_token(self):
+        path = self.make_file(b"data")
+        server = P2PServer(TOKEN, self.out_dir)
+        port = server.start(0)
+        try:
+            with self.assertRaises(RuntimeError):
+                await self.make_client(port, path, b"x" * 32).main()
+        finally:
+            server.close()
+        self.assertFalse(server.done.done())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+import os
+import socket
+import sys
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+from tornado.tcpclient import TCPClient
+from tornado.testing import AsyncTestCase, gen_test
+
+from securedrop.client_server_base import ServerBase, read, write
+from securedrop.profiling import HandlerProfiler, collapse_stack
+
+
+class BusyServer(ServerBase):
+    # blocks the IOLoop while handling SLOW messages
+    def __init__(self):
+        super().__init__(packet_types={b"SLOW", b"FAST"}, tls=False)
+
+    async def on_data_received(self, data, stream):
+        if data[:4] == b"SLOW":
+            deadline = time.process_time() + 0.5
+            while time.process_time() < deadline:
+                pass
+        await self.write(stream, data)
+
+
+class TestHandlerProfiler(AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        self.dump_dir = tempfile.TemporaryDirectory()
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            self.port = sock.getsockname()[1]
+        self.server = BusyServer()
+        self.server.listen(self.port, "127.0.0.1")
+        self.profiler = self.server.make_profiler(self.dump_dir.name)
+
+    def tearDown(self):
+        self.profiler.stop()
+        self.server.stop()
+        self.dump_dir.cleanup()
+        super().tearDown()
+
+    async def request(self, data):
+        stream = await TCPClient().connect("127.0.0.1", self.port)
+        try:
+            await write(stream, data)
+            return await read(stream)
+        finally:
+            stream.close()
+
+    @gen_test(timeout=10)
+    async def test_samples_and_stalls_per_packet_type(self):
+        self.profiler.start()
+        self.assertEqual(await self.request(b"FAST"), b"FAST")
+        self.assertEqual(await self.request(b"SLOW"), b"SLOW")
+
+        self.assertGreater(sum(self.profiler.samples["SLOW"].values()), 0)
+        busy = self.profiler.samples["SLOW"].most_common(1)[0][0]
+        self.assertTrue(busy.endswith("profiling_test.py:on_data_received"), busy)
+        self.assertEqual([stall["packet_type"] for stall in self.profiler.stalls], ["SLOW"])
+        self.assertTrue(self.profiler.stalls[0]["stack"].endswith("profiling_test.py:on_data_received"))
+
+        path = self.profiler.dump()
+        self.assertEqual(os.path.dirname(path), self.dump_dir.name)
+        with open(path) as f:
+            report = f.read()
+        self.assertIn("# SLOW: ", report)
+        self.assertIn("\nstall;SLOW;", report)
+        self.assertFalse(self.profiler.samples)
+        self.assertFalse(self.profiler.stalls)
+
+    @gen_test(timeout=10)
+    async def test_toggle(self):
+        self.profiler.toggle()
+        self.assertTrue(self.profiler.running)
+        self.assertEqual(await self.request(b"SLOW"), b"SLOW")
+        self.profiler.toggle()
+        self.assertFalse(self.profiler.running)
+        reports = os.listdir(self.dump_dir.name)
+        self.assertEqual(len(reports), 1)
+        # stopped, nothing is recorded
+        self.assertEqual(await self.request(b"SLOW"), b"SLOW")
+        self.assertFalse(self.profiler.samples)
+        self.assertFalse(self.profiler.stalls)
+
+    def test_stall_stack_skips_sampling(self):
+        # the watchdog may catch the thread in on_sample, whose stack would hide the handler it interrupted
+        caught = []
+
+        def collapse(frame):
+            caught.append(sys._getframe())
+            return collapse_stack(frame)
+
+        handler = sys._getframe()
+        with patch("securedrop.profiling.collapse_stack", collapse):
+            self.profiler.on_sample(None, handler)
+        self.assertIs(HandlerProfiler.interrupted_frame(caught[0]), handler)
+        self.assertIs(HandlerProfiler.interrupted_frame(handler), handler)
+
+
+if __name__ == '__main__':
+    unittest.main()
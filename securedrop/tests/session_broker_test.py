@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import unittest
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.netutil import bind_unix_socket
+from tornado.testing import AsyncTestCase, gen_test
+from tornado.locks import Event
+
+from securedrop import ClientBase
+from securedrop.client_server_base import write
+from securedrop.add_contact_packets import AddContactPackets
+from securedrop.file_transfer_packets import FileTransferRequestPackets, FileTransferRequestResponsePackets, \
+    FileTransferCheckRequestsPackets, FileTransferAcceptRequestPackets, FileTransferSendTokenPackets, \
+    FileTransferSendPortPackets, FileTransferSendPortTokenPackets
+from securedrop.register_packets import RegisterPackets
+from securedrop.server import Server
+from securedrop.session_directory import BrokerSessionDirectory, SessionBroker
+from securedrop.status_packets import StatusPackets
+
+
+class TestSessionBroker(AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "broker.sock")
+        self.broker = SessionBroker()
+        self.broker.add_socket(bind_unix_socket(self.path))
+        self.workers = [BrokerSessionDirectory(self.path) for _ in range(2)]
+
+    def tearDown(self):
+        for worker in self.workers:
+            worker.close()
+        self.broker.stop()
+        self.tmp_dir.cleanup()
+        super().tearDown()
+
+    @gen_test
+    async def test_presence_is_shared(self):
+        w1, w2 = self.workers
+        await w1.connect("a@test.com", "127.0.0.1", ["b@test.com"])
+        await w2.connect("b@test.com", "127.0.0.1", [])
+        online = await w2.lookup(["a@test.com", "c@test.com"])
+        self.assertEqual(online, {"a@test.com": {"host": "127.0.0.1", "contacts": ["b@test.com"]}})
+
+        await w1.update_contacts("a@test.com", ["b@test.com", "c@test.com"])
+        online = await w2.lookup(["a@test.com"])
+        self.assertEqual(online["a@test.com"]["contacts"], ["b@test.com", "c@test.com"])
+
+        # only the worker the user is connected to can disconnect them
+        await w2.disconnect("a@test.com")
+        self.assertIn("a@test.com", await w2.lookup(["a@test.com"]))
+        await w1.disconnect("a@test.com")
+        self.assertEqual(await w2.lookup(["a@test.com"]), dict())
+
+    @gen_test
+    async def test_errors_are_answered(self):
+        w1, w2 = self.workers
+        # a failing operation gets an error instead of no answer, and the broker goes on serving the worker
+        with self.assertRaisesRegex(RuntimeError, "Session broker error"):
+            await w1.call("lookup", nonsense=1)
+        self.assertEqual(await w1.lookup(["a@test.com"]), dict())
+
+        # a message without an id can't be answered: the worker is dropped, which fails its pending calls
+        await w2.ensure_connected()
+        pending = w2.pending[0] = Future()
+        await write(w2.stream, b"not json")
+        with self.assertRaisesRegex(RuntimeError, "Lost connection"):
+            await pending
+        self.assertEqual(await w1.lookup(["a@test.com"]), dict())
+
+    @gen_test
+    async def test_requests_are_shared(self):
+        w1, w2 = self.workers
+        await w1.add_request("b@test.com", "a@test.com", {"name": "f1"})
+        await w1.add_request("b@test.com", "c@test.com", {"name": "f2"})
+        self.assertEqual(await w2.get_requests("b@test.com"), {
+            "a@test.com": {
+                "name": "f1"
+            },
+            "c@test.com": {
+                "name": "f2"
+            }
+        })
+        self.assertEqual(await w2.pop_requests("b@test.com", "a@test.com"), {"a@test.com": {"name": "f1"}})
+        self.assertEqual(await w2.pop_requests("b@test.com"), {"c@test.com": {"name": "f2"}})
+        self.assertEqual(await w1.get_requests("b@test.com"), dict())
+
+    @gen_test
+    async def test_deliver_routes_to_owning_worker(self):
+        w1, w2 = self.workers
+        delivered = Event()
+        received = []
+
+        async def on_deliver(email, data):
+            received.append((email, data))
+            delivered.set()
+
+        w1.on_deliver = on_deliver
+        await w1.connect("a@test.com", "127.0.0.1", [])
+        self.assertTrue(await w2.deliver("a@test.com", b"\x00data"))
+        await delivered.wait()
+        self.assertEqual(received, [("a@test.com", b"\x00data")])
+        self.assertFalse(await w2.deliver("b@test.com", b"data"))
+
+    @gen_test
+    async def test_lost_worker_disconnects_its_users(self):
+        w1, w2 = self.workers
+        await w1.connect("a@test.com", "127.0.0.1", [])
+        w1.close()
+        # give the broker a moment to notice the closed stream
+        for _ in range(20):
+            if not await w2.lookup(["a@test.com"]):
+                break
+            await gen.sleep(0.05)
+        self.assertEqual(await w2.lookup(["a@test.com"]), dict())
+
+    @gen_test(timeout=30)
+    async def test_file_transfer_across_workers(self):
+        # X and Y are connected to different workers, as they may be behind the same SO_REUSEPORT port
+        filename = os.path.join(self.tmp_dir.name, "server.json")
+        servers = [Server(filename, worker) for worker in self.workers]
+        x, y = ClientBase("localhost", None), ClientBase("localhost", None)
+        try:
+            for server, client in zip(servers, (x, y)):
+                server.listen(0)
+                client.port = next(iter(server.listen_ports))
+                await client.main()
+
+            async def request(client, packet):
+                await client.write(bytes(packet))
+                return await client.read()
+
+            for client, me, other in ((x, "x@test.com", "y@test.com"), (y, "y@test.com", "x@test.com")):
+                self.assertEqual(
+                    StatusPackets(data=(await request(client, RegisterPackets(me, me, "pw")))[4:]).message, "")
+                await request(client, AddContactPackets(other, other))
+
+            status = await request(x, FileTransferRequestPackets("y@test.com", {"name": "f"}))
+            self.assertEqual(StatusPackets(data=status[4:]).message, "")
+            requests = await request(y, FileTransferRequestResponsePackets())
+            self.assertEqual(
+                FileTransferCheckRequestsPackets(data=requests[4:]).requests, {"x@test.com": {
+                    "name": "f"
+                }})
+            token = FileTransferSendTokenPackets(
+                data=(await request(y, FileTransferAcceptRequestPackets("x@test.com")))[4:]).token
+            await y.write(bytes(FileTransferSendPortPackets(1234)))
+            port_token = FileTransferSendPortTokenPackets(data=(await x.read())[4:])
+            self.assertEqual((port_token.port, port_token.token), (1234, token))
+        finally:
+            for client in (x, y):
+                if client.stream is not None:
+                    client.stream.close()
+            for server in servers:
+                server.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
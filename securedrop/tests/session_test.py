@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+
+import asyncio
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from tornado.iostream import StreamClosedError
+from tornado.testing import AsyncTestCase, gen_test
+
+from securedrop import SecureDropSession
+from securedrop.file_transfer_packets import FileTransferAcceptRequestPackets
+from securedrop.login_packets import LoginPackets
+from securedrop.resume_packets import ResumePackets
+from securedrop.List_Contacts_Response_Packets import ListContactsResponsePackets, LIST_CONTACTS_RESPONSE_PACKETS_NAME
+from securedrop.server import Server, import_users
+from securedrop.session import check_status
+from securedrop.timer_wheel import TimerWheel
+from securedrop.utils import sha256_file
+
+PASSWORD = "correct horse battery"
+
+
+class TestSecureDropSession(AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.server = Server(os.path.join(self.tmp_dir.name, "server.json"))
+        self.server.listen(0)
+        self.port = next(iter(self.server.listen_ports))
+        self.sessions = []
+
+    def tearDown(self):
+        for session in self.sessions:
+            session.close()
+        self.server.stop()
+        self.tmp_dir.cleanup()
+        super().tearDown()
+
+    async def register(self, *emails):
+        # sessions of users that are each other's contacts
+        sessions = []
+        for email in emails:
+            session = SecureDropSession("localhost", self.port)
+            self.sessions.append(session)
+            await session.main()
+            await session.register(email.split("@")[0], email, PASSWORD)
+            errors = await session.add_contacts([(other.split("@")[0], other) for other in emails if other != email])
+            self.assertEqual(errors, [""] * (len(emails) - 1))
+            sessions.append(session)
+        return sessions
+
+    def make_file(self, name, size):
+        path = os.path.join(self.tmp_dir.name, name)
+        with open(path, "wb") as f:
+            f.write(os.urandom(size))
+        return path
+
+    @gen_test(timeout=30)
+    async def test_contacts(self):
+        x, y = await self.register("x@test.com", "y@test.com")
+        self.assertEqual(await x.list_online(), {"y@test.com": "y"})
+        self.assertEqual(await x.add_contacts([("z", "z@test.com"), ("bad", "not an email")]),
+                         ["", "Invalid Email Address."])
+        y.close()
+        await asyncio.sleep(0.1)
+        self.assertEqual(await x.list_online(), dict())
+
+        session = SecureDropSession("localhost", self.port)
+        self.sessions.append(session)
+        await session.main()
+        with self.assertRaises(RuntimeError):
+            await session.login("y@test.com", "wrong password")
+        await session.login("y@test.com", PASSWORD)
+        self.assertEqual(await x.list_online(), {"y@test.com": "y"})
+
+    @gen_test(timeout=30)
+    async def test_contacts_changes(self):
+        x, y, z, w = await self.register("x@test.com", "y@test.com", "z@test.com", "w@test.com")
+        replies = []
+        write = self.server.write
+
+        async def record_reply(stream, data):
+            if data.startswith(LIST_CONTACTS_RESPONSE_PACKETS_NAME):
+                replies.append(ListContactsResponsePackets(data=data[4:]))
+            await write(stream, data)
+
+        with patch.object(self.server, "write", record_reply):
+            self.assertEqual(await x.list_online(), {"y@test.com": "y", "z@test.com": "z", "w@test.com": "w"})
+            self.assertEqual(await x.list_online(), {"y@test.com": "y", "z@test.com": "z", "w@test.com": "w"})
+            z.close()
+            await asyncio.sleep(0.1)
+            self.assertEqual(await x.list_online(), {"y@test.com": "y", "w@test.com": "w"})
+        self.assertEqual(replies[0].contacts, {"y@test.com": "y", "z@test.com": "z", "w@test.com": "w"})
+        self.assertTrue(replies[1].not_modified())
+        self.assertEqual((replies[2].contacts, replies[2].added, replies[2].removed), (None, dict(), ["z@test.com"]))
+        epoch, version, _ = x.contacts_view
+        self.assertEqual(version, 2)
+
+        # versions of a view the server doesn't have get the whole list
+        x.contacts_view = ("unknown", version, dict())
+        self.assertEqual(await x.list_online(), {"y@test.com": "y", "w@test.com": "w"})
+        self.assertEqual(x.contacts_view[:2], (epoch, version))
+        x.close()
+        await asyncio.sleep(0.1)
+        self.assertNotIn("x@test.com", self.server.online)
+
+    @gen_test(timeout=30)
+    async def test_timeouts(self):
+        self.server.timers.stop()
+        self.server.timers = TimerWheel(tick=0.05)
+        self.server.timers.start()
+        self.server.request_timeout = self.server.token_timeout = 0.3
+        x, y = await self.register("x@test.com", "y@test.com")
+        path = self.make_file("f.bin", 1024)
+
+        # y never answers
+        with self.assertRaisesRegex(RuntimeError, "did not answer"):
+            await x.send_file("y@test.com", path)
+        self.assertEqual(await y.check_incoming(), [])
+        self.assertEqual(self.server.request_timers, dict())
+
+        # y accepts, but never sends the port it listens on
+        async def accept():
+            async for transfer in y.incoming(poll_interval=0.05):
+                await y.request(bytes(FileTransferAcceptRequestPackets(transfer.sender)))
+                return
+
+        with self.assertRaisesRegex(RuntimeError, "did not start"):
+            await asyncio.gather(x.send_file("y@test.com", path), accept())
+        self.assertIsNone(self.server.online["y@test.com"].accepted)
+
+        # connections that send nothing are closed
+        self.server.idle_timeout = 0.3
+        session = SecureDropSession("localhost", self.port)
+        self.sessions.append(session)
+        await session.main()
+        await asyncio.sleep(0.6)
+        with self.assertRaises(StreamClosedError):
+            await session.login("x@test.com", PASSWORD)
+
+    @gen_test(timeout=30)
+    async def test_accept_replaces(self):
+        # y accepts x's request, then z's before sending a port: x is told at once rather than waiting forever
+        x, y, z = await self.register("x@test.com", "y@test.com", "z@test.com")
+        path = self.make_file("f.bin", 1024)
+        sends = [asyncio.ensure_future(session.send_file("y@test.com", path)) for session in (x, z)]
+        while len(await y.check_incoming()) < 2:
+            await asyncio.sleep(0.05)
+        for sender in ("x@test.com", "z@test.com"):
+            await y.request(bytes(FileTransferAcceptRequestPackets(sender)))
+        with self.assertRaisesRegex(RuntimeError, "accepted another"):
+            await sends[0]
+        self.assertEqual(self.server.online["y@test.com"].accepted[0], "z@test.com")
+        sends[1].cancel()
+
+    @gen_test(timeout=30)
+    async def test_handoff(self):
+        # a new server takes over while x waits for y to answer its request: neither notices
+        x, y = await self.register("x@test.com", "y@test.com")
+        path = self.make_file("f.bin", 64 * 1024)
+        out_dir = os.path.join(self.tmp_dir.name, "out")
+        os.mkdir(out_dir)
+        handoff_path = os.path.join(self.tmp_dir.name, "handoff.sock")
+        self.server.serve_handoff(handoff_path)
+        send = asyncio.ensure_future(x.send_file("y@test.com", path))
+        while not await y.check_incoming():
+            await asyncio.sleep(0.05)
+
+        old_server, self.server = self.server, Server(self.server.users.filename)
+        self.assertTrue(await self.server.take_over(handoff_path))
+        self.assertEqual(self.server.listen_ports, old_server.listen_ports)
+        while old_server.streams or len(self.server.online) < 2:
+            await asyncio.sleep(0.05)
+        self.assertTrue(old_server.handed_off)
+        self.assertEqual(self.server.resumable, dict())
+
+        self.assertEqual(await x.list_online(), {"y@test.com": "y"})
+        transfer, = await y.check_incoming()
+        self.assertEqual(await transfer.accept(out_dir), os.path.join(out_dir, "f.bin"))
+        await send
+        self.assertEqual(sha256_file(os.path.join(out_dir, "f.bin"), []), sha256_file(path, []))
+
+        # nothing serves the path anymore
+        self.assertFalse(await Server(self.server.users.filename).take_over(handoff_path))
+
+        # tokens that aren't even base64 are turned down like wrong ones
+        for token in ("abc", "A" * 44):
+            with self.assertRaisesRegex(RuntimeError, "log in again"):
+                check_status(await y.request(bytes(LoginPackets("y@test.com", resume=token))))
+
+    @gen_test(timeout=30)
+    async def test_resume_fails(self):
+        # a session that can't resume on the new server fails, rather than going on without pushes
+        x, y = await self.register("x@test.com", "y@test.com")
+        path = self.make_file("f.bin", 1024)
+        send = asyncio.ensure_future(x.send_file("y@test.com", path))
+        while not await y.check_incoming():
+            await asyncio.sleep(0.05)
+        await self.server.write(self.server.online["x@test.com"].stream, bytes(ResumePackets("unknown")))
+        with self.assertRaisesRegex(RuntimeError, "log in again"):
+            await send
+        with self.assertRaisesRegex(RuntimeError, "log in again"):
+            await x.list_online()
+
+    @gen_test(timeout=30)
+    async def test_handoff_forwards(self):
+        # y denies x's request just as the server hands over: the old server forwards the deny to the new one
+        x, y = await self.register("x@test.com", "y@test.com")
+        path = self.make_file("f.bin", 1024)
+        handoff_path = os.path.join(self.tmp_dir.name, "handoff.sock")
+        self.server.serve_handoff(handoff_path)
+        send = asyncio.ensure_future(x.send_file("y@test.com", path))
+        while not await y.check_incoming():
+            await asyncio.sleep(0.05)
+
+        resume = y.resume
+
+        async def deny_then_resume(packets):
+            await y.deny()
+            await resume(packets)
+
+        y.resume = deny_then_resume
+        old_server, self.server = self.server, Server(self.server.users.filename)
+        self.assertTrue(await self.server.take_over(handoff_path))
+        with self.assertRaisesRegex(RuntimeError, "declined"):
+            await asyncio.wait_for(send, 5)
+        self.assertEqual(await y.check_incoming(), [])
+
+    @gen_test(timeout=30)
+    async def test_handoff_queues(self):
+        # y accepts x's request before x resumed on the new server, which gets the port once it does
+        x, y = await self.register("x@test.com", "y@test.com")
+        path = self.make_file("f.bin", 64 * 1024)
+        out_dir = os.path.join(self.tmp_dir.name, "out")
+        os.mkdir(out_dir)
+        handoff_path = os.path.join(self.tmp_dir.name, "handoff.sock")
+        self.server.serve_handoff(handoff_path)
+        send = asyncio.ensure_future(x.send_file("y@test.com", path))
+        while not await y.check_incoming():
+            await asyncio.sleep(0.05)
+
+        answered, resume = asyncio.Event(), x.resume
+
+        async def resume_once_answered(packets):
+            await answered.wait()
+            await resume(packets)
+
+        x.resume = resume_once_answered
+        old_server, self.server = self.server, Server(self.server.users.filename)
+        self.assertTrue(await self.server.take_over(handoff_path))
+        while "y@test.com" not in self.server.online:
+            await asyncio.sleep(0.05)
+        transfer, = await y.check_incoming()
+        accept = asyncio.ensure_future(transfer.accept(out_dir))
+        while not self.server.resumable["x@test.com"].queued:
+            await asyncio.sleep(0.05)
+        answered.set()
+        await asyncio.wait_for(send, 5)
+        self.assertEqual(await accept, os.path.join(out_dir, "f.bin"))
+        self.assertEqual(sha256_file(os.path.join(out_dir, "f.bin"), []), sha256_file(path, []))
+
+    @gen_test(timeout=30)
+    async def test_add_contacts_batch(self):
+        x, = await self.register("x@test.com")
+        contacts = [("user{}".format(i), "user{}@test.com".format(i)) for i in range(500)]
+        contacts.insert(100, ("", "noname@test.com"))
+        contacts.insert(200, ("bad", "not an email"))
+        with patch.object(self.server.users, "write_json", wraps=self.server.users.write_json) as write_json:
+            messages = await x.add_contacts(contacts)
+        self.assertEqual(write_json.call_count, 1)
+        self.assertEqual(len(messages), 502)
+        self.assertEqual((messages[100], messages[200]), ("Invalid contact name.", "Invalid Email Address."))
+        self.assertEqual(messages.count(""), 500)
+        self.assertEqual(len(self.server.users.get_contacts("x@test.com")), 500)
+
+    @gen_test(timeout=30)
+    async def test_import_users(self):
+        entries = [("user{}".format(i), "user{}@test.com".format(i), PASSWORD) for i in range(20)]
+        entries += [("dup", "user0@test.com", PASSWORD), ("bad", "not an email", PASSWORD)]
+        filename = self.server.users.filename
+        self.assertEqual(import_users(filename, entries),
+                         [""] * 20 + ["User already exists.", "Invalid Email Address."])
+        self.assertEqual(import_users(filename, entries[:1]), ["User already exists."])
+
+        session = SecureDropSession("localhost", self.port)
+        self.sessions.append(session)
+        await session.main()
+        await session.login("user7@test.com", PASSWORD)
+        with self.assertRaises(RuntimeError):
+            await session.register("user7", "user7@test.com", PASSWORD)
+
+    @gen_test(timeout=30)
+    async def test_concurrent_sends(self):
+        # X sends to Y and Z at once: Y accepts and Z denies, and X tells their answers apart
+        x, y, z = await self.register("x@test.com", "y@test.com", "z@test.com")
+        path = self.make_file("f.bin", 300 * 1024)
+        out_dir = os.path.join(self.tmp_dir.name, "out")
+        os.mkdir(out_dir)
+
+        async def receive(session, accept):
+            async for transfer in session.incoming(poll_interval=0.05):
+                self.assertEqual((transfer.sender, transfer.name, transfer.size), ("x@test.com", "f.bin", 300 * 1024))
+                if accept:
+                    return await transfer.accept(out_dir)
+                await transfer.deny()
+                return None
+
+        results = await asyncio.gather(x.send_file("y@test.com", path),
+                                       x.send_file("z@test.com", path),
+                                       receive(y, True),
+                                       receive(z, False),
+                                       return_exceptions=True)
+        self.assertIsNone(results[0])
+        self.assertIsInstance(results[1], RuntimeError)
+        self.assertIn("declined", str(results[1]))
+        self.assertEqual(results[2], os.path.join(out_dir, "f.bin"))
+        self.assertEqual(sha256_file(results[2], []), sha256_file(path, []))
+        self.assertEqual(x.pending_sends, dict())
+
+    @gen_test(timeout=30)
+    async def test_send_file_to_many(self):
+        x, y, z, w = await self.register("x@test.com", "y@test.com", "z@test.com", "w@test.com")
+        path = self.make_file("f.bin", 300 * 1024)
+        out_dirs = [os.path.join(self.tmp_dir.name, name) for name in ("y", "w")]
+        for out_dir in out_dirs:
+            os.mkdir(out_dir)
+
+        async def receive(session, out_dir):
+            async for transfer in session.incoming(poll_interval=0.05):
+                if out_dir is None:
+                    return await transfer.deny()
+                return await transfer.accept(out_dir)
+
+        messages, *received = await asyncio.gather(
+            x.send_file_to_many(["y@test.com", "z@test.com", "w@test.com", "nobody@test.com"], path),
+            receive(y, out_dirs[0]), receive(z, None), receive(w, out_dirs[1]))
+        self.assertEqual(messages[0], "")
+        self.assertIn("declined", messages[1])
+        self.assertEqual(messages[2], "")
+        self.assertIn("not online", messages[3])
+        for out_dir in out_dirs:
+            self.assertEqual(sha256_file(os.path.join(out_dir, "f.bin"), []), sha256_file(path, []))
+
+    @gen_test(timeout=30)
+    async def test_send_directory(self):
+        x, y = await self.register("x@test.com", "y@test.com")
+        src = os.path.join(self.tmp_dir.name, "tree")
+        os.makedirs(os.path.join(src, "sub"))
+        for name in ("a.txt", os.path.join("sub", "b.txt")):
+            with open(os.path.join(src, name), "w") as f:
+                f.write(name)
+        out_dir = os.path.join(self.tmp_dir.name, "out")
+        os.mkdir(out_dir)
+
+        async def receive():
+            async for transfer in y.incoming(poll_interval=0.05):
+                self.assertTrue(transfer.directory)
+                return await transfer.accept(out_dir)
+
+        _, received = await asyncio.gather(x.send_file("y@test.com", src), receive())
+        self.assertEqual(received, os.path.join(out_dir, "tree"))
+        with open(os.path.join(received, "sub", "b.txt")) as f:
+            self.assertEqual(f.read(), os.path.join("sub", "b.txt"))
+
+
+if __name__ == '__main__':
+    unittest.main()
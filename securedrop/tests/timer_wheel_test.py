@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+import asyncio
+import random
+import unittest
+
+from tornado.testing import AsyncTestCase, gen_test
+
+from securedrop.timer_wheel import TimerWheel
+
+
+class TestTimerWheel(AsyncTestCase):
+    def make_wheel(self, **kwargs):
+        wheel = TimerWheel(**kwargs)
+        wheel.start_time = 0
+        wheel.now = lambda: self.now
+        return wheel
+
+    def setUp(self):
+        super().setUp()
+        self.now = 0
+
+    def test_expiry(self):
+        # a small wheel, so that timers are placed in every level and beyond the last one
+        wheel = self.make_wheel(tick=1, slots=4, levels=3)
+        fired = []
+        delays = [random.randrange(1, 200) for _ in range(500)] + [1, 4, 5, 16, 17, 64, 65]
+        timers = []
+        for delay in delays:
+            self.now = random.random() * 3
+            timers.append(wheel.schedule(delay, fired.append, (delay, self.now)))
+        cancelled = set(random.sample(range(len(timers)), 100))
+        for i in cancelled:
+            timers[i].cancel()
+        self.assertEqual(len(wheel), len(delays) - len(cancelled))
+
+        for t in range(1, 210):
+            self.now = t
+            wheel.advance()
+            for delay, scheduled in fired:
+                # never early, and at most a tick late
+                self.assertGreaterEqual(t, delay + scheduled)
+                self.assertLess(t, delay + scheduled + 2)
+            fired.clear()
+        self.assertEqual(len(wheel), 0)
+        self.assertFalse(any(timer.active for timer in timers))
+
+    def test_callback_error(self):
+        wheel = self.make_wheel(tick=0.5)
+        fired = []
+        wheel.schedule(1, lambda: 1 / 0)
+        wheel.schedule(1, fired.append, True)
+        self.now = 1
+        wheel.advance()
+        self.assertEqual(fired, [True])
+
+    @gen_test(timeout=5)
+    async def test_periodic(self):
+        wheel = TimerWheel(tick=0.01)
+        wheel.start()
+        fired = []
+        timer = wheel.schedule(0.05, fired.append, True)
+        while timer.active:
+            await asyncio.sleep(0.01)
+        wheel.stop()
+        self.assertEqual(fired, [True])
+
+
+if __name__ == '__main__':
+    unittest.main()
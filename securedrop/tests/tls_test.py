@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+import os
+import socket
+import unittest
+
+from tornado.testing import AsyncTestCase, gen_test
+
+from securedrop.client_server_base import ClientBase, ServerBase
+from securedrop import tls
+from securedrop.tls import client_ssl_context, server_ssl_context, clear_ssl_contexts
+
+
+class EchoServer(ServerBase):
+    async def on_data_received(self, data, stream):
+        await self.write(stream, data)
+
+
+class EchoClient(ClientBase):
+    def __init__(self, port, by_port=True):
+        super().__init__("localhost", port)
+        self.tls_sessions_by_port = by_port
+        self.resumed = None
+
+    async def main(self):
+        await super().main()
+        try:
+            await self.write(b"ECHO")
+            await self.read()
+            self.resumed = self.stream.socket.session_reused
+        finally:
+            self.stream.close()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class TestTLS(AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        clear_ssl_contexts()
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+        super().tearDown()
+
+    def start_server(self):
+        port = free_port()
+        server = EchoServer()
+        server.listen(port, "127.0.0.1")
+        self.servers.append(server)
+        return port
+
+    async def connect(self, port, by_port=True):
+        client = EchoClient(port, by_port)
+        await client.main()
+        return client.resumed
+
+    def test_contexts_are_cached(self):
+        self.assertIs(client_ssl_context(), client_ssl_context())
+        self.assertIsNot(client_ssl_context(), client_ssl_context(by_port=False))
+        ctx = server_ssl_context()
+        self.assertIs(server_ssl_context(), ctx)
+        # a renewed certificate gets a new context
+        stat = os.stat("server.pem")
+        os.utime("server.pem", ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+        renewed = server_ssl_context()
+        self.assertIsNot(renewed, ctx)
+        self.assertIs(server_ssl_context(), renewed)
+        # which replaces the old one
+        self.assertEqual(len(tls._contexts), 3)
+
+    @gen_test
+    async def test_reconnect_resumes(self):
+        port = self.start_server()
+        self.assertEqual([await self.connect(port) for _ in range(3)], [False, True, True])
+
+    @gen_test
+    async def test_sessions_by_port(self):
+        first, second = self.start_server(), self.start_server()
+        await self.connect(first)
+        # another server, though with the same context
+        self.assertFalse(await self.connect(second))
+
+    @gen_test
+    async def test_sessions_by_host(self):
+        # like P2P servers, which listen on a new port for every transfer
+        first, second = self.start_server(), self.start_server()
+        await self.connect(first, by_port=False)
+        self.assertTrue(await self.connect(second, by_port=False))
+
+
+if __name__ == '__main__':
+    unittest.main()
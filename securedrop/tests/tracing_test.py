@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+import os
+import signal
+import socket
+import tempfile
+import time
+import unittest
+from multiprocessing import Process
+
+from tornado import gen
+from tornado.tcpclient import TCPClient
+from tornado.testing import AsyncTestCase, gen_test
+
+from securedrop.client_server_base import ServerBase, ShutdownController, read, write
+from securedrop.tracing import TraceBuffer, load, format_event, ACCEPT, RECEIVE, SEND, ERROR, CLOSE
+
+
+class TracedServer(ServerBase):
+    def __init__(self):
+        super().__init__(tls=False)
+
+    async def on_data_received(self, data, stream):
+        if data[:4] == b"FAIL":
+            raise RuntimeError("failed")
+        await self.write(stream, data)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class TestTraceBuffer(unittest.TestCase):
+    def test_ring(self):
+        trace = TraceBuffer(3)
+        for i in range(5):
+            trace.record(1, RECEIVE, b"LGIN", i, 0.5)
+        self.assertEqual(trace.count, 5)
+        self.assertEqual([event.size for event in trace.events()], [2, 3, 4])
+        self.assertEqual({event.prefix for event in trace.events()}, {b"LGIN"})
+
+    def test_dump(self):
+        trace = TraceBuffer(3)
+        trace.record(1, ACCEPT)
+        trace.record(1, RECEIVE, b"LGIN", 10, 0.25)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = trace.dump(dump_dir=tmp_dir)
+            events = load(path)
+        self.assertEqual(events, trace.events())
+        self.assertTrue(format_event(events[1]).endswith(" conn=1 receive LGIN size=10 duration=0.250000"))
+
+    def test_not_a_dump(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(bytes(64))
+            f.flush()
+            with self.assertRaises(ValueError):
+                load(f.name)
+
+
+class TestServerTrace(AsyncTestCase):
+    @gen_test(timeout=5)
+    async def test_events(self):
+        port = free_port()
+        server = TracedServer()
+        server.listen(port, "127.0.0.1")
+        try:
+            stream = await TCPClient().connect("127.0.0.1", port)
+            await write(stream, b"ECHO")
+            self.assertEqual(await read(stream), b"ECHO")
+            await write(stream, b"FAIL")
+            await write(stream, b"ECHO")
+            self.assertEqual(await read(stream), b"ECHO")
+            stream.close()
+            while server.connection_ids:
+                await gen.sleep(0.01)
+        finally:
+            server.stop()
+
+        events = server.trace.events()
+        self.assertEqual([(event.connection, event.kind, event.prefix) for event in events], [(1, ACCEPT, bytes(4)),
+                                                                                              (1, SEND, b"ECHO"),
+                                                                                              (1, RECEIVE, b"ECHO"),
+                                                                                              (1, ERROR, b"FAIL"),
+                                                                                              (1, SEND, b"ECHO"),
+                                                                                              (1, RECEIVE, b"ECHO"),
+                                                                                              (1, CLOSE, bytes(4))])
+        self.assertEqual(events[1].size, len(b"ECHO"))
+        self.assertFalse(server.connection_ids)
+
+    def test_dump_on_signal(self):
+        port = free_port()
+        shutdown = ShutdownController()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            process = Process(target=TracedServer().run, args=(port, shutdown), kwargs={"trace_dir": tmp_dir})
+            process.start()
+            try:
+                deadline = time.monotonic() + 10
+                while True:
+                    try:
+                        sock = socket.create_connection(("127.0.0.1", port))
+                        break
+                    except ConnectionRefusedError:
+                        self.assertLess(time.monotonic(), deadline)
+                        time.sleep(0.05)
+                with sock:
+                    # the first message is handled by the time the second one is answered
+                    for _ in range(2):
+                        sock.sendall(b"ECHO\n\n")
+                        self.assertEqual(sock.recv(16), b"ECHO\n\n")
+                    os.kill(process.pid, signal.SIGUSR2)
+                    while not os.listdir(tmp_dir):
+                        self.assertLess(time.monotonic(), deadline)
+                        time.sleep(0.05)
+            finally:
+                shutdown.request()
+                process.join()
+                shutdown.close()
+            events = load(os.path.join(tmp_dir, os.listdir(tmp_dir)[0]))
+        self.assertEqual([event.kind for event in events][:3], [ACCEPT, SEND, RECEIVE])
+
+
+if __name__ == '__main__':
+    unittest.main()
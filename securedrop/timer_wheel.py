@@ -0,0 +1,121 @@
+from logging import getLogger
+
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+# seconds between ticks, which is as precise as timers get
+DEFAULT_TICK = 1.0
+# slots of each level; a level's slot spans all the slots of the level below
+DEFAULT_SLOTS = 64
+# with the defaults, timers up to 64 ** 4 seconds (about six months) ahead are placed exactly
+DEFAULT_LEVELS = 4
+
+log = getLogger()
+
+
+class Timer:
+    # A callback scheduled on a TimerWheel, see TimerWheel.schedule()
+
+    __slots__ = ("deadline", "callback", "args", "slot")
+
+    def __init__(self, deadline, callback, args):
+        self.deadline, self.callback, self.args = deadline, callback, args
+        # the dict of the wheel that holds this timer, None once it ran or was cancelled
+        self.slot = None
+
+    @property
+    def active(self):
+        return self.slot is not None
+
+    def cancel(self):
+        if self.slot is not None:
+            del self.slot[self]
+            self.slot = None
+
+
+class TimerWheel:
+    # Hierarchical timing wheel: timers are kept in slots of a tick each for the next `slots` ticks, and in coarser
+    # slots the further ahead they are; a coarse slot is spread over the finer ones once they come round. Scheduling
+    # and cancelling are O(1) whatever the number of timers, and a tick only looks at the timers that are due (and
+    # now and then at those of one coarse slot), so thousands of pending timeouts cost next to nothing while idle.
+    # Callbacks run on the IOLoop once their tick passed; exceptions are logged.
+
+    def __init__(self, tick=DEFAULT_TICK, slots=DEFAULT_SLOTS, levels=DEFAULT_LEVELS):
+        self.tick, self.slots, self.levels = tick, slots, levels
+        self.wheels = [[dict() for _ in range(slots)] for _ in range(levels)]
+        # ticks since start, and the IOLoop time of tick 0
+        self.ticks, self.start_time = 0, None
+        self.periodic = None
+
+    def __len__(self):
+        return sum(len(slot) for wheel in self.wheels for slot in wheel)
+
+    def now(self):
+        return IOLoop.current().time()
+
+    def start(self):
+        if self.periodic is None:
+            if self.start_time is None:
+                self.start_time = self.now()
+            self.periodic = PeriodicCallback(self.advance, self.tick * 1000)
+            self.periodic.start()
+
+    def stop(self):
+        if self.periodic is not None:
+            self.periodic.stop()
+            self.periodic = None
+
+    def schedule(self, delay, callback, *args):
+        # runs callback(*args) after delay seconds, give or take a tick; returns the Timer to cancel it with
+        if self.start_time is None:
+            self.start_time = self.now()
+        # ticks are counted from the last one that passed, and a timer never runs early
+        elapsed = (self.now() - self.start_time) / self.tick - self.ticks
+        deadline = self.ticks + max(1, int(elapsed + delay / self.tick + 0.999999))
+        timer = Timer(deadline, callback, args)
+        self.place(timer)
+        return timer
+
+    def remaining(self, timer):
+        # seconds until timer runs, give or take a tick
+        return max(0, self.start_time + timer.deadline * self.tick - self.now())
+
+    def place(self, timer):
+        ahead, level, span = timer.deadline - self.ticks, 0, 1
+        while level < self.levels - 1 and ahead >= span * self.slots:
+            level, span = level + 1, span * self.slots
+        # timers beyond the last level wait in its furthest slot and are placed again from there
+        deadline = min(timer.deadline, self.ticks + span * (self.slots - 1))
+        slot = self.wheels[level][(deadline // span) % self.slots]
+        slot[timer] = None
+        timer.slot = slot
+
+    def advance(self, now=None):
+        # runs the timers whose tick passed by now, by default the current IOLoop time
+        if self.start_time is None:
+            self.start_time = self.now()
+        target = int(((now if now is not None else self.now()) - self.start_time) / self.tick)
+        while self.ticks < target:
+            self.ticks += 1
+            self.cascade()
+            slot = self.wheels[0][self.ticks % self.slots]
+            while slot:
+                timer = next(iter(slot))
+                timer.cancel()
+                try:
+                    timer.callback(*timer.args)
+                except Exception as e:
+                    log.error("Timer callback failed: {}".format(e))
+
+    def cascade(self):
+        # spreads the coarse slots that start at this tick over the finer levels
+        span = 1
+        for level in range(1, self.levels):
+            span *= self.slots
+            if self.ticks % span:
+                break
+            slot = self.wheels[level][(self.ticks // span) % self.slots]
+            timers = list(slot)
+            slot.clear()
+            for timer in timers:
+                timer.slot = None
+                self.place(timer)
@@ -0,0 +1,91 @@
+import collections
+import os
+import ssl
+import threading
+
+# sessions a client context remembers, the least recently used are forgotten first
+DEFAULT_TLS_SESSIONS = 1024
+
+_contexts = dict()
+_contexts_lock = threading.Lock()
+
+
+class SessionCachingContext(ssl.SSLContext):
+    # Client context that resumes TLS sessions: wrap_socket() offers the session last saved for the same server, so
+    # reconnecting skips the full handshake when the server still knows the session. Servers are told apart by host and
+    # port, or by host alone when by_port is False, since P2P servers listen on a new port for every transfer.
+
+    def setup_sessions(self, by_port=True, capacity=DEFAULT_TLS_SESSIONS):
+        self.by_port, self.capacity = by_port, capacity
+        self.sessions = collections.OrderedDict()
+
+    def session_key(self, sock, server_hostname):
+        if not self.by_port:
+            return server_hostname
+        try:
+            return server_hostname, sock.getpeername()[1]
+        except OSError:
+            return None
+
+    def wrap_socket(self, sock, *args, server_hostname=None, session=None, **kwargs):
+        if session is None and not kwargs.get("server_side"):
+            session = self.sessions.get(self.session_key(sock, server_hostname))
+        return super().wrap_socket(sock, *args, server_hostname=server_hostname, session=session, **kwargs)
+
+    def save_session(self, sock):
+        # with TLS 1.3 the server sends its session tickets after the handshake, so call this once the server has sent
+        # something
+        session = sock.session
+        key = self.session_key(sock, sock.server_hostname)
+        if session is None or key is None:
+            return
+        self.sessions[key] = session
+        self.sessions.move_to_end(key)
+        if len(self.sessions) > self.capacity:
+            self.sessions.popitem(last=False)
+
+
+def _cached(key, make):
+    # one context per certificate file, replaced when the file changes so that a renewed certificate is picked up
+    path, mtime = key[1], None
+    if path:
+        path = os.path.abspath(path)
+        key, mtime = (key[0], path) + key[2:], os.stat(path).st_mtime_ns
+    with _contexts_lock:
+        cached = _contexts.get(key)
+        if cached is None or cached[0] != mtime:
+            cached = _contexts[key] = (mtime, make(path))
+        return cached[1]
+
+
+def client_ssl_context(cert_path="server.pem", by_port=True):
+    # process-wide context trusting cert_path, see SessionCachingContext
+    def make(path):
+        ctx = SessionCachingContext(ssl.PROTOCOL_TLS_CLIENT)
+        ctx.setup_sessions(by_port)
+        ctx.load_default_certs(ssl.Purpose.SERVER_AUTH)
+        if path:
+            ctx.load_verify_locations(path)
+            ctx.load_cert_chain(path)
+        ctx.check_hostname = False
+        return ctx
+
+    return _cached(("client", cert_path, by_port), make)
+
+
+def server_ssl_context(cert_path="server.pem"):
+    # process-wide context serving cert_path; sharing it also shares its session cache and ticket keys, which lets
+    # clients resume sessions with servers that started after they first connected, e.g. the next P2PServer
+    def make(path):
+        ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        if path:
+            ctx.load_cert_chain(path)
+        return ctx
+
+    return _cached(("server", cert_path), make)
+
+
+def clear_ssl_contexts():
+    # forgets every cached context along with its sessions
+    with _contexts_lock:
+        _contexts.clear()
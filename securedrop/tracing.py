@@ -0,0 +1,92 @@
+import collections
+import os
+import struct
+import sys
+import tempfile
+import time
+from logging import getLogger
+
+# events kept by a server, the oldest are overwritten first
+DEFAULT_TRACE_EVENTS = 64 * 1024
+
+TRACE_MAGIC = b"SDTRACE1"
+
+# header of a dump: magic, capacity, events recorded since the buffer was created
+TRACE_HEADER = struct.Struct("<8sIQ")
+
+# timestamp, connection id, event kind, packet prefix, size in bytes, seconds spent
+TRACE_EVENT = struct.Struct("<dIB4sId")
+
+ACCEPT, RECEIVE, SEND, ERROR, CLOSE = range(5)
+EVENT_KINDS = ("accept", "receive", "send", "error", "close")
+
+TraceEvent = collections.namedtuple("TraceEvent", ["time", "connection", "kind", "prefix", "size", "duration"])
+
+log = getLogger()
+
+
+class TraceBuffer:
+    # Fixed size ring of binary trace events, cheap enough to keep on in production: record() packs a few numbers into
+    # a preallocated bytearray, without formatting strings or allocating per event. dump() writes the ring to a file,
+    # which load() or `python -m securedrop.tracing FILE` read back.
+
+    def __init__(self, capacity=DEFAULT_TRACE_EVENTS):
+        self.capacity = capacity
+        self.buffer = bytearray(capacity * TRACE_EVENT.size)
+        self.count = 0
+        self.connections = 0
+
+    def new_connection(self):
+        self.connections += 1
+        return self.connections
+
+    def record(self, connection, kind, prefix=b"", size=0, duration=0.0):
+        TRACE_EVENT.pack_into(self.buffer, (self.count % self.capacity) * TRACE_EVENT.size, time.time(), connection,
+                              kind, prefix, size, duration)
+        self.count += 1
+
+    def ordered(self):
+        # the recorded bytes, oldest event first
+        if self.count <= self.capacity:
+            return bytes(self.buffer[:self.count * TRACE_EVENT.size])
+        split = (self.count % self.capacity) * TRACE_EVENT.size
+        return bytes(self.buffer[split:] + self.buffer[:split])
+
+    def events(self):
+        return parse_events(self.ordered())
+
+    def dump(self, path=None, dump_dir=None):
+        # returns the path written to
+        if path is None:
+            path = os.path.join(dump_dir if dump_dir is not None else tempfile.gettempdir(),
+                                "securedrop-trace-{}-{}.bin".format(os.getpid(), int(time.time())))
+        with open(path, "wb") as f:
+            f.write(TRACE_HEADER.pack(TRACE_MAGIC, self.capacity, self.count))
+            f.write(self.ordered())
+        log.info("Trace written to {}".format(path))
+        return path
+
+
+def parse_events(data):
+    return [TraceEvent(*fields) for fields in TRACE_EVENT.iter_unpack(data)]
+
+
+def load(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    magic, _, _ = TRACE_HEADER.unpack_from(data)
+    if magic != TRACE_MAGIC:
+        raise ValueError("{} is not a trace dump".format(path))
+    return parse_events(data[TRACE_HEADER.size:])
+
+
+def format_event(event):
+    return "{:.6f} conn={} {} {} size={} duration={:.6f}".format(event.time, event.connection, EVENT_KINDS[event.kind],
+                                                                 event.prefix.decode("ascii", "replace"), event.size,
+                                                                 event.duration)
+
+
+if __name__ == "__main__":
+    for trace_path in sys.argv[1:]:
+        for trace_event in load(trace_path):
+            print(format_event(trace_event))
@@ -1,12 +1,12 @@
-import math
 import os
-import zlib
 
 from Crypto.Hash import SHA256
 import logging
 
 from email_validator import validate_email, EmailNotValidError
 
+from securedrop.progress import Progress, ProgressEvent, TerminalSink, format_status, sizeof_fmt
+
 
 def validate_and_normalize_email(email):
     try:
@@ -16,38 +16,24 @@ def validate_and_normalize_email(email):
         print(str(e))
 
 
-def sha256_file(path: str):
+def sha256_file(path: str, progress_sinks=None):
     if not os.path.exists(path):
         return None
 
     chunk_size = 256 * 16
-    total_chunks = os.path.getsize(path) / math.ceil(chunk_size)
-    chunks_so_far = 0
-
-    def print_hash_progress(final=False):
-        print_status(*get_progress(chunks_so_far, total_chunks, chunk_size), "hashed", final)
-
-    print_hash_progress()
+    if progress_sinks is None:
+        progress_sinks = [TerminalSink("hashed")]
+    progress = Progress(os.path.getsize(path), sinks=progress_sinks)
     with open(path, "rb") as file:
         hasher = SHA256.new()
         while chunk := file.read(chunk_size):
             hasher.update(chunk)
-            chunks_so_far += 1
-            if chunks_so_far % 10 == 0:
-                print_hash_progress()
+            progress.update(len(chunk))
 
-        print_hash_progress(final=True)
+        progress.finish()
         return hasher.hexdigest()
 
 
-def sizeof_fmt(num, suffix='B'):
-    for unit in ['', 'Ki', 'Mi', 'Gi', 'Ti', 'Pi', 'Ei', 'Zi']:
-        if abs(num) < 1024.0:
-            return "%3.1f%s%s" % (num, unit, suffix)
-        num /= 1024.0
-    return "%.1f%s%s" % (num, 'Yi', suffix)
-
-
 def set_logger(verbose):
     # create logger
     logger = logging.getLogger()
@@ -67,12 +53,9 @@ def set_logger(verbose):
     logger.addHandler(ch)
 
 
-def get_progress(chunks_so_far, total_chunks, chunk_size):
-    chunks_so_far *= chunk_size
-    total_chunks *= chunk_size
-    percent = 100 * (chunks_so_far / total_chunks) if total_chunks else 0
-    return sizeof_fmt(chunks_so_far), sizeof_fmt(total_chunks), "{}%".format(int(percent))
+def get_progress(bytes_so_far, total_bytes):
+    return ProgressEvent(bytes_so_far, total_bytes).format()
 
 
 def print_status(progress, total, percent, verb, final=False):
-    print("{}/{} {} ({})".format(progress, total, verb, percent), end='\n' if final else '\r', flush=True)
+    print(format_status(progress, total, percent, verb), end='\n' if final else '\r', flush=True)
@@ -20,7 +20,6 @@ setup(
         'email-validator>=1.1.2',
         'idna>=2.10',
         'Naked>=0.1.31',
-        'nest-asyncio==1.4.3',
         'pycryptodome>=3.9.9',
         'PyYAML>=5.3.1',
         'requests>=2.25.0',